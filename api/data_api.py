@@ -1,46 +1,537 @@
+from contextlib import asynccontextmanager
+from datetime import date
+from email.utils import parsedate_to_datetime
+from itertools import groupby
 import logging
-from sqlite3 import Connection
-from typing import Iterable
+from operator import itemgetter
+import os
+import sqlite3
+from typing import (
+    AsyncContextManager,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Hashable,
+    List,
+    Literal,
+    Optional,
+)
 
 import fastapi
-from fastapi import Depends
-
-from models.report import Report
-from services import db
+from fastapi import Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from starlette.requests import Request
 
+from models.report import ALL_UTILITIES, AggregateReport, BatchReport, Report
+from services import (
+    aggregate,
+    db,
+    db_async,
+    encoding,
+    export,
+    ingests,
+    pool,
+    replica,
+    scheduler,
+    snapshot,
+)
+from services.cache import CachedResponse, ResponseCache
+from services.db import DATE_COL, PROD_TABLE, SAMPLES_COLS, UTILITY_COL
+from services.db_async import DataSource
+from services.encoding import Representation
+from services.metrics import SERIALIZE, timed
+from services.singleflight import SingleFlight
 
 logger = logging.getLogger(__name__)
 router = fastapi.APIRouter()
 
 API_ROOT = "/api/v1"
-DB_URI = "data/wastewater.db"
+DB_URI = db.DB_PATH
+DB_POOL_SIZE = int(os.environ.get("WASTEWATER_DB_POOL_SIZE", pool.DEFAULT_POOL_SIZE))
+# "sqlite" queries the db per request, "snapshot" serves from an in-memory copy of `latest`
+SERVING_MODE = os.environ.get("WASTEWATER_SERVING_MODE", "sqlite")
+# how long clients (and nginx) may reuse a response before revalidating it
+CACHE_MAX_AGE = 60
+
+response_cache = ResponseCache()
+# cache misses for the same response share one query and one serialized body
+inflight = SingleFlight()
+
+
+def current_db_uri() -> Optional[str]:
+    """The db to serve: on a replica, the newest snapshot pulled so far (see
+    services/replica.py). Reads a file, so not on the event loop"""
+    if replica.REPLICA_SOURCE:
+        return replica.current_uri()
+    return DB_URI
+
+
+def startup_db_uri() -> str:
+    """current_db_uri, after pulling a first snapshot if a replica has none yet. That downloads
+    the whole db, so only worker startup and preload use it, never a request"""
+    if replica.REPLICA_SOURCE and replica.read_current(replica.REPLICA_DIR) is None:
+        replica.pull(replica.REPLICA_SOURCE)
+    return current_db_uri()
+
+
+@router.on_event("startup")
+def init_db_pool():
+    # one pool per worker; opened after gunicorn forks. Requests only ever use this pool (or
+    # the one refresh_caches swaps in)
+    conn_pool = pool.init_pool(startup_db_uri(), size=DB_POOL_SIZE)
+    conn_pool.add_listener(response_cache.clear)
+    db_async.get_executor()
+    if SERVING_MODE == "snapshot":
+        conn_pool.add_listener(snapshot.invalidate)
+        snapshot.get_snapshot(conn_pool)
+
+
+def preload():
+    """Load read-only state once, before gunicorn forks its workers (see server/gunicorn.conf.py).
+
+    Workers inherit the snapshot and the cached utilities responses; no connections or threads
+    are opened here that would have to survive the fork.
+    """
+    db_uri = startup_db_uri()
+    conn = db.open_connection(db_uri)
+    try:
+        generation = db.get_generation(conn)
+        if SERVING_MODE == "snapshot":
+            snapshot.preload(conn, db_uri)
+        utilities = db.get_utilities(conn)
+    finally:
+        conn.close()
+    if utilities:
+        for content_encoding in [None, *encoding.content_encodings()]:
+            rep = Representation(encoding.JSON, content_encoding)
+            cache_json(("utilities",), generation, rep, {"utilities": utilities})
+    logger.info(f"Preloaded generation {generation} ({SERVING_MODE=})")
+
+
+async def refresh_caches():
+    """Pick up a new dataset generation ahead of the next request"""
+    conn_pool = pool.get_pool()
+    if replica.REPLICA_SOURCE:
+        db_uri = await db_async.run(current_db_uri)
+        if db_uri is not None and db_uri != conn_pool.db_uri:
+            # a newer snapshot was pulled: move to it (notifying the listeners) and let the old
+            # pool's connections close as in-flight requests release them
+            conn_pool = await db_async.run(pool.swap_pool, db_uri)
+    # acquiring a connection checks the generation and notifies the pool's listeners
+    async with db_async.connection(conn_pool):
+        pass
+    if SERVING_MODE == "snapshot":
+        await db_async.get_snapshot(conn_pool)
+
+
+@router.on_event("startup")
+async def start_scheduler():
+    if scheduler.REFRESH_INTERVAL > 0:
+        scheduler.start(refresh_caches)
+
+
+@router.on_event("shutdown")
+def close_db_pool():
+    scheduler.stop()
+    db_async.shutdown_executor()
+    pool.close_pool()
 
 
 # dependency
-def get_db_conn():
-    conn = db.get_connection(DB_URI)
+async def get_db_conn():
+    async with db_async.connection(pool.get_pool()) as conn:
+        yield conn
+
+
+async def get_export_conn():
+    # exports can run for a while, so they get their own connection rather than a pool slot
+    conn = await db_async.run(db.open_connection, pool.get_pool().db_uri)
     try:
         yield conn
     finally:
         conn.close()
 
 
+async def get_snapshot():
+    return await db_async.get_snapshot(pool.get_pool())
+
+
+get_data_source = get_snapshot if SERVING_MODE == "snapshot" else get_db_conn
+
+OpenDataSource = Callable[[], AsyncContextManager[DataSource]]
+
+
+@asynccontextmanager
+async def pooled_connection() -> AsyncIterator[sqlite3.Connection]:
+    async with db_async.connection(pool.get_pool()) as conn:
+        yield conn
+
+
+@asynccontextmanager
+async def pooled_snapshot() -> AsyncIterator[snapshot.Snapshot]:
+    yield await db_async.get_snapshot(pool.get_pool())
+
+
+# dependency: for responses built once for many requests, the data source is opened by the
+# build itself, so requests waiting on it (or answered from the cache) hold no pool slot
+def get_data_source_opener() -> OpenDataSource:
+    return pooled_snapshot if SERVING_MODE == "snapshot" else pooled_connection
+
+
+async def current_generation(open_source: OpenDataSource) -> int:
+    # opening a source checks the generation (clearing the caches if it changed); the
+    # connection goes straight back to the pool
+    async with open_source() as source:
+        return db_async.get_generation(source)
+
+
+SAMPLES_FIELDS = [DATE_COL, *SAMPLES_COLS]
+BATCH_FIELDS = [UTILITY_COL, *SAMPLES_FIELDS]
+
+
+def negotiate(request: Request, fmt: Optional[str] = None, tabular: bool = True) -> Representation:
+    try:
+        return encoding.negotiate(
+            request.headers.get("accept"), request.headers.get("accept-encoding"), fmt, tabular
+        )
+    except encoding.NotAcceptable as e:
+        raise HTTPException(status_code=406, detail=str(e))
+
+
+# dependencies: how to encode the response body
+def get_representation(
+    request: Request,
+    fmt: Optional[Literal[tuple(encoding.FORMATS)]] = Query(None, alias="format"),
+) -> Representation:
+    # sample rows: JSON rows, columnar JSON, Arrow or Parquet; `format` overrides Accept
+    return negotiate(request, fmt)
+
+
+def get_json_representation(request: Request) -> Representation:
+    return negotiate(request, tabular=False)
+
+
+def is_not_modified(request: Request, cached: CachedResponse) -> bool:
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110 13.2.2)
+    if if_none_match := request.headers.get("if-none-match"):
+        etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in etags or cached.etag in etags
+    if (if_modified_since := request.headers.get("if-modified-since")) and cached.last_modified:
+        try:
+            return cached.generation <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def cached_response(request: Request, cached: CachedResponse) -> fastapi.Response:
+    headers = {
+        "ETag": cached.etag,
+        "Cache-Control": f"public, max-age={CACHE_MAX_AGE}",
+        "Vary": "Accept, Accept-Encoding",
+    }
+    if cached.last_modified:
+        headers["Last-Modified"] = cached.last_modified
+    if is_not_modified(request, cached):
+        return fastapi.Response(status_code=304, headers=headers)
+    if cached.content_encoding:
+        headers["Content-Encoding"] = cached.content_encoding
+    return fastapi.Response(content=cached.body, media_type=cached.media_type, headers=headers)
+
+
+def cache_body(key: Hashable, generation: int, rep: Representation, body: bytes) -> CachedResponse:
+    with timed(SERIALIZE, endpoint=key[0], media_type=rep.media_type, stage="compress"):
+        body, content_encoding = encoding.compress(body, rep.content_encoding)
+    return response_cache.put((*key, rep), generation, body, rep.media_type, content_encoding)
+
+
+def get_cached(key: Hashable, generation: int, rep: Representation) -> Optional[CachedResponse]:
+    # each representation of a resource is cached (and validated) separately
+    return response_cache.get((*key, rep), generation)
+
+
+def cache_json(key: Hashable, generation: int, rep: Representation, content: dict):
+    with timed(SERIALIZE, endpoint=key[0], media_type=rep.media_type, stage="encode"):
+        body = encoding.dumps(content)
+    return cache_body(key, generation, rep, body)
+
+
+async def cache_table(
+    key: Hashable,
+    generation: int,
+    rep: Representation,
+    content: dict,
+    fields: List[str],
+    rows: List[tuple],
+) -> CachedResponse:
+    # long ranges take a while to encode and compress, keep that off the event loop
+    with timed(SERIALIZE, endpoint=key[0], media_type=rep.media_type, stage="encode"):
+        body = await db_async.run(encoding.encode_table, content, fields, rows, rep.media_type)
+    return await db_async.run(cache_body, key, generation, rep, body)
+
+
+async def build_once(
+    key: Hashable,
+    generation: int,
+    rep: Representation,
+    build: Callable[..., Awaitable[Optional[CachedResponse]]],
+    *args,
+) -> Optional[CachedResponse]:
+    """Build (and cache) a response missing from the cache, or wait for an identical request
+    that is already building it. `build(key, rep, *args)` opens its own data source: the
+    requests sharing it may finish (and release theirs) before it does"""
+    return await inflight.do((*key, rep, generation), key[0], build, key, rep, *args)
+
+
+def internal_error() -> fastapi.Response:
+    return fastapi.Response(content="Internal error. Please try again later.", status_code=500)
+
+
 @router.get(f"{API_ROOT}/utilities")
-def utilities(conn: Connection = Depends(get_db_conn)):
-    logger.debug(f"Querying utilities")
-    results = db.get_utilities(conn)
-    if len(results) == 0:
-        resp = fastapi.Response(content="Internal error. Please try again later.", status_code=500)
-    else:
-        resp = {"utilities": results}
-    return resp
+async def utilities(
+    request: Request,
+    source: DataSource = Depends(get_data_source),
+    rep: Representation = Depends(get_json_representation),
+):
+    generation = db_async.get_generation(source)
+    key = ("utilities",)
+    if (cached := get_cached(key, generation, rep)) is None:
+        logger.debug(f"Querying utilities")
+        results = await db_async.get_utilities(source)
+        if len(results) == 0:
+            return internal_error()
+        cached = cache_json(key, generation, rep, {"utilities": results})
+    return cached_response(request, cached)
 
 
 @router.get(f"{API_ROOT}/samples")
-def samples(report: Report = Depends(), conn: Connection = Depends(get_db_conn)):
-    results = db.get_samples(conn, report)
+async def samples(
+    request: Request,
+    report: Report = Depends(),
+    open_source: OpenDataSource = Depends(get_data_source_opener),
+    rep: Representation = Depends(get_representation),
+):
+    generation = await current_generation(open_source)
+    key = ("samples", report.utility, report.start, report.end)
+    if (cached := get_cached(key, generation, rep)) is None:
+        cached = await build_once(key, generation, rep, build_samples, open_source, report)
+        if cached is None:
+            return internal_error()
+    return cached_response(request, cached)
+
+
+async def build_samples(
+    key: Hashable, rep: Representation, open_source: OpenDataSource, report: Report
+) -> Optional[CachedResponse]:
+    async with open_source() as source:
+        # cached under the generation actually read, which may be newer than the lookup's
+        generation = db_async.get_generation(source)
+        results = await db_async.get_samples(source, report)
     if len(results) == 0:
-        resp = fastapi.Response(content="Internal error. Please try again later.", status_code=500)
-    else:
-        resp = {"parameters": report.dict(), "samples": results}
-    return resp
+        return None
+    content = {"parameters": report.dict()}
+    return await cache_table(key, generation, rep, content, SAMPLES_FIELDS, results)
+
+
+@router.get(f"{API_ROOT}/summary")
+async def summary(
+    request: Request,
+    conn: sqlite3.Connection = Depends(get_db_conn),
+    rep: Representation = Depends(get_json_representation),
+):
+    generation = db_async.get_generation(conn)
+    key = ("summary",)
+    if (cached := get_cached(key, generation, rep)) is None:
+        results = await db_async.get_summary(conn)
+        if len(results) == 0:
+            return internal_error()
+        cached = cache_json(key, generation, rep, {"summary": results})
+    return cached_response(request, cached)
+
+
+@router.get(f"{API_ROOT}/status")
+async def status(conn: sqlite3.Connection = Depends(get_db_conn)):
+    # a few index lookups, and it changes with loads that don't publish: not cached
+    return await db_async.run(ingests.get_status, conn)
+
+
+@router.get(f"{API_ROOT}/samples/aggregate")
+async def aggregate_samples(
+    request: Request,
+    report: AggregateReport = Depends(),
+    open_source: OpenDataSource = Depends(get_data_source_opener),
+    rep: Representation = Depends(get_representation),
+):
+    generation = await current_generation(open_source)
+    key = ("aggregate", *report.dict().values())
+    if (cached := get_cached(key, generation, rep)) is None:
+        cached = await build_once(key, generation, rep, build_aggregate, open_source, report)
+        if cached is None:
+            return internal_error()
+    return cached_response(request, cached)
+
+
+async def build_aggregate(
+    key: Hashable, rep: Representation, open_source: OpenDataSource, report: AggregateReport
+) -> Optional[CachedResponse]:
+    async with open_source() as source:
+        generation = db_async.get_generation(source)
+        rows = await db_async.get_samples(source, report)
+    results = await db_async.run(aggregate.summarize, rows, report)
+    if len(results) == 0:
+        return None
+    content = {"parameters": report.dict()}
+    return await cache_table(key, generation, rep, content, SAMPLES_FIELDS, results)
+
+
+def get_batch_report(
+    utility: List[str] = Query([ALL_UTILITIES]),
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+) -> BatchReport:
+    # repeated `utility` params; unset dates fall back to the model's defaults
+    return BatchReport(utilities=utility, start=start, end=end)
+
+
+async def stream_batch(report: BatchReport, chunks: AsyncIterator[List[tuple]]):
+    # same document as the buffered JSON response, written out one fetched chunk at a time
+    dumps = encoding.dumps
+    yield b'{"parameters":' + dumps(report.dict()) + b',"samples":{'
+    current = None
+    async for chunk in chunks:
+        for utility, rows in groupby(chunk, key=itemgetter(0)):
+            values = b",".join(dumps(row[1:]) for row in rows)
+            if utility == current:
+                yield b"," + values
+            else:
+                separator = b"" if current is None else b"],"
+                yield separator + dumps(utility) + b":[" + values
+                current = utility
+    yield b"}}" if current is None else b"]}}"
+
+
+@router.get(f"{API_ROOT}/samples/batch")
+async def batch_samples(
+    request: Request,
+    report: BatchReport = Depends(get_batch_report),
+    stream: bool = False,
+    open_source: OpenDataSource = Depends(get_data_source_opener),
+    rep: Representation = Depends(get_representation),
+):
+    if stream:
+        # for statewide pulls: never holds more than one fetch in memory, and skips the cache.
+        # only JSON rows can be written out a chunk at a time
+        if rep.media_type != encoding.JSON:
+            raise HTTPException(
+                status_code=406, detail=f"stream=true is only available as {encoding.JSON}"
+            )
+        chunks = iter_batch_samples(open_source, report)
+        return StreamingResponse(stream_batch(report, chunks), media_type="application/json")
+    generation = await current_generation(open_source)
+    key = ("batch", tuple(report.utilities), report.start, report.end)
+    if (cached := get_cached(key, generation, rep)) is None:
+        cached = await build_once(key, generation, rep, build_batch, open_source, report)
+        if cached is None:
+            return internal_error()
+    return cached_response(request, cached)
+
+
+async def iter_batch_samples(
+    open_source: OpenDataSource, report: BatchReport
+) -> AsyncIterator[List[tuple]]:
+    # the source stays open until the last chunk is sent
+    async with open_source() as source:
+        async for chunk in db_async.iter_batch_samples(source, report):
+            yield chunk
+
+
+async def build_batch(
+    key: Hashable, rep: Representation, open_source: OpenDataSource, report: BatchReport
+) -> Optional[CachedResponse]:
+    async with open_source() as source:
+        generation = db_async.get_generation(source)
+        chunks = db_async.iter_batch_samples(source, report)
+        rows = [row async for chunk in chunks for row in chunk]
+    if len(rows) == 0:
+        return None
+    content = {"parameters": report.dict()}
+    if rep.media_type == encoding.JSON:
+        # JSON rows are grouped by utility; the columnar formats get a Utility column instead
+        grouped = {u: [row[1:] for row in group] for u, group in groupby(rows, itemgetter(0))}
+        return cache_json(key, generation, rep, {**content, "samples": grouped})
+    return await cache_table(key, generation, rep, content, BATCH_FIELDS, rows)
+
+
+@router.get(f"{API_ROOT}/export/tables")
+async def export_tables(conn: sqlite3.Connection = Depends(get_export_conn)):
+    return {
+        "tables": await db_async.run(export.exportable_tables, conn),
+        "generations": await db_async.run(export.exportable_generations, conn),
+    }
+
+
+async def stream_export(
+    conn: sqlite3.Connection,
+    table: str,
+    columns: List[str],
+    rows: Optional[tuple],
+    media_type: str,
+    generation: Optional[int] = None,
+) -> AsyncIterator[bytes]:
+    query, params = export.export_query(table, rows, generation)
+    # csv header only at the start of the table, so resumed downloads can be appended
+    header = columns if rows is None or rows[0] == 0 else None
+    async for chunk in db_async.iter_rows(conn, "export", query, params, export.BATCH_ROWS):
+        if media_type == export.CSV:
+            yield export.encode_csv(chunk, header)
+            header = None
+        else:
+            yield export.encode_ndjson(chunk, columns)
+
+
+@router.get(f"{API_ROOT}/export")
+async def export_table(
+    request: Request,
+    table: str = PROD_TABLE,
+    generation: Optional[int] = None,
+    fmt: Literal[tuple(export.EXPORT_FORMATS)] = Query("csv", alias="format"),
+    conn: sqlite3.Connection = Depends(get_export_conn),
+):
+    """Stream `latest`, `latest` as of a past `generation` (see /export/tables), or a dated
+    backup table from before the history table. Supports `Range: rows=<first>-[<last>]` with
+    `If-Range: <ETag of the first response>`"""
+    if table not in await db_async.run(export.exportable_tables, conn):
+        raise HTTPException(status_code=404, detail=f"No exportable table {table}")
+    rebuilt = generation is not None
+    if rebuilt and (
+        table != PROD_TABLE
+        or generation not in await db_async.run(export.exportable_generations, conn)
+    ):
+        raise HTTPException(status_code=404, detail=f"No generation {generation} of {table}")
+    generation, columns, total = await db_async.run(export.begin_export, conn, table, generation)
+    tag = export.etag(table, generation, rebuilt)
+    filename = f"{table}-{generation}.{fmt}" if rebuilt else f"{table}.{fmt}"
+    headers = {
+        "Accept-Ranges": "rows",
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "ETag": tag,
+    }
+    try:
+        rows = export.requested_rows(
+            request.headers.get("range"), request.headers.get("if-range"), tag, total
+        )
+    except export.PreconditionRequired as e:
+        raise HTTPException(status_code=428, detail=str(e))
+    except export.RangeNotSatisfiable as e:
+        return fastapi.Response(status_code=416, headers={"Content-Range": str(e), "ETag": tag})
+    status_code = 200
+    if rows is not None:
+        status_code = 206
+        headers["Content-Range"] = f"rows {rows[0]}-{rows[1]}/{total}"
+    media_type = export.EXPORT_FORMATS[fmt]
+    return StreamingResponse(
+        stream_export(conn, table, columns, rows, media_type, generation if rebuilt else None),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers,
+    )
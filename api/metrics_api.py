@@ -0,0 +1,11 @@
+import fastapi
+
+from services import metrics
+
+router = fastapi.APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return fastapi.Response(content=body, media_type=content_type)
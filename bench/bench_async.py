@@ -0,0 +1,93 @@
+"""Compare endpoint throughput of the sync (threadpool), async (dedicated executor) and
+in-memory snapshot data paths
+
+usage: python bench/bench_async.py [--requests 2000] [--concurrency 200]
+"""
+
+import argparse
+import asyncio
+from pathlib import Path
+import sys
+import tempfile
+import time
+
+import fastapi
+from fastapi import Depends
+import httpx
+
+# enable the script to have access to other modules
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+from api import data_api
+from bench.synth import build_db
+from models.report import Report
+from services import db, pool
+
+
+def sync_app(db_file: str) -> fastapi.FastAPI:
+    # the original handlers: sync def endpoints run in starlette's threadpool, with a
+    # connection opened per request
+    app = fastapi.FastAPI()
+
+    def get_db_conn():
+        conn = db.get_connection(db_file)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @app.get(f"{data_api.API_ROOT}/samples")
+    def samples(report: Report = Depends(), conn=Depends(get_db_conn)):
+        return {"parameters": report.dict(), "samples": db.get_samples(conn, report)}
+
+    return app
+
+
+def async_app(serving_mode: str = "sqlite") -> fastapi.FastAPI:
+    app = fastapi.FastAPI()
+    app.include_router(data_api.router)
+    if serving_mode == "snapshot":
+        app.dependency_overrides[data_api.get_data_source] = data_api.get_snapshot
+        app.dependency_overrides[data_api.get_data_source_opener] = lambda: data_api.pooled_snapshot
+    return app
+
+
+async def drive(app: fastapi.FastAPI, n_requests: int, concurrency: int) -> float:
+    queue: asyncio.Queue = asyncio.Queue()
+    for _ in range(n_requests):
+        queue.put_nowait(f"{data_api.API_ROOT}/samples")
+
+    async def worker(client: httpx.AsyncClient):
+        while not queue.empty():
+            resp = await client.get(queue.get_nowait())
+            assert resp.status_code == 200, resp.text
+
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2_000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = build_db(str(Path(tmp) / "bench.db"))
+        pool.init_pool(db_file, size=data_api.DB_POOL_SIZE)
+        print(f"{args.requests} requests, {args.concurrency} concurrent clients")
+        for name, app in [
+            ("sync", sync_app(db_file)),
+            ("async", async_app()),
+            ("snapshot", async_app("snapshot")),
+        ]:
+            elapsed = asyncio.run(drive(app, args.requests, args.concurrency))
+            print(f"{name:>8}: {args.requests / elapsed:8.1f} req/s ({elapsed:.2f}s)")
+        pool.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Compare payload size and encode time of the samples response formats, for a 30 day and an
+all-time range of one utility
+
+usage: python bench/bench_formats.py [--days 1100] [--repeat 20]
+"""
+
+import argparse
+from datetime import date, timedelta
+from pathlib import Path
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Callable
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+# enable the script to have access to other modules
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+from api.data_api import SAMPLES_FIELDS
+from bench.synth import DEFAULT_UTILITY, build_db
+from models.report import Report
+from services import db, encoding
+
+
+def legacy_json(content: dict, rows: list) -> bytes:
+    # the original path: jsonable_encoder + stdlib json via JSONResponse
+    return JSONResponse(content=jsonable_encoder({**content, "samples": rows})).body
+
+
+def timed(encode: Callable[[], bytes], repeat: int) -> tuple:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        body = encode()
+    return body, (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=1_100, help="days of data per utility")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        n_utilities = 10
+        db_file = build_db(str(Path(tmp) / "bench.db"), args.days * n_utilities, n_utilities)
+        conn = sqlite3.connect(db_file)
+        ranges = {
+            "30 days": Report(utility=DEFAULT_UTILITY),
+            "all time": Report(utility=DEFAULT_UTILITY, start=date.today() - timedelta(days=3650)),
+        }
+        formats = [("json (before)", None)] + [
+            (name, media_type)
+            for name, media_type in encoding.FORMATS.items()
+            if media_type in encoding.media_types()
+        ]
+        print(f"orjson: {encoding.orjson is not None}, brotli: {encoding.brotli is not None}")
+        print(f"{'':>9} {'format':>14} {'rows':>6} {'bytes':>9} {'gzip':>8} {'br':>8} {'ms':>7}")
+        for range_name, report in ranges.items():
+            rows = db.get_samples(conn, report)
+            content = {"parameters": report.dict()}
+            for name, media_type in formats:
+                if media_type is None:
+                    encode = lambda: legacy_json(content, rows)
+                else:
+                    encode = lambda: encoding.encode_table(
+                        content, SAMPLES_FIELDS, rows, media_type
+                    )
+                body, ms = timed(encode, args.repeat)
+                sizes = []
+                for content_encoding in ["gzip", "br"]:
+                    if content_encoding in encoding.content_encodings():
+                        compressed, _ = encoding.compress(body, content_encoding)
+                        sizes.append(f"{len(compressed):8d}")
+                    else:
+                        sizes.append(f"{'-':>8}")
+                print(
+                    f"{range_name:>9} {name:>14} {len(rows):6d} {len(body):9d} "
+                    + f"{' '.join(sizes)} {ms:7.2f}"
+                )
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Compare staging load times with per-row date conversion (the original loader) against
+converting dates once per distinct value before insert, and loading a CSV download through
+DictReader (the original CSV loader) against typed batches inserted in one transaction
+
+usage: python bench/bench_load.py [--rows 50000] [--utilities 60] [--workers N]
+"""
+
+import argparse
+import csv
+from datetime import datetime
+from pathlib import Path
+import sys
+import tempfile
+import time
+from typing import Callable, Iterable, List
+
+from dateutil import parser as date_parser
+from sqlite_utils import Database
+
+# enable the script to have access to other modules
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+from bench.synth import COLS, rows
+from models.observation import CdpheObservation
+from tools import update_data
+
+DATE = CdpheObservation.DATE.value
+
+
+def json_records(n_rows: int, n_utilities: int) -> List[dict]:
+    # flattened portal features: dates as epoch ms
+    records = []
+    for row in rows(n_rows, n_utilities):
+        record = dict(zip(COLS, row))
+        record[DATE] = int(datetime.fromisoformat(record[DATE]).timestamp() * 1000)
+        records.append(record)
+    return records
+
+
+def csv_rows(n_rows: int, n_utilities: int) -> List[dict]:
+    # DictReader rows of the portal's CSV export: everything is a string
+    records = []
+    for i, row in enumerate(rows(n_rows, n_utilities)):
+        record = {k: "" if v is None else str(v) for k, v in zip(COLS, row)}
+        record[DATE] = record[DATE].replace("-", "/") + " 00:00:00+00"
+        record[CdpheObservation.OBJECTID.value] = str(i)
+        records.append(record)
+    return records
+
+
+def write_csv(path: str, n_rows: int, n_utilities: int) -> str:
+    # the portal's CSV export, OBJECTID first
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([CdpheObservation.OBJECTID.value] + COLS)
+        for record in csv_rows(n_rows, n_utilities):
+            writer.writerow([record.pop(CdpheObservation.OBJECTID.value)] + list(record.values()))
+    return path
+
+
+def legacy_load_csv(db: Database, data_file: str, table: str) -> int:
+    # the original update_db_from_csv_file: DictReader, a dict per row, all rows in memory
+    with open(data_file, encoding="utf-8-sig", mode="r") as f:
+        xformed_data = [update_data.transform_raw_csv_data(row) for row in csv.DictReader(f)]
+    return update_data.load_staging(db, xformed_data, table)
+
+
+def legacy_transform_csv(csv_row: dict) -> dict:
+    # the original transform_raw_csv_data: dateutil on every row, to epoch ms
+    dt = date_parser.parse(csv_row[DATE])
+    csv_row[DATE] = int(dt.timestamp() * 1000.0)
+    del csv_row[CdpheObservation.OBJECTID.value]
+    for k in [CdpheObservation.COPIES_LP1.value, CdpheObservation.COPIES_LP2.value]:
+        try:
+            csv_row[k] = float(csv_row[k])
+        except ValueError:
+            csv_row[k] = None
+    csv_row[CdpheObservation.CASES.value] = int(csv_row[CdpheObservation.CASES.value])
+    return csv_row
+
+
+def legacy_load(db: Database, data: Iterable[dict], table: str) -> int:
+    # the original load_staging: integer dates, then a python callback per row via convert()
+    db[table].drop(ignore=True)
+    db[table].create(
+        {
+            DATE: int,
+            CdpheObservation.UTILITY.value: str,
+            CdpheObservation.COPIES_LP1.value: float,
+            CdpheObservation.COPIES_LP2.value: float,
+            CdpheObservation.CASES.value: int,
+            CdpheObservation.PHASE.value: str,
+        }
+    )
+    db[table].insert_all(records=data)
+    db[table].convert(DATE, lambda x: datetime.fromtimestamp(x / 1000.0).date().isoformat())
+    return db[table].count
+
+
+def timed(name: str, load: Callable[[], int]) -> float:
+    update_data.epoch_ms_to_iso.cache_clear()
+    update_data.csv_date_to_iso.cache_clear()
+    start = time.perf_counter()
+    count = load()
+    elapsed = time.perf_counter() - start
+    print(f"{name:>12}: {elapsed:6.2f}s ({count / elapsed:9.0f} rows/s)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--utilities", type=int, default=60)
+    parser.add_argument("--workers", type=int, default=update_data.CSV_WORKERS)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(str(Path(tmp) / "bench.db"))
+        print(f"Loading {args.rows} rows for {args.utilities} utilities")
+        # each load consumes (mutates) its records, so every run gets a fresh copy
+        for name, records, legacy, current in [
+            ("json", json_records, lambda r: r, lambda r: r),
+            ("csv", csv_rows, legacy_transform_csv, update_data.transform_raw_csv_data),
+        ]:
+            data = records(args.rows, args.utilities)
+            before = timed(f"{name} before", lambda: legacy_load(db, map(legacy, data), "staging"))
+            data = records(args.rows, args.utilities)
+            after = timed(
+                f"{name} after", lambda: update_data.load_staging(db, map(current, data), "staging")
+            )
+            print(f"{'':>12}  {before / after:.1f}x faster")
+
+        data_file = write_csv(str(Path(tmp) / "download.csv"), args.rows, args.utilities)
+        before = timed("file before", lambda: legacy_load_csv(db, data_file, "staging"))
+        batches = lambda: update_data.transform_csv_file(data_file, args.workers)
+        after = timed("file after", lambda: update_data.load_staging_rows(db, batches(), "staging"))
+        print(f"{'':>12}  {before / after:.1f}x faster ({args.workers} workers)")
+
+
+if __name__ == "__main__":
+    main()
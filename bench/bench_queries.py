@@ -0,0 +1,97 @@
+"""Compare a mixed read workload with interpolated SQL (the original samples query), and with the
+parameterized statements in services.queries with and without sqlite3's statement cache
+
+usage: python bench/bench_queries.py [--rows 50000] [--utilities 600] [--queries 20000]
+"""
+
+import argparse
+from datetime import date, timedelta
+from pathlib import Path
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Callable, List, Tuple
+
+# enable the script to have access to other modules
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+from bench.synth import build_db, utility_names
+from models.report import BatchReport, Report
+from services import db, queries
+from services.queries import DATE_COL, PROD_TABLE, SAMPLES_COLS, UTILITY_COL, double_quote
+
+# days back from today; most requests are for the default 30 day window
+RANGES = [30] * 6 + [90] * 2 + [365, 3650]
+
+
+def legacy_samples_query(report: Report) -> Tuple[str, tuple]:
+    # the original get_samples: values spliced into the text, so every request is a new statement
+    cols = f"{DATE_COL}, {','.join([double_quote(col) for col in SAMPLES_COLS])}"
+    condition = (
+        f"{UTILITY_COL} = '{report.utility}' "
+        + f"AND {DATE_COL} >= '{report.start}' "
+        + f"AND {DATE_COL} <= '{report.end}'"
+    )
+    return f"SELECT {cols} FROM {PROD_TABLE} WHERE {condition} ORDER BY {DATE_COL} ASC", ()
+
+
+def workload(utilities: List[str], n_queries: int, seed: int = 0) -> List[object]:
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(n_queries):
+        start = date.today() - timedelta(days=rng.choice(RANGES) + rng.randint(0, 6))
+        kind = rng.random()
+        if kind < 0.85:
+            requests.append(Report(utility=rng.choice(utilities), start=start))
+        elif kind < 0.95:
+            requests.append(BatchReport(utilities=rng.sample(utilities, 3), start=start))
+        else:
+            requests.append(None)
+    return requests
+
+
+def run(conn: sqlite3.Connection, requests: List[object], samples: Callable) -> float:
+    start = time.perf_counter()
+    for request in requests:
+        if request is None:
+            query, params = queries.UTILITIES, ()
+        elif isinstance(request, BatchReport):
+            query, params = db.batch_samples_query(request)
+        else:
+            query, params = samples(request)
+        conn.execute(query, params).fetchall()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--utilities", type=int, default=600)
+    parser.add_argument("--queries", type=int, default=20_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = build_db(str(Path(tmp) / "bench.db"), args.rows, args.utilities)
+        requests = workload(utility_names(args.utilities), args.queries)
+        print(f"{args.queries} queries over {args.rows} rows and {args.utilities} utilities")
+        results = {}
+        for name, samples, cached_statements in [
+            ("interpolated", legacy_samples_query, db.CACHED_STATEMENTS),
+            ("params, no cache", db.samples_query, 0),
+            ("params, cached", db.samples_query, db.CACHED_STATEMENTS),
+        ]:
+            conn = sqlite3.connect(db_file, cached_statements=cached_statements)
+            # warm the page cache so every run reads the same pages from memory
+            run(conn, requests[:1_000], samples)
+            results[name] = elapsed = run(conn, requests, samples)
+            conn.close()
+            print(f"{name:>16}: {elapsed / args.queries * 1e6:7.1f} us/query")
+        speedup = results["interpolated"] / results["params, cached"]
+        print(f"{'':>16}  {speedup:.2f}x faster than interpolated")
+
+
+if __name__ == "__main__":
+    main()
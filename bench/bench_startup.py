@@ -0,0 +1,77 @@
+"""Measure how long a fresh API process takes to import, build the app and serve its first
+request, i.e. the gap a restarted gunicorn worker leaves. Each run is a new interpreter.
+
+In CI the results are also written to the job summary ($GITHUB_STEP_SUMMARY).
+
+usage: python bench/bench_startup.py [--runs 5]
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# enable the script to have access to other modules
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+from bench.synth import build_db
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.create_app(env="prod")
+created = time.perf_counter()
+from fastapi.testclient import TestClient
+from api import data_api
+data_api.DB_URI = sys.argv[1]
+helpers = time.perf_counter()
+with TestClient(app) as client:
+    assert client.get("/api/v1/utilities").status_code == 200
+served = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "first_response_ms": (served - helpers) * 1000,
+    "total_ms": (served - start - (helpers - created)) * 1000,
+}))
+"""
+
+
+def run_child(db_file: str) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD, db_file],
+        cwd=project_root,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = build_db(str(Path(tmp) / "bench.db"))
+        runs = [run_child(db_file) for _ in range(args.runs)]
+    lines = [f"| startup ({args.runs} runs) | median ms | max ms |", "|---|---:|---:|"]
+    for name in runs[0]:
+        values = [run[name] for run in runs]
+        lines.append(f"| {name} | {statistics.median(values):.1f} | {max(values):.1f} |")
+    print("\n".join(lines))
+    if summary := os.environ.get("GITHUB_STEP_SUMMARY"):
+        with open(summary, "a") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+if __name__ == "__main__":
+    main()
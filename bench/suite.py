@@ -0,0 +1,242 @@
+"""Benchmark suite for the query, endpoint and ingestion hot paths at several dataset sizes.
+
+For each size a synthetic `latest` table (see bench/synth.py) is built and measured for:
+- get_utilities / get_samples latency (30 day and all-time ranges), p50 and p95
+- /api/v1/samples throughput through the ASGI app, with a cold response cache
+- update_db load time and peak memory (in a child process, so sizes don't share a heap)
+
+Each run appends one JSON line per size to bench/results/results.jsonl, tagged with the git commit
+and host, and is compared against the last run recorded for the same size on the same host;
+anything more than --threshold worse is flagged.
+
+usage: python bench/suite.py [--sizes 50k,500k] [--no-save] [--fail-on-regression]
+"""
+
+import argparse
+import asyncio
+from datetime import date, datetime, timedelta
+import json
+import multiprocessing
+from pathlib import Path
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+
+import httpx
+
+# enable the script to have access to other modules
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+from bench.bench_async import async_app
+from bench.synth import COLS, build_db, rows, utility_names
+from models.observation import CdpheObservation
+from models.report import Report
+from services import db, pool
+
+RESULTS_FILE = project_root / "bench" / "results" / "results.jsonl"
+# rows: utilities; about 830 days of data per utility at every size
+SIZES = {"50k": (50_000, 60), "500k": (500_000, 600), "5m": (5_000_000, 6_000)}
+DEFAULT_SIZES = "50k,500k"
+# the fraction a metric may get worse by before it's reported as a regression
+DEFAULT_THRESHOLD = 0.2
+# metrics where bigger is better; everything else is a time or a size
+HIGHER_IS_BETTER = {"samples_req_per_s"}
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    cuts = statistics.quantiles(samples, n=20)
+    return {"p50": statistics.median(samples), "p95": cuts[18]}
+
+
+def latency_ms(call: Callable[[], object], repeat: int) -> Dict[str, float]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - start) * 1000)
+    return percentiles(samples)
+
+
+def query_latencies(db_file: str, utilities: List[str], repeat: int) -> Dict[str, float]:
+    conn = db.open_connection(db_file)
+    results = {}
+    for name, stats in latency_ms(lambda: db.get_utilities(conn), repeat).items():
+        results[f"get_utilities_{name}_ms"] = stats
+    ranges = {
+        "30d": lambda utility: Report(utility=utility),
+        "all": lambda utility: Report(utility=utility, start=date.today() - timedelta(days=3650)),
+    }
+    for range_name, report in ranges.items():
+        reports = [report(utility) for utility in utilities]
+        calls = iter(range(repeat))
+        stats = latency_ms(
+            lambda: db.get_samples(conn, reports[next(calls) % len(reports)]), repeat
+        )
+        for name, value in stats.items():
+            results[f"get_samples_{range_name}_{name}_ms"] = value
+    conn.close()
+    return results
+
+
+async def drive(paths: List[str], concurrency: int) -> float:
+    queue: asyncio.Queue = asyncio.Queue()
+    for path in paths:
+        queue.put_nowait(path)
+
+    async def worker(client: httpx.AsyncClient):
+        while not queue.empty():
+            resp = await client.get(queue.get_nowait())
+            assert resp.status_code == 200, resp.text
+
+    async with httpx.AsyncClient(app=async_app(), base_url="http://bench") as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        return time.perf_counter() - start
+
+
+def endpoint_throughput(
+    db_file: str, utilities: List[str], n_requests: int, concurrency: int
+) -> Dict[str, float]:
+    from api import data_api
+
+    pool.close_pool()
+    pool.init_pool(db_file, size=data_api.DB_POOL_SIZE)
+    data_api.response_cache.clear()
+    # distinct (utility, start) pairs, so requests miss the response cache
+    paths = [
+        f"{data_api.API_ROOT}/samples?utility={utilities[i % len(utilities)]}"
+        + f"&start={date.today() - timedelta(days=30 + i // len(utilities))}"
+        for i in range(n_requests)
+    ]
+    elapsed = asyncio.run(drive(paths, concurrency))
+    pool.close_pool()
+    return {"samples_req_per_s": n_requests / elapsed}
+
+
+def portal_records(n_rows: int, n_utilities: int) -> Iterator[dict]:
+    # transformed portal features: epoch ms dates, as fetch_portal_json_data feeds update_db
+    date_col = CdpheObservation.DATE.value
+    for row in rows(n_rows, n_utilities):
+        record = dict(zip(COLS, row))
+        record[date_col] = int(datetime.fromisoformat(record[date_col]).timestamp() * 1000)
+        yield record
+
+
+def load_child(db_file: str, n_rows: int, n_utilities: int, results: multiprocessing.Queue):
+    from tools import update_data
+
+    start = time.perf_counter()
+    update_data.update_db(portal_records(n_rows, n_utilities), database=db_file)
+    elapsed = time.perf_counter() - start
+    # kilobytes on linux
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put({"update_db_s": elapsed, "update_db_peak_mb": peak_kb / 1024})
+
+
+def load_stats(db_file: str, n_rows: int, n_utilities: int) -> Dict[str, float]:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    child = context.Process(target=load_child, args=(db_file, n_rows, n_utilities, results))
+    child.start()
+    stats = results.get()
+    child.join()
+    stats["update_db_rows_per_s"] = n_rows / stats["update_db_s"]
+    return stats
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=project_root,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_results(size: str, machine: str) -> Optional[dict]:
+    # timings only compare on the same hardware
+    if not RESULTS_FILE.exists():
+        return None
+    previous = None
+    with RESULTS_FILE.open() as f:
+        for line in f:
+            record = json.loads(line)
+            if record["size"] == size and record["machine"] == machine:
+                previous = record
+    return previous
+
+
+def regressions(current: dict, previous: dict, threshold: float) -> List[str]:
+    found = []
+    for name, value in current["metrics"].items():
+        before = previous["metrics"].get(name)
+        if not before:
+            continue
+        change = (before / value - 1) if name in HIGHER_IS_BETTER else (value / before - 1)
+        if change > threshold:
+            found.append(f"{name}: {before:.3f} -> {value:.3f} ({change:+.0%})")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"any of {','.join(SIZES)}")
+    parser.add_argument("--repeat", type=int, default=200, help="calls per latency measurement")
+    parser.add_argument("--requests", type=int, default=2_000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--no-save", action="store_true", help="don't append to the results")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    regressed = False
+    for size in args.sizes.split(","):
+        n_rows, n_utilities = SIZES[size]
+        print(f"== {size}: {n_rows} rows, {n_utilities} utilities")
+        metrics = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = build_db(str(Path(tmp) / "bench.db"), n_rows, n_utilities)
+            # a spread of utilities across the index
+            utilities = utility_names(n_utilities)[:: max(n_utilities // 50, 1)]
+            metrics.update(query_latencies(db_file, utilities, args.repeat))
+            metrics.update(endpoint_throughput(db_file, utilities, args.requests, args.concurrency))
+            metrics.update(load_stats(str(Path(tmp) / "load.db"), n_rows, n_utilities))
+        for name, value in metrics.items():
+            print(f"{name:>28}: {value:10.3f}")
+
+        record = {
+            "size": size,
+            "rows": n_rows,
+            "utilities": n_utilities,
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.node(),
+            "metrics": {name: round(value, 4) for name, value in metrics.items()},
+        }
+        if previous := previous_results(size, record["machine"]):
+            found = regressions(record, previous, args.threshold)
+            print(f"compared to {previous['commit']} ({previous['timestamp']}):")
+            for line in found or ["no regressions"]:
+                print(f"  {line}")
+            regressed = regressed or bool(found)
+        if not args.no_save:
+            RESULTS_FILE.parent.mkdir(exist_ok=True)
+            with RESULTS_FILE.open("a") as f:
+                f.write(json.dumps(record) + "\n")
+    if regressed and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
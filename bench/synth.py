@@ -0,0 +1,68 @@
+"""Synthetic wastewater data for benchmarks, shaped like the `latest` table built by update_db"""
+
+from datetime import date, timedelta
+import random
+import sqlite3
+from pathlib import Path
+import sys
+from typing import Iterator, Tuple
+
+# enable the script to have access to other modules
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+from models.observation import CdpheObservation
+from services.db import (
+    PROD_TABLE,
+    build_summary_table,
+    build_utilities_table,
+    create_indexes,
+    double_quote,
+    publish_generation,
+)
+
+COLS = [
+    CdpheObservation.DATE.value,
+    CdpheObservation.UTILITY.value,
+    CdpheObservation.COPIES_LP1.value,
+    CdpheObservation.COPIES_LP2.value,
+    CdpheObservation.CASES.value,
+    CdpheObservation.PHASE.value,
+]
+DEFAULT_UTILITY = "Metro WW - Platte/Central"
+
+
+def utility_names(n_utilities: int) -> list:
+    return [DEFAULT_UTILITY] + [f"Utility {i:04d}" for i in range(1, n_utilities)]
+
+
+def rows(n_rows: int, n_utilities: int, seed: int = 0) -> Iterator[Tuple]:
+    """Yield roughly `n_rows` observations spread evenly over `n_utilities`, ending today"""
+    rng = random.Random(seed)
+    days = max(n_rows // n_utilities, 1)
+    first = date.today() - timedelta(days=days - 1)
+    for utility in utility_names(n_utilities):
+        for d in range(days):
+            # about a third of the days have no LP2 measurement, like the real data
+            lp2 = rng.lognormvariate(11, 1.5) if rng.random() > 0.3 else None
+            lp1 = rng.lognormvariate(11, 1.5) if rng.random() > 0.8 else None
+            cases = rng.randint(0, 200)
+            yield ((first + timedelta(days=d)).isoformat(), utility, lp1, lp2, cases, "Phase 2")
+
+
+def build_db(path: str, n_rows: int = 50_000, n_utilities: int = 60) -> str:
+    Path(path).unlink(missing_ok=True)
+    con = sqlite3.connect(path)
+    table_and_cols = f"{PROD_TABLE}({','.join(double_quote(col) for col in COLS)})"
+    con.execute(f"CREATE TABLE {table_and_cols}")
+    placeholders = ",".join("?" for _ in COLS)
+    with con:
+        con.executemany(
+            f"INSERT INTO {table_and_cols} VALUES ({placeholders})", rows(n_rows, n_utilities)
+        )
+    create_indexes(con)
+    build_utilities_table(con)
+    build_summary_table(con)
+    publish_generation(con)
+    con.close()
+    return path
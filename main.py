@@ -3,19 +3,29 @@ import logging
 from pathlib import Path
 
 import fastapi
-from starlette.staticfiles import StaticFiles
-import uvicorn
 
-from views import home
-from api import data_api
+_app = None
 
 
-app = fastapi.FastAPI()
+def create_app(env: str = "prod") -> fastapi.FastAPI:
+    """Build the app. Routers (and what they import) load here rather than at import time,
+    and under gunicorn's preload_app this runs once in the master instead of in every worker."""
+    logger = configure_logging(env=env)
+    logger.info("> Creating application")
+    app = fastapi.FastAPI()
+    configure_routing(app)
+    return app
 
 
-def configure_routing():
+def configure_routing(app: fastapi.FastAPI):
+    from starlette.staticfiles import StaticFiles
+
+    from api import data_api, metrics_api
+    from views import home
+
     app.include_router(home.router)
     app.include_router(data_api.router)
+    app.include_router(metrics_api.router)
     app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
@@ -40,12 +50,19 @@ def configure_logging(env="prod") -> logging.Logger:
     return logger
 
 
+def __getattr__(name: str):
+    # `main:app` (and `from main import app`) still work, building the app on first access
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app(env="dev")
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == "__main__":
-    logger = configure_logging(env="dev")
-    logger.info("> Starting application from CLI")
-    configure_routing()
+    import uvicorn
+
+    app = create_app(env="dev")
+    logging.getLogger(__name__).info("> Starting application from CLI")
     uvicorn.run(app, port=8888, host="127.0.0.1")
-else:
-    logger = configure_logging(env="dev")
-    logger.info("> Starting application from systemd and gunicorn")
-    configure_routing()
@@ -1,10 +1,52 @@
 from datetime import date, timedelta
-from typing import Optional
-from pydantic import BaseModel
+from typing import List, Literal, Optional
+from pydantic import BaseModel, conint, validator
+
+# stands in for every utility in a BatchReport
+ALL_UTILITIES = "all"
+# unset dates cover this many days up to today
+DEFAULT_DAYS = 30
+
+
+def default_start(start: Optional[date]) -> date:
+    return date.today() - timedelta(days=DEFAULT_DAYS) if start is None else start
+
+
+def default_end(end: Optional[date]) -> date:
+    return date.today() if end is None else end
 
 
 class Report(BaseModel):
     # user-submitted request
     utility: str = "Metro WW - Platte/Central"
-    start: Optional[date] = date.today() - timedelta(days=30)
-    end: Optional[date] = date.today()
+    # resolved per request rather than at import, which a preloaded gunicorn master only does
+    # once. FastAPI passes unset query params as None, so a default_factory wouldn't run
+    start: Optional[date] = None
+    end: Optional[date] = None
+
+    _default_start = validator("start", always=True, allow_reuse=True)(default_start)
+    _default_end = validator("end", always=True, allow_reuse=True)(default_end)
+
+
+class AggregateReport(Report):
+    # user-submitted request for bucketed and/or downsampled samples
+    bucket: Optional[Literal["week", "month"]] = None
+    stat: Literal["mean", "median", "max"] = "mean"
+    # trailing window, in (bucketed) rows
+    rolling: Optional[conint(ge=1, le=365)] = None
+    # target row count for LTTB downsampling
+    points: Optional[conint(ge=3, le=10_000)] = None
+
+
+class BatchReport(BaseModel):
+    # user-submitted request for several utilities over one date range
+    utilities: List[str] = [ALL_UTILITIES]
+    start: Optional[date] = None
+    end: Optional[date] = None
+
+    _default_start = validator("start", always=True, allow_reuse=True)(default_start)
+    _default_end = validator("end", always=True, allow_reuse=True)(default_end)
+
+    @property
+    def all_utilities(self) -> bool:
+        return ALL_UTILITIES in self.utilities
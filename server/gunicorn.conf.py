@@ -0,0 +1,41 @@
+"""gunicorn settings for the API, used by server/units/wastewater.service:
+
+    gunicorn -c /apps/app_repo/server/gunicorn.conf.py --chdir /apps/app_repo/
+
+The app is loaded once in the master (preload_app) and its read-only state (the in-memory
+snapshot in snapshot serving mode, cached utilities responses) is inherited by the workers, so a
+restarted worker is serving as soon as it has forked and opened its connection pool.
+"""
+
+import gc
+import os
+
+wsgi_app = "main:app"
+bind = "127.0.0.1:8888"
+workers = 4
+worker_class = "uvicorn.workers.UvicornWorker"
+proc_name = "wastewater_svc"
+
+# code changes need a restart, not a reload: HUP re-forks workers from the preloaded master
+preload_app = True
+
+
+def when_ready(server):
+    # the master has loaded the app and is about to fork workers
+    from api import data_api
+
+    try:
+        data_api.preload()
+    except Exception as e:
+        # e.g. no db yet on a fresh server: workers load everything on demand instead
+        server.log.warning(f"Skipping preload: {e!r}")
+    # the preloaded objects live as long as the master; keeping the gc from walking them means
+    # workers don't write to (and so copy) the pages they sit on
+    gc.freeze()
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -76,6 +76,7 @@ apt install python3-certbot-nginx
 certbot --nginx -d wastewater.jrmontag.xyz
 
 # Set data generation process in root crontab
+# (not needed if WASTEWATER_REFRESH_INTERVAL is set in wastewater.service, see runbook.md)
 crontab -e
 # m h  dom mon dow   command
-15 0 * * * cd /apps/app_repo && . ../venv/bin/activate && python tools/update_data.py >>data/cron.log 2>&1
+15 0 * * * cd /apps/app_repo && . ../venv/bin/activate && PROMETHEUS_MULTIPROC_DIR=data/prometheus python tools/update_data.py >>data/cron.log 2>&1
@@ -0,0 +1,113 @@
+"""Server-side bucketing and downsampling of sample rows, (date, *SAMPLES_COLS) as returned by
+db.get_samples, for long time ranges"""
+
+from datetime import date, timedelta
+from itertools import groupby
+import statistics
+from typing import Callable, Dict, List, Optional, Sequence
+
+from models.report import AggregateReport
+
+Row = tuple
+
+STATS: Dict[str, Callable[[Sequence[float]], float]] = {
+    "mean": statistics.fmean,
+    "median": statistics.median,
+    "max": max,
+}
+
+
+def bucket_start(day: str, bucket: str) -> str:
+    """Return the first day (ISO) of the week (starting Monday) or month that `day` falls in"""
+    d = date.fromisoformat(day)
+    if bucket == "week":
+        d -= timedelta(days=d.weekday())
+    elif bucket == "month":
+        d = d.replace(day=1)
+    return d.isoformat()
+
+
+def drop_nulls(rows: List[Row]) -> List[Row]:
+    """Drop rows that have no measurements at all"""
+    return [row for row in rows if any(value is not None for value in row[1:])]
+
+
+def _reduce(values: List[Optional[float]], stat: Callable) -> Optional[float]:
+    present = [value for value in values if value is not None]
+    return stat(present) if present else None
+
+
+def bucketed(rows: List[Row], bucket: str, stat: str = "mean") -> List[Row]:
+    """Aggregate date-ordered rows into one row per bucket, labelled by the bucket's first day"""
+    fn = STATS[stat]
+    result = []
+    for start, group in groupby(rows, key=lambda row: bucket_start(row[0], bucket)):
+        columns = list(zip(*(row[1:] for row in group)))
+        result.append((start, *(_reduce(list(column), fn) for column in columns)))
+    return result
+
+
+def rolling(rows: List[Row], window: int) -> List[Row]:
+    """Replace each value with the mean of the non-null values in the trailing `window` rows"""
+    result = []
+    for i, row in enumerate(rows):
+        columns = zip(*(r[1:] for r in rows[max(0, i - window + 1) : i + 1]))
+        result.append((row[0], *(_reduce(list(column), statistics.fmean) for column in columns)))
+    return result
+
+
+def first_value(row: Row) -> Optional[float]:
+    """The row's first measurement that isn't null: coalesce(LP2, LP1) for sample rows"""
+    return next((value for value in row[1:] if value is not None), None)
+
+
+def lttb(rows: List[Row], threshold: int) -> List[Row]:
+    """Downsample to `threshold` rows with Largest-Triangle-Three-Buckets.
+
+    Keeps the first and last rows and, from each of `threshold - 2` equal buckets in between,
+    the row forming the largest triangle with the previously kept row and the next bucket's
+    average. x is the row's date ordinal, y its first_value; rows without any value are never
+    picked. Returns `rows` as they are if there is nothing to downsample.
+    """
+    if threshold >= len(rows) or threshold < 3:
+        return rows
+    points = [row for row in rows if first_value(row) is not None]
+    if threshold >= len(points):
+        return points
+
+    def xy(row: Row) -> tuple:
+        return date.fromisoformat(row[0]).toordinal(), first_value(row)
+
+    sampled = [points[0]]
+    every = (len(points) - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = int(i * every) + 1, int((i + 1) * every) + 1
+        # average of the next bucket (just the last point, for the final bucket)
+        next_bucket = [xy(row) for row in points[hi : min(int((i + 2) * every) + 1, len(points))]]
+        next_bucket = next_bucket or [xy(points[-1])]
+        avg_x = sum(x for x, _ in next_bucket) / len(next_bucket)
+        avg_y = sum(y for _, y in next_bucket) / len(next_bucket)
+        ax, ay = xy(points[a])
+        best, best_area = lo, -1.0
+        for j in range(lo, hi):
+            bx, by = xy(points[j])
+            area = abs((ax - avg_x) * (by - ay) - (ax - bx) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+
+def summarize(rows: List[Row], report: AggregateReport) -> List[Row]:
+    """Apply the report's bucketing, rolling average and downsampling, in that order"""
+    rows = drop_nulls(rows)
+    if report.bucket:
+        rows = bucketed(rows, report.bucket, report.stat)
+    if report.rolling:
+        rows = rolling(rows, report.rolling)
+    if report.points:
+        rows = lttb(rows, report.points)
+    return rows
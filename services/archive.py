@@ -0,0 +1,171 @@
+"""Content-addressed archive of raw portal downloads.
+
+Each download is split into chunks at record boundaries chosen by the records' content, so a
+record edited or added between two days' downloads only changes the chunk it falls in; every
+other chunk is shared with the previous day. Chunks are stored once, zlib-compressed, under
+their sha256; a manifest per download lists its chunks in order.
+
+    data/archive/chunks/ab/ab12...    compressed chunk
+    data/archive/manifests/2022-11-18_download.ndjson.json
+"""
+
+from datetime import date, timedelta
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import re
+from typing import Dict, Iterator, List, Optional
+import zlib
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = "data/archive"
+# records start at a newline (NDJSON/CSV) or a portal feature ({"attributes": ...}) in a page
+RECORD_START = re.compile(rb'\n|\{"attributes"')
+# a chunk ends before a record whose first bytes hash to 0 mod this: ~64 records per chunk
+CHUNK_RECORDS = 64
+# bytes of each record that decide the boundaries
+BOUNDARY_WINDOW = 64
+# no chunk grows past this, whatever the content
+MAX_CHUNK_BYTES = 1024 * 1024
+COMPRESS_LEVEL = 9
+# raw downloads are kept for this long, then only the first of each month
+RETENTION_DAYS = 90
+# file name convention: 2022-11-18_download.(ndjson|json|csv), see fetch_portal_json_data
+DOWNLOAD_NAME = re.compile(r"(\d{4}-\d{2}-\d{2})_[\w-]*download[\w-]*\.(ndjson|json|csv)")
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def chunks(data: bytes) -> Iterator[bytes]:
+    """Split `data` at content-defined record boundaries"""
+    start = 0
+    for match in RECORD_START.finditer(data):
+        position = match.start()
+        if position - start >= MAX_CHUNK_BYTES or (
+            position > start
+            and zlib.crc32(data[position : position + BOUNDARY_WINDOW]) % CHUNK_RECORDS == 0
+        ):
+            yield data[start:position]
+            start = position
+    if start < len(data):
+        yield data[start:]
+
+
+def chunk_path(archive_dir: str, digest: str) -> Path:
+    return Path(archive_dir) / "chunks" / digest[:2] / digest
+
+
+def manifest_path(archive_dir: str, name: str) -> Path:
+    return Path(archive_dir) / "manifests" / f"{name}.json"
+
+
+def write_atomic(path: Path, content: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_bytes(content)
+    os.replace(tmp, path)
+
+
+def store(path: str, archive_dir: str = ARCHIVE_DIR) -> dict:
+    """Archive the file at `path` under its name; returns its manifest plus what was written"""
+    data = Path(path).read_bytes()
+    digests, new_chunks, stored_bytes = [], 0, 0
+    for chunk in chunks(data):
+        digest = hashlib.sha256(chunk).hexdigest()
+        digests.append(digest)
+        target = chunk_path(archive_dir, digest)
+        if not target.exists():
+            compressed = zlib.compress(chunk, COMPRESS_LEVEL)
+            write_atomic(target, compressed)
+            new_chunks += 1
+            stored_bytes += len(compressed)
+    manifest = {
+        "name": Path(path).name,
+        "size": len(data),
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "chunks": digests,
+    }
+    write_atomic(manifest_path(archive_dir, manifest["name"]), json.dumps(manifest).encode())
+    logger.info(
+        f"Archived {manifest['name']} ({len(data)} bytes): {len(digests)} chunks, "
+        + f"{new_chunks} new ({stored_bytes} bytes stored)"
+    )
+    return {**manifest, "new_chunks": new_chunks, "stored_bytes": stored_bytes}
+
+
+def names(archive_dir: str = ARCHIVE_DIR) -> List[str]:
+    manifests = Path(archive_dir) / "manifests"
+    return sorted(p.name[: -len(".json")] for p in manifests.glob("*.json"))
+
+
+def read_manifest(name: str, archive_dir: str = ARCHIVE_DIR) -> dict:
+    try:
+        return json.loads(manifest_path(archive_dir, name).read_text())
+    except FileNotFoundError:
+        raise ArchiveError(f"{name} is not in the archive")
+
+
+def restore(name: str, archive_dir: str = ARCHIVE_DIR) -> bytes:
+    """Return the original bytes of an archived download, checked against its sha256"""
+    manifest = read_manifest(name, archive_dir)
+    data = b"".join(
+        zlib.decompress(chunk_path(archive_dir, digest).read_bytes())
+        for digest in manifest["chunks"]
+    )
+    if hashlib.sha256(data).hexdigest() != manifest["sha256"]:
+        raise ArchiveError(f"{name} does not match its checksum")
+    return data
+
+
+def store_downloads(data_dir: str = "data", archive_dir: str = ARCHIVE_DIR) -> List[dict]:
+    """Move the raw downloads left in `data_dir` into the archive"""
+    stored = []
+    for path in sorted(Path(data_dir).iterdir()):
+        if DOWNLOAD_NAME.fullmatch(path.name):
+            stored.append(store(str(path), archive_dir))
+            path.unlink()
+    return stored
+
+
+def download_date(name: str) -> Optional[date]:
+    match = DOWNLOAD_NAME.fullmatch(name)
+    return date.fromisoformat(match.group(1)) if match else None
+
+
+def prune(
+    archive_dir: str = ARCHIVE_DIR,
+    retention_days: int = RETENTION_DAYS,
+    today: Optional[date] = None,
+) -> Dict[str, int]:
+    """Apply the retention policy: keep every download from the last `retention_days`, and the
+    first one of each month before that. Chunks no remaining download uses are deleted."""
+    cutoff = (today or date.today()) - timedelta(days=retention_days)
+    kept_months = set()
+    removed = 0
+    for name in names(archive_dir):
+        day = download_date(name)
+        if day is None or day >= cutoff:
+            continue
+        if (day.year, day.month) not in kept_months:
+            # names sort by date, so this is the month's first download
+            kept_months.add((day.year, day.month))
+            continue
+        manifest_path(archive_dir, name).unlink()
+        removed += 1
+    used = {
+        digest
+        for name in names(archive_dir)
+        for digest in read_manifest(name, archive_dir)["chunks"]
+    }
+    deleted = 0
+    for path in (Path(archive_dir) / "chunks").glob("*/*"):
+        if path.name not in used:
+            path.unlink()
+            deleted += 1
+    logger.info(f"Pruned {removed} downloads and {deleted} unused chunks from {archive_dir}")
+    return {"downloads": removed, "chunks": deleted}
@@ -0,0 +1,78 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from email.utils import formatdate
+from hashlib import blake2b
+import logging
+import threading
+from typing import Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 512
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    body: bytes
+    generation: int
+    etag: str
+    media_type: str = "application/json"
+    content_encoding: Optional[str] = None
+
+    @property
+    def last_modified(self) -> Optional[str]:
+        # generations are load times in epoch seconds; 0 means the loader never stamped the db
+        if self.generation <= 0:
+            return None
+        return formatdate(self.generation, usegmt=True)
+
+
+class ResponseCache:
+    """LRU cache of serialized responses, keyed on request parameters and tagged with the
+    dataset generation they were built from. Entries from an older generation are misses.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, generation: int) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.generation != generation:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(
+        self,
+        key: Hashable,
+        generation: int,
+        body: bytes,
+        media_type: str = "application/json",
+        content_encoding: Optional[str] = None,
+    ) -> CachedResponse:
+        # strong validator: identical bytes <=> identical etag, so each format and content
+        # encoding of a response gets its own
+        etag = f'"{blake2b(body, digest_size=16).hexdigest()}"'
+        entry = CachedResponse(body, generation, etag, media_type, content_encoding)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self, generation: Optional[int] = None) -> None:
+        # also usable as a ConnectionPool listener
+        with self._lock:
+            self._entries.clear()
+        logger.debug(f"Cleared response cache (new generation: {generation})")
@@ -1,28 +1,121 @@
-from itertools import chain
+from itertools import chain, groupby
 import logging
+import os
+import secrets
 import sqlite3
-from typing import List, Tuple
+import time
+from typing import Iterable, List, Optional, Tuple
 from fastapi import Depends
 
-from models.observation import CdpheObservation
-from models.report import Report
+from models.report import BatchReport, Report
+from services import queries
+from services.metrics import DB_QUERY, SLOW_QUERIES
+from services.queries import (
+    DATE_COL,
+    PROD_TABLE,
+    SAMPLES_COLS,
+    SAMPLES_INDEX,
+    SUMMARY_TABLE,
+    UTILITIES_TABLE,
+    UTILITY_COL,
+    SamplesQuery,
+    double_quote,
+)
+from services.trends import SUMMARY_COLS, summarize
 
 logger = logging.getLogger(__name__)
 
-# DB conventions
-PROD_TABLE = "latest"
-DATE_COL = CdpheObservation.DATE.value
-SAMPLES_COLS = [CdpheObservation.COPIES_LP2.value, CdpheObservation.COPIES_LP1.value]
-UTILITY_COL = CdpheObservation.UTILITY.value
+# the db the loader writes and (unless it's a replica, see services/replica.py) the API reads
+DB_PATH = os.environ.get("WASTEWATER_DB", "data/wastewater.db")
 
+# log queries slower than this, with their query plan; 0 turns the slow-query log off
+SLOW_QUERY_MS = float(os.environ.get("WASTEWATER_SLOW_QUERY_MS", 0))
 
-def double_quote(name: str) -> str:
-    # manually double-quote col names
-    return f'"{name}"'
+
+# read-side connection tuning; the db is only written by tools/update_data.py
+READ_PRAGMAS = {
+    "mmap_size": 256 * 1024 * 1024,
+    # negative values are KiB
+    "cache_size": -16 * 1024,
+    "temp_store": "MEMORY",
+}
+
+
+# prepared statements kept per connection, by SQL text. the fixed statements in services.queries
+# need a handful; the rest is room for batch reads, whose text varies with the number of utilities
+CACHED_STATEMENTS = 256
+
+
+def db_path(db_uri: str) -> str:
+    """Filesystem path of a db given as a path or a `file:` URI"""
+    return db_uri.removeprefix("file:").split("?")[0]
+
+
+def open_connection(db_uri: str) -> sqlite3.Connection:
+    # `file:` URIs are replica snapshots, opened with immutable=1 (see services/replica.py)
+    is_uri = db_uri.startswith("file:")
+    conn = sqlite3.connect(
+        db_uri, check_same_thread=False, cached_statements=CACHED_STATEMENTS, uri=is_uri
+    )
+    # WAL lets readers keep going while the loader writes; the setting persists in the db file.
+    # nothing writes a replica snapshot, so it doesn't need it
+    try:
+        # switching modes needs a write lock, so don't ask unless it's actually needed
+        if not is_uri and conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+            conn.execute("PRAGMA journal_mode = WAL")
+    except sqlite3.OperationalError as e:
+        logger.warning(f"Could not enable WAL mode on {db_uri}: {e}")
+    for pragma, value in READ_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+def get_generation(conn: sqlite3.Connection) -> int:
+    # dataset generation, bumped by the loader each time it publishes new data
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def next_generation(conn: sqlite3.Connection) -> int:
+    # load time in epoch seconds, always moving forward
+    return max(int(time.time()), get_generation(conn) + 1)
+
+
+def publish_generation(conn: sqlite3.Connection, generation: Optional[int] = None) -> int:
+    # loader-side: stamp the db with a new generation so that serving workers can tell their
+    # cached data is stale
+    generation = generation or next_generation(conn)
+    conn.execute(f"PRAGMA user_version = {generation}")
+    return generation
+
+
+def log_slow_query(
+    conn: sqlite3.Connection, name: str, query: str, params: Iterable, seconds: float
+) -> None:
+    SLOW_QUERIES.labels(query=name).inc()
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+    details = "; ".join(row[-1] for row in plan)
+    logger.warning(f"Slow query {name} ({seconds * 1000:.1f}ms): {query} {params=} plan: {details}")
+
+
+def fetch_all(conn: sqlite3.Connection, name: str, query: str, params: Iterable = ()) -> list:
+    """Run a query and fetch its rows, timing both stages under `name`"""
+    logger.debug(f"Issuing db query: {query}")
+    start = time.perf_counter()
+    # sqlite steps to the first row on execute; fetchall steps through the rest
+    cursor = conn.execute(query, params)
+    executed = time.perf_counter()
+    rows = cursor.fetchall()
+    fetched = time.perf_counter()
+    DB_QUERY.labels(query=name, stage="execute").observe(executed - start)
+    DB_QUERY.labels(query=name, stage="fetch").observe(fetched - executed)
+    if SLOW_QUERY_MS and (fetched - start) * 1000 >= SLOW_QUERY_MS:
+        log_slow_query(conn, name, query, params, fetched - start)
+    return rows
 
 
 def get_connection(db_uri: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_uri, check_same_thread=False)
+    conn = open_connection(db_uri)
     # metadata table that includes tables and indexs in the db
     entities = conn.execute("SELECT * FROM sqlite_master").fetchall()
     if len(entities) == 0:
@@ -30,38 +123,117 @@ def get_connection(db_uri: str) -> sqlite3.Connection:
     return conn
 
 
+def create_indexes(conn: sqlite3.Connection, table: str = PROD_TABLE) -> None:
+    # loader-side: covering index for get_samples, so range queries never touch the table itself.
+    # index names are unique per db, so each build gets its own suffix; that lets a staging table
+    # be indexed while the live table still has its index
+    existing = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND name LIKE ?",
+        (table, f"{SAMPLES_INDEX}%"),
+    ).fetchall()
+    if existing:
+        return
+    name = f"{SAMPLES_INDEX}_{secrets.token_hex(4)}"
+    cols = ", ".join([UTILITY_COL, DATE_COL] + [double_quote(col) for col in SAMPLES_COLS])
+    conn.execute(f"CREATE INDEX {name} ON {double_quote(table)}({cols})")
+
+
+def drop_indexes(conn: sqlite3.Connection, table: str = PROD_TABLE) -> None:
+    # backup tables don't need them; automatic (constraint) indexes have no sql and can't be dropped
+    names = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (table,),
+    ).fetchall()
+    for (name,) in names:
+        conn.execute(f"DROP INDEX {double_quote(name)}")
+
+
+def build_utilities_table(
+    conn: sqlite3.Connection, table: str = PROD_TABLE, target: str = UTILITIES_TABLE
+) -> None:
+    # loader-side: precomputed lookup for get_utilities, replaced in one transaction
+    conn.executescript(
+        "BEGIN;"
+        + f"DROP TABLE IF EXISTS {target};"
+        + f"CREATE TABLE {target}({UTILITY_COL} TEXT PRIMARY KEY) WITHOUT ROWID;"
+        + f"INSERT INTO {target} "
+        + f"SELECT DISTINCT {UTILITY_COL} FROM {double_quote(table)} "
+        + f"WHERE {UTILITY_COL} IS NOT NULL;"
+        + "COMMIT;"
+    )
+
+
+def update_summary(
+    conn: sqlite3.Connection,
+    utilities: Optional[Iterable[str]] = None,
+    table: str = PROD_TABLE,
+    target: str = SUMMARY_TABLE,
+) -> int:
+    # loader-side: (re)compute summary rows for `utilities` (default: all of them) within the
+    # caller's transaction. one ordered pass over the covering index; LP2 readings, falling back
+    # to LP1 for dates before lab phase 2
+    lp2, lp1 = [double_quote(col) for col in SAMPLES_COLS]
+    query = f"SELECT {UTILITY_COL}, {DATE_COL}, coalesce({lp2}, {lp1}) FROM {double_quote(table)}"
+    params: list = []
+    if utilities is not None:
+        params = list(utilities)
+        placeholders = ",".join("?" for _ in params)
+        query += f" WHERE {UTILITY_COL} IN ({placeholders})"
+        conn.execute(f"DELETE FROM {target} WHERE {UTILITY_COL} IN ({placeholders})", params)
+    query += f" ORDER BY {UTILITY_COL} ASC, {DATE_COL} ASC"
+    rows = groupby(conn.execute(query, params), key=lambda row: row[0])
+    summary = [
+        (utility, *summarize((day, value) for _, day, value in readings))
+        for utility, readings in rows
+        if utility is not None
+    ]
+    placeholders = ",".join("?" for _ in range(len(SUMMARY_COLS) + 1))
+    conn.executemany(f"INSERT INTO {target} VALUES ({placeholders})", summary)
+    return len(summary)
+
+
+def build_summary_table(
+    conn: sqlite3.Connection, table: str = PROD_TABLE, target: str = SUMMARY_TABLE
+) -> None:
+    # loader-side: precomputed per-utility trends for get_summary
+    cols = ", ".join(SUMMARY_COLS)
+    conn.execute(f"DROP TABLE IF EXISTS {target}")
+    conn.execute(f"CREATE TABLE {target}({UTILITY_COL} TEXT PRIMARY KEY, {cols}) WITHOUT ROWID")
+    update_summary(conn, table=table, target=target)
+    conn.commit()
+
+
+def get_summary(conn: sqlite3.Connection) -> List[dict]:
+    # CRUD fn for the statewide summary: one row per utility
+    names = [UTILITY_COL, *SUMMARY_COLS]
+    return [dict(zip(names, row)) for row in fetch_all(conn, "summary", queries.SUMMARY)]
+
+
 def get_utilities(conn: sqlite3.Connection) -> List[str]:
     # CRUD fn for utilities
-    query = (
-        f"SELECT DISTINCT {UTILITY_COL} " + f"FROM {PROD_TABLE} " + f"ORDER BY {UTILITY_COL} ASC"
-    )
-    logger.debug(f"Issuing db query: {query}")
-    list_of_utility_lists: List[Tuple[str]] = conn.execute(query).fetchall()
+    list_of_utility_lists: List[Tuple[str]] = fetch_all(conn, "utilities", queries.UTILITIES)
     # flatten lists
     result = list(chain.from_iterable(list_of_utility_lists))
     return result
 
 
+def samples_query(report: Report) -> Tuple[str, tuple]:
+    return SamplesQuery((report.utility,), report.start, report.end).build()
+
+
 def get_samples(conn: sqlite3.Connection, report: Report = Depends()) -> List[str]:
     # CRUD fn for samples
-    # notes on sqlite quoting and keywords: https://www.sqlite.org/lang_keywords.html
-    cols = f"{DATE_COL}, {','.join([double_quote(col) for col in SAMPLES_COLS])}"
-    condition = (
-        f"{UTILITY_COL} = '{report.utility}' "
-        + f"AND {DATE_COL} >= '{report.start}' "
-        + f"AND {DATE_COL} <= '{report.end}'"
-    )
-    query = (
-        f"SELECT {cols} "
-        + f"FROM {PROD_TABLE} "
-        + f"WHERE {condition} "
-        + f"ORDER BY {DATE_COL} ASC"
-    )
-    logger.debug(f"Issuing db query: {query}")
-    result = conn.execute(query).fetchall()
+    query, params = samples_query(report)
+    result = fetch_all(conn, "samples", query, params)
     return result
 
 
+def batch_samples_query(report: BatchReport) -> Tuple[str, tuple]:
+    # one range query over the covering index for every requested utility, grouped by utility
+    utilities = None if report.all_utilities else tuple(report.utilities)
+    return SamplesQuery(utilities, report.start, report.end, with_utility=True).build()
+
+
 def get_cases(db: sqlite3.Connection, report: Report = Depends()):
     # CRUD: cases
     pass
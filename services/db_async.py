@@ -0,0 +1,131 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import functools
+import logging
+import os
+import sqlite3
+import time
+from typing import AsyncIterator, Callable, List, Optional, TypeVar, Union
+from weakref import WeakKeyDictionary
+
+import anyio
+
+from models.report import BatchReport, Report
+from services import db, snapshot
+from services.metrics import DB_ACQUIRE, DB_QUERY, timed
+from services.pool import DEFAULT_POOL_SIZE, ConnectionPool
+from services.snapshot import Snapshot
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+# endpoints read from either a pooled connection or this worker's in-memory snapshot
+DataSource = Union[sqlite3.Connection, Snapshot]
+
+# rows per fetch when streaming large results
+FETCH_SIZE = 1_000
+
+# threads dedicated to blocking sqlite calls, separate from starlette's shared threadpool
+DB_WORKERS = int(os.environ.get("WASTEWATER_DB_WORKERS", DEFAULT_POOL_SIZE))
+
+_executor: Optional[ThreadPoolExecutor] = None
+# one slot per pooled connection, so waiting for a connection never ties up a thread
+_slots: "WeakKeyDictionary[ConnectionPool, anyio.Semaphore]" = WeakKeyDictionary()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        logger.info(f"Starting db executor ({DB_WORKERS=})")
+        _executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+    return _executor
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+async def run(fn: Callable[..., T], *args) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(fn, *args))
+
+
+@asynccontextmanager
+async def connection(conn_pool: ConnectionPool) -> AsyncIterator[sqlite3.Connection]:
+    slots = _slots.setdefault(conn_pool, anyio.Semaphore(conn_pool.size))
+    start = time.perf_counter()
+    async with slots:
+        # holding a slot guarantees an idle (or openable) connection, so this doesn't block
+        conn = conn_pool.acquire()
+        DB_ACQUIRE.observe(time.perf_counter() - start)
+        try:
+            yield conn
+        finally:
+            conn_pool.release(conn)
+
+
+async def get_snapshot(conn_pool: ConnectionPool) -> Snapshot:
+    if snapshot.is_fresh(conn_pool):
+        return snapshot.get_snapshot(conn_pool)
+    # (re)loading reads the whole table, keep it off the event loop
+    return await run(snapshot.get_snapshot, conn_pool)
+
+
+def get_generation(source: DataSource) -> int:
+    if isinstance(source, Snapshot):
+        return source.generation
+    # header read, cheap enough to do on the event loop
+    return db.get_generation(source)
+
+
+async def get_utilities(source: DataSource) -> List[str]:
+    if isinstance(source, Snapshot):
+        return source.get_utilities()
+    return await run(db.get_utilities, source)
+
+
+async def get_summary(conn: sqlite3.Connection) -> List[dict]:
+    # small precomputed table, always read from sqlite (snapshots only hold `latest`)
+    return await run(db.get_summary, conn)
+
+
+async def get_samples(source: DataSource, report: Report) -> List[str]:
+    if isinstance(source, Snapshot):
+        # a couple of binary searches, cheap enough to answer on the event loop
+        return source.get_samples(report)
+    return await run(db.get_samples, source, report)
+
+
+async def iter_batch_samples(
+    source: DataSource, report: BatchReport, fetch_size: int = FETCH_SIZE
+) -> AsyncIterator[List[tuple]]:
+    """Yield chunks of (utility, date, *SAMPLES_COLS) rows, ordered by utility and date"""
+    if isinstance(source, Snapshot):
+        for rows in source.iter_batch_samples(report):
+            yield rows
+        return
+    query, params = db.batch_samples_query(report)
+    async for rows in iter_rows(source, "batch", query, params, fetch_size):
+        yield rows
+
+
+async def iter_rows(
+    conn: sqlite3.Connection, name: str, query: str, params: list, fetch_size: int = FETCH_SIZE
+) -> AsyncIterator[List[tuple]]:
+    """Yield the query's results `fetch_size` rows at a time from one cursor"""
+    logger.debug(f"Issuing db query: {query}")
+    with timed(DB_QUERY, query=name, stage="execute"):
+        cursor = await run(conn.execute, query, params)
+    try:
+        while True:
+            with timed(DB_QUERY, query=name, stage="fetch"):
+                rows = await run(cursor.fetchmany, fetch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
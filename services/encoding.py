@@ -0,0 +1,190 @@
+"""Response body formats and compression for the data API, picked by content negotiation.
+
+orjson, pyarrow (Arrow IPC and Parquet) and brotli are optional: without them responses fall
+back to the stdlib json encoder, JSON formats only and gzip, respectively.
+"""
+
+from dataclasses import dataclass
+from functools import lru_cache
+import gzip
+import importlib
+import importlib.util
+import io
+import json
+from typing import Dict, List, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# pyarrow takes a while to import, and only the Arrow and Parquet formats need it
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON = "application/json"
+# {"parameters": ..., "samples": {column: [values...], ...}}
+COLUMNAR_JSON = "application/vnd.wastewater.columnar+json"
+ARROW = "application/vnd.apache.arrow.stream"
+PARQUET = "application/vnd.apache.parquet"
+
+# `format` query parameter values
+FORMATS = {"json": JSON, "columnar": COLUMNAR_JSON, "arrow": ARROW, "parquet": PARQUET}
+
+# smaller bodies aren't worth the cpu (or the extra bytes gzip adds to tiny ones)
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+class NotAcceptable(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Representation:
+    media_type: str = JSON
+    content_encoding: Optional[str] = None
+
+
+def media_types(tabular: bool = True) -> List[str]:
+    """Media types available for an endpoint, in order of preference"""
+    if not tabular:
+        return [JSON]
+    available = [JSON, COLUMNAR_JSON]
+    if HAS_PYARROW:
+        available += [ARROW, PARQUET]
+    return available
+
+
+def content_encodings() -> List[str]:
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def parse_header(header: str) -> List[Tuple[str, float]]:
+    """Parse an Accept(-Encoding) header into (value, q) pairs, most preferred first"""
+    parsed = []
+    for i, item in enumerate(header.split(",")):
+        value, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, number = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        if value:
+            # stable: equally preferred values keep their header order
+            parsed.append((value.lower(), q, i))
+    return [(value, q) for value, q, _ in sorted(parsed, key=lambda p: (-p[1], p[2]))]
+
+
+def negotiate_media_type(accept: Optional[str], tabular: bool = True) -> str:
+    available = media_types(tabular)
+    if not accept:
+        return JSON
+    for value, q in parse_header(accept):
+        if q <= 0:
+            continue
+        if value in ("*/*", "application/*"):
+            return JSON
+        if value in available:
+            return value
+    raise NotAcceptable(f"Available media types: {', '.join(available)}")
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    if not accept_encoding:
+        return None
+    accepted = {value: q for value, q in parse_header(accept_encoding)}
+    for encoding in content_encodings():
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def negotiate(
+    accept: Optional[str],
+    accept_encoding: Optional[str],
+    fmt: Optional[str] = None,
+    tabular: bool = True,
+) -> Representation:
+    """Pick a body format (`fmt` overrides the Accept header) and a content encoding"""
+    if fmt is not None:
+        media_type = FORMATS[fmt]
+        if media_type not in media_types(tabular):
+            raise NotAcceptable(f"format={fmt} is not available")
+    else:
+        media_type = negotiate_media_type(accept, tabular)
+    if media_type == PARQUET:
+        # parquet pages are compressed already
+        return Representation(media_type)
+    return Representation(media_type, negotiate_encoding(accept_encoding))
+
+
+def dumps(content) -> bytes:
+    """Compact JSON, same output as JSONResponse (dates as ISO strings, NaN as null)"""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        jsonable_encoder(content), ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def columns_of(columns: List[str], rows: List[tuple]) -> Dict[str, list]:
+    if not rows:
+        return {name: [] for name in columns}
+    return {name: list(values) for name, values in zip(columns, zip(*rows))}
+
+
+@lru_cache(maxsize=None)
+def _pyarrow():
+    for module in ["pyarrow.ipc", "pyarrow.parquet"]:
+        importlib.import_module(module)
+    return importlib.import_module("pyarrow")
+
+
+def arrow_table(content: dict, columns: Dict[str, list]) -> "pyarrow.Table":
+    table = _pyarrow().table(columns)
+    # everything besides the rows (e.g. request parameters) rides along as schema metadata
+    metadata = {name.encode(): dumps(value) for name, value in content.items()}
+    return table.replace_schema_metadata(metadata)
+
+
+def encode_table(content: dict, columns: List[str], rows: List[tuple], media_type: str) -> bytes:
+    """Encode `content` plus `rows` (tuples matching `columns`) under "samples" as `media_type`.
+
+    JSON keeps the rows as arrays; the columnar and Arrow formats store one array per column.
+    """
+    if media_type == JSON:
+        return dumps({**content, "samples": rows})
+    by_column = columns_of(columns, rows)
+    if media_type == COLUMNAR_JSON:
+        return dumps({**content, "samples": by_column})
+    sink = io.BytesIO()
+    table = arrow_table(content, by_column)
+    pyarrow = _pyarrow()
+    if media_type == ARROW:
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    elif media_type == PARQUET:
+        pyarrow.parquet.write_table(table, sink)
+    else:
+        raise NotAcceptable(media_type)
+    return sink.getvalue()
+
+
+def compress(body: bytes, content_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """Return the (possibly) compressed body and the Content-Encoding that applies to it"""
+    if content_encoding is None or len(body) < MIN_COMPRESS_BYTES:
+        return body, None
+    if content_encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0), "gzip"
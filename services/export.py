@@ -0,0 +1,135 @@
+"""Bulk export of `latest`, as it is now or as of any generation still in the history table, as
+CSV or NDJSON. Dated backup tables left by loads from before the history table are exported too.
+"""
+
+import csv
+import io
+import re
+import sqlite3
+from typing import List, Optional, Tuple
+
+from services import history
+from services.db import PROD_TABLE, double_quote, get_generation
+from services.encoding import dumps
+
+CSV = "text/csv"
+NDJSON = "application/x-ndjson"
+EXPORT_FORMATS = {"csv": CSV, "ndjson": NDJSON}
+# rows per fetch; memory use is bounded by this, not by the table size
+BATCH_ROWS = 5_000
+
+# older versions of update_db moved the previous `latest` to a table named by its download date
+BACKUP_TABLE = re.compile(r"\d{4}-\d{2}-\d{2}")
+# `Range: rows=<first>-[<last>]`, zero-based and inclusive like byte ranges
+ROWS_RANGE = re.compile(r"rows=(\d+)-(\d*)")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class PreconditionRequired(Exception):
+    pass
+
+
+def exportable_tables(conn: sqlite3.Connection) -> List[str]:
+    names = [
+        name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    ]
+    backups = sorted((name for name in names if BACKUP_TABLE.fullmatch(name)), reverse=True)
+    return ([PROD_TABLE] if PROD_TABLE in names else []) + backups
+
+
+def exportable_generations(conn: sqlite3.Connection) -> List[int]:
+    """Generations of `latest` that can be rebuilt from the history table, oldest first"""
+    if not history.has_table(conn, history.HISTORY_TABLE):
+        return []
+    return history.generations(conn)
+
+
+def table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({double_quote(table)})")]
+
+
+def row_count(conn: sqlite3.Connection, table: str) -> int:
+    return conn.execute(f"SELECT count(*) FROM {double_quote(table)}").fetchone()[0]
+
+
+def begin_export(
+    conn: sqlite3.Connection, table: str, generation: Optional[int] = None
+) -> Tuple[int, List[str], int]:
+    """Open the read transaction an export streams from, so the count, the rows and the
+    generation all come from one version of the db; returns (generation, columns, row count).
+    With a `generation`, `latest` is rebuilt from the history table as of that generation.
+    The transaction lasts until the connection is closed."""
+    conn.execute("BEGIN")
+    if generation is not None:
+        return generation, history.ROW_COLS, history.rebuilt_count(conn, generation)
+    return get_generation(conn), table_columns(conn, table), row_count(conn, table)
+
+
+def etag(table: str, generation: int, rebuilt: bool = False) -> str:
+    # a table's rows, and so their offsets, only change with the generation. A rebuilt
+    # generation is ordered differently from the live table, even when it's the same one
+    return f'"{table}@{generation}"' if rebuilt else f'"{table}-{generation}"'
+
+
+def requested_rows(
+    range_header: Optional[str], if_range: Optional[str], tag: str, total: int
+) -> Optional[Tuple[int, int]]:
+    """Return the (first, last) rows to send, or None for the whole table.
+
+    A range only makes sense against the version of the table the download started from, so
+    it needs an If-Range with that response's ETag; if the table has changed since, the whole
+    table is sent again (RFC 9110 13.1.5).
+    """
+    if range_header is None or not ROWS_RANGE.fullmatch(range_header.replace(" ", "")):
+        return None
+    if if_range is None:
+        raise PreconditionRequired("Resuming needs If-Range with the ETag of the first response")
+    if if_range.strip() != tag:
+        return None
+    return parse_range(range_header, total)
+
+
+def parse_range(header: Optional[str], total: int) -> Optional[Tuple[int, int]]:
+    """Return the (first, last) rows requested by a Range header, or None for the whole table"""
+    if header is None:
+        return None
+    match = ROWS_RANGE.fullmatch(header.replace(" ", ""))
+    if match is None:
+        # unknown range units are ignored (RFC 9110 14.2)
+        return None
+    first = int(match.group(1))
+    last = min(int(match.group(2)), total - 1) if match.group(2) else total - 1
+    if first >= total or last < first:
+        raise RangeNotSatisfiable(f"rows */{total}")
+    return first, last
+
+
+def export_query(
+    table: str, rows: Optional[Tuple[int, int]], generation: Optional[int] = None
+) -> Tuple[str, list]:
+    if generation is not None:
+        query, params = history.rebuild_query(generation)
+    else:
+        # rowid order is insertion order, so row offsets stay stable across resumed requests
+        query, params = f"SELECT * FROM {double_quote(table)} ORDER BY rowid", []
+    if rows is None:
+        return query, params
+    first, last = rows
+    return f"{query} LIMIT ? OFFSET ?", [*params, last - first + 1, first]
+
+
+def encode_csv(rows: List[tuple], columns: Optional[List[str]] = None) -> bytes:
+    # pass `columns` to start with a header row
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if columns:
+        writer.writerow(columns)
+    writer.writerows(rows)
+    return buffer.getvalue().encode("utf-8")
+
+
+def encode_ndjson(rows: List[tuple], columns: List[str]) -> bytes:
+    return b"".join(dumps(dict(zip(columns, row))) + b"\n" for row in rows)
@@ -0,0 +1,125 @@
+"""Append-only history of `latest`, keyed by dataset generation.
+
+Every publish appends the rows it added (change = +1) and removed (change = -1), so any
+generation still in the history can be rebuilt by summing the changes up to it. This replaces
+the dated full copies of `latest` that full loads used to leave behind.
+"""
+
+import logging
+import sqlite3
+import time
+from typing import Iterator, List, Optional, Tuple
+
+from models.observation import CdpheObservation
+from services.queries import PROD_TABLE, double_quote
+
+logger = logging.getLogger(__name__)
+
+HISTORY_TABLE = "history"
+# the columns of `latest` (see load_staging in tools/update_data.py)
+ROW_COLS = [
+    CdpheObservation.DATE.value,
+    CdpheObservation.UTILITY.value,
+    CdpheObservation.COPIES_LP1.value,
+    CdpheObservation.COPIES_LP2.value,
+    CdpheObservation.CASES.value,
+    CdpheObservation.PHASE.value,
+]
+# generations older than this are folded together by `compact`
+RETENTION_DAYS = 365
+
+_cols = ", ".join(double_quote(col) for col in ROW_COLS)
+
+
+def has_table(conn: sqlite3.Connection, name: str) -> bool:
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+    return conn.execute(query, (name,)).fetchone() is not None
+
+
+def create_history_table(conn: sqlite3.Connection) -> None:
+    """Create the history table if needed. A db that already has data starts its history with
+    the current `latest` as one generation."""
+    if has_table(conn, HISTORY_TABLE):
+        return
+    conn.execute(f"CREATE TABLE {HISTORY_TABLE}(generation INTEGER, change INTEGER, {_cols})")
+    conn.execute(f"CREATE INDEX idx_{HISTORY_TABLE}_generation ON {HISTORY_TABLE}(generation)")
+    if has_table(conn, PROD_TABLE):
+        generation = conn.execute("PRAGMA user_version").fetchone()[0]
+        conn.execute(
+            f"INSERT INTO {HISTORY_TABLE} SELECT ?, 1, {_cols} FROM {PROD_TABLE}", (generation,)
+        )
+        logger.info(f"Started {HISTORY_TABLE} from {PROD_TABLE} at generation {generation}")
+    conn.commit()
+
+
+def record_changes(
+    conn: sqlite3.Connection, generation: int, new_table: str, old_table: Optional[str]
+) -> int:
+    """Append the difference between `old_table` (None: empty) and `new_table` as `generation`;
+    runs in the caller's transaction. Identical rows are counted, so duplicates survive."""
+    old = f"UNION ALL SELECT {_cols}, -1 FROM {double_quote(old_table)}" if old_table else ""
+    return conn.execute(
+        f"INSERT INTO {HISTORY_TABLE} SELECT ?, sum(n), {_cols} "
+        + f"FROM (SELECT {_cols}, 1 AS n FROM {double_quote(new_table)} {old}) "
+        + f"GROUP BY {_cols} HAVING sum(n) != 0",
+        (generation,),
+    ).rowcount
+
+
+def generations(conn: sqlite3.Connection) -> List[int]:
+    rows = conn.execute(f"SELECT DISTINCT generation FROM {HISTORY_TABLE} ORDER BY generation")
+    return [generation for (generation,) in rows]
+
+
+def rebuild_query(generation: int) -> Tuple[str, list]:
+    """SQL for the rows of `latest` as of `generation`, each duplicate as its own row, ordered by
+    every column so that row offsets are the same on every run"""
+    query = (
+        f"WITH RECURSIVE counted AS (SELECT {_cols}, sum(change) AS n FROM {HISTORY_TABLE} "
+        + f"WHERE generation <= ? GROUP BY {_cols} HAVING sum(change) > 0), "
+        + f"copies AS (SELECT * FROM counted UNION ALL SELECT {_cols}, n - 1 FROM copies "
+        + f"WHERE n > 1) SELECT {_cols} FROM copies ORDER BY {_cols}"
+    )
+    return query, [generation]
+
+
+def rebuild(conn: sqlite3.Connection, generation: int) -> Iterator[tuple]:
+    """Yield the rows of `latest` as of `generation` (see rebuild_query)"""
+    yield from conn.execute(*rebuild_query(generation))
+
+
+def rebuilt_count(conn: sqlite3.Connection, generation: int) -> int:
+    """Number of rows `rebuild` yields for `generation`"""
+    return conn.execute(
+        f"SELECT coalesce(sum(n), 0) FROM (SELECT sum(change) AS n FROM {HISTORY_TABLE} "
+        + f"WHERE generation <= ? GROUP BY {_cols} HAVING sum(change) > 0)",
+        (generation,),
+    ).fetchone()[0]
+
+
+def compact(conn: sqlite3.Connection, retention_days: int = RETENTION_DAYS) -> Optional[int]:
+    """Fold every generation older than the retention window into the newest of them, which
+    stays rebuildable; returns that generation (None if there was nothing to fold)"""
+    # generations are publish times in epoch seconds (see db.publish_generation)
+    if not has_table(conn, HISTORY_TABLE):
+        return None
+    cutoff = int(time.time()) - retention_days * 86_400
+    oldest, base = conn.execute(
+        f"SELECT min(generation), max(generation) FROM {HISTORY_TABLE} WHERE generation <= ?",
+        (cutoff,),
+    ).fetchone()
+    # nothing old enough, or only the base left from an earlier run: already folded
+    if base is None or oldest == base:
+        return None
+    with conn:
+        conn.execute(
+            f"CREATE TEMP TABLE folded AS SELECT ? AS generation, sum(change) AS change, {_cols} "
+            + f"FROM {HISTORY_TABLE} WHERE generation <= ? GROUP BY {_cols} "
+            + "HAVING sum(change) > 0",
+            (base, base),
+        )
+        conn.execute(f"DELETE FROM {HISTORY_TABLE} WHERE generation <= ?", (base,))
+        conn.execute(f"INSERT INTO {HISTORY_TABLE} SELECT * FROM temp.folded")
+        conn.execute("DROP TABLE temp.folded")
+    logger.info(f"Compacted {HISTORY_TABLE} up to generation {base}")
+    return base
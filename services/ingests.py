@@ -0,0 +1,158 @@
+"""Manifest of data loads, kept in the db next to the data it describes.
+
+Each full load or merge appends one row: where the data came from, the portal's edit timestamp
+it reflects, how many rows it had, a hash of its content, how long it took and how it ended.
+The loader decides whether the portal has anything new from the last successful row, and
+/api/v1/status reports from it.
+"""
+
+from datetime import datetime, timezone
+import hashlib
+import logging
+import sqlite3
+import time
+from typing import Optional
+
+from services.queries import SUMMARY_TABLE, double_quote
+
+logger = logging.getLogger(__name__)
+
+INGESTS_TABLE = "ingests"
+# statuses: the load was published, was identical to the data already published, had too few
+# rows to publish, or raised
+OK, UNCHANGED, PARTIAL, FAILED = "ok", "unchanged", "partial", "failed"
+INGEST_COLS = [
+    "started_at",
+    # "load" (replaces `latest`) or "merge" (upserts into it)
+    "kind",
+    # "portal", "portal csv", or the path of a local download
+    "source",
+    "portal_edit_ms",
+    "row_count",
+    "content_hash",
+    "duration_s",
+    "status",
+    "generation",
+    "error",
+]
+
+
+def create_ingests_table(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {INGESTS_TABLE}("
+        + "id INTEGER PRIMARY KEY, started_at REAL, kind TEXT, source TEXT, "
+        + "portal_edit_ms INTEGER, row_count INTEGER, content_hash TEXT, duration_s REAL, "
+        + "status TEXT, generation INTEGER, error TEXT)"
+    )
+    # the last load, and the newest portal edit, with a given status are one index lookup each
+    for col in ["id", "portal_edit_ms"]:
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{INGESTS_TABLE}_status_{col} "
+            + f"ON {INGESTS_TABLE}(status, {col})"
+        )
+    conn.commit()
+
+
+def content_hash(conn: sqlite3.Connection, table: str) -> str:
+    """sha256 of `table`'s rows in insert order"""
+    digest = hashlib.sha256()
+    for row in conn.execute(f"SELECT * FROM {double_quote(table)} ORDER BY rowid"):
+        digest.update(repr(row).encode())
+    return digest.hexdigest()
+
+
+def record_ingest(conn: sqlite3.Connection, started_at: float, **values) -> int:
+    """Append a load to the manifest, timed from `started_at` (epoch seconds); returns its id"""
+    values = {**values, "started_at": started_at, "duration_s": time.time() - started_at}
+    cols = [col for col in INGEST_COLS if col in values]
+    with conn:
+        cursor = conn.execute(
+            f"INSERT INTO {INGESTS_TABLE}({', '.join(cols)}) "
+            + f"VALUES ({', '.join('?' * len(cols))})",
+            [values[col] for col in cols],
+        )
+    logger.info(f"Recorded ingest {cursor.lastrowid}: {values}")
+    return cursor.lastrowid
+
+
+def last_ingest(
+    conn: sqlite3.Connection, status: Optional[str] = None, kind: Optional[str] = None
+) -> Optional[dict]:
+    """The most recent load (with `status` and `kind`, if given); None if there is none or no
+    manifest"""
+    filters = {col: value for col, value in [("status", status), ("kind", kind)] if value}
+    where = f"WHERE {' AND '.join(f'{col} = ?' for col in filters)}" if filters else ""
+    try:
+        cursor = conn.execute(
+            f"SELECT id, {', '.join(INGEST_COLS)} FROM {INGESTS_TABLE} {where} "
+            + "ORDER BY id DESC LIMIT 1",
+            list(filters.values()),
+        )
+    except sqlite3.OperationalError:
+        # a db from before the manifest
+        return None
+    row = cursor.fetchone()
+    return dict(zip(["id", *INGEST_COLS], row)) if row else None
+
+
+def last_published_load(conn: sqlite3.Connection) -> Optional[dict]:
+    """The newest published full load, if `latest` still holds what it loaded: None once a
+    merge has changed `latest` after it (merges never delete, so its hash no longer describes
+    `latest`)"""
+    load = last_ingest(conn, OK, kind="load")
+    merge = last_ingest(conn, OK, kind="merge")
+    if load is None or (merge is not None and merge["id"] > load["id"]):
+        return None
+    return load
+
+
+def latest_portal_edit(conn: sqlite3.Connection) -> Optional[int]:
+    """Portal edit timestamp (epoch ms) of the newest data loaded from the portal, or None"""
+    edits = []
+    for status in [OK, UNCHANGED]:
+        try:
+            (edit,) = conn.execute(
+                f"SELECT max(portal_edit_ms) FROM {INGESTS_TABLE} WHERE status = ?", (status,)
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        if edit is not None:
+            edits.append(edit)
+    return max(edits, default=None)
+
+
+def _iso(epoch_seconds: Optional[float]) -> Optional[str]:
+    if not epoch_seconds:
+        return None
+    return datetime.fromtimestamp(epoch_seconds, timezone.utc).isoformat(timespec="seconds")
+
+
+def describe(ingest: Optional[dict]) -> Optional[dict]:
+    if ingest is None:
+        return None
+    duration, rows = ingest["duration_s"], ingest["row_count"]
+    return {
+        **ingest,
+        "started_at": _iso(ingest["started_at"]),
+        "portal_edited_at": _iso(ingest["portal_edit_ms"] and ingest["portal_edit_ms"] / 1000),
+        "rows_per_s": round(rows / duration) if rows and duration else None,
+    }
+
+
+def get_status(conn: sqlite3.Connection) -> dict:
+    """Data freshness and the last loads, for /api/v1/status"""
+    # generations are publish times in epoch seconds (see db.publish_generation)
+    generation = conn.execute("PRAGMA user_version").fetchone()[0]
+    edit = latest_portal_edit(conn)
+    try:
+        (latest_date,) = conn.execute(f"SELECT max(latest_date) FROM {SUMMARY_TABLE}").fetchone()
+    except sqlite3.OperationalError:
+        latest_date = None
+    return {
+        "generation": generation,
+        "published_at": _iso(generation),
+        "portal_edited_at": _iso(edit and edit / 1000),
+        "latest_sample_date": latest_date,
+        "last_ingest": describe(last_ingest(conn)),
+        "last_published": describe(last_ingest(conn, OK)),
+    }
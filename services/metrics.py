@@ -0,0 +1,105 @@
+"""Prometheus metrics for the data API's hot path and the data updater.
+
+Under gunicorn every worker is its own process, so set PROMETHEUS_MULTIPROC_DIR (an empty,
+writable directory, cleared before the service starts) in the environment: workers then write
+their samples to files there and /metrics aggregates all of them. tools/update_data.py writes to
+the same directory when it runs with that variable set.
+"""
+
+from contextlib import contextmanager
+import logging
+import os
+import time
+from typing import Iterable, Iterator, Tuple, TypeVar
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# sub-millisecond index reads up to multi-second range scans
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+# page downloads up to full loads
+SLOW_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+DB_ACQUIRE = Histogram(
+    "wastewater_db_acquire_seconds",
+    "Time spent waiting for a pooled connection",
+    buckets=FAST_BUCKETS,
+)
+DB_QUERY = Histogram(
+    "wastewater_db_query_seconds",
+    "Time spent executing queries and fetching their rows",
+    ["query", "stage"],
+    buckets=FAST_BUCKETS,
+)
+SERIALIZE = Histogram(
+    "wastewater_serialize_seconds",
+    "Time spent encoding and compressing response bodies",
+    ["endpoint", "media_type", "stage"],
+    buckets=FAST_BUCKETS,
+)
+SLOW_QUERIES = Counter(
+    "wastewater_slow_queries_total",
+    "Queries slower than WASTEWATER_SLOW_QUERY_MS",
+    ["query"],
+)
+SINGLE_FLIGHT = Counter(
+    "wastewater_singleflight_requests_total",
+    "Response cache misses that started a query (leader) or shared one in flight (follower)",
+    ["endpoint", "role"],
+)
+UPDATER_STAGE = Histogram(
+    "wastewater_updater_stage_seconds",
+    "Time spent in each stage of a data update",
+    ["stage"],
+    buckets=SLOW_BUCKETS,
+)
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        (histogram.labels(**labels) if labels else histogram).observe(time.perf_counter() - start)
+
+
+class Stopwatch:
+    """Time spent pulling items from an iterable, e.g. to separate a lazy pipeline's upstream
+    stages from the time its consumer spends on its own work"""
+
+    def __init__(self, iterable: Iterable[T]):
+        self.iterable = iterable
+        self.elapsed = 0.0
+
+    def __iter__(self) -> Iterator[T]:
+        iterator = iter(self.iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.elapsed += time.perf_counter() - start
+            yield item
+
+
+def render() -> Tuple[bytes, str]:
+    """Return the exposition body and its content type, aggregated across processes if needed"""
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,157 @@
+import logging
+from contextlib import contextmanager
+from queue import Empty, Full, LifoQueue
+import sqlite3
+import threading
+from typing import Callable, Iterator, List, Optional
+
+from services import db
+
+logger = logging.getLogger(__name__)
+
+# per-worker defaults; gunicorn runs 4 workers (see server/units/wastewater.service)
+DEFAULT_POOL_SIZE = 8
+DEFAULT_ACQUIRE_TIMEOUT = 5.0
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Bounded pool of read-only sqlite connections for one worker process.
+
+    Connections are opened lazily (up to `size`) and handed out LIFO so that hot connections
+    keep their page cache. The pool tracks the dataset generation written by the loader
+    (PRAGMA user_version) and notifies listeners when it changes.
+    """
+
+    def __init__(
+        self, db_uri: str, size: int = DEFAULT_POOL_SIZE, timeout: float = DEFAULT_ACQUIRE_TIMEOUT
+    ):
+        self.db_uri = db_uri
+        self.size = size
+        self.timeout = timeout
+        self.generation: Optional[int] = None
+        self._idle: LifoQueue = LifoQueue(maxsize=size)
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._listeners: List[Callable[[int], None]] = []
+        # health check once per pool, rather than once per request
+        conn = db.get_connection(db_uri)
+        self._check_generation(conn)
+        self._opened += 1
+        self._idle.put_nowait(conn)
+
+    def add_listener(self, callback: Callable[[int], None]) -> None:
+        # called with the new generation whenever the loader publishes new data
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+
+    def acquire(self) -> sqlite3.Connection:
+        if self._closed:
+            raise PoolExhausted(f"Pool for {self.db_uri} is closed")
+        try:
+            conn = self._idle.get_nowait()
+        except Empty:
+            conn = self._open_or_wait()
+        self._check_generation(conn)
+        return conn
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if self._closed:
+            conn.close()
+            return
+        try:
+            self._idle.put_nowait(conn)
+        except Full:
+            conn.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self) -> None:
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                break
+
+    def _open_or_wait(self) -> sqlite3.Connection:
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+        if can_open:
+            return db.open_connection(self.db_uri)
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except Empty:
+            raise PoolExhausted(f"No connection available after {self.timeout}s")
+
+    def _check_generation(self, conn: sqlite3.Connection) -> None:
+        # user_version lives in the db header, so this read is effectively free
+        generation = db.get_generation(conn)
+        if generation == self.generation:
+            return
+        previous, self.generation = self.generation, generation
+        if previous is not None:
+            logger.info(f"Dataset generation changed: {previous} -> {generation}")
+            for callback in self._listeners:
+                callback(generation)
+
+
+# one pool per worker process
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def init_pool(db_uri: str, size: int = DEFAULT_POOL_SIZE) -> ConnectionPool:
+    global _pool
+    if _pool is not None:
+        return _pool
+    with _pool_lock:
+        if _pool is None:
+            logger.info(f"Initializing connection pool for {db_uri} ({size=})")
+            _pool = ConnectionPool(db_uri, size=size)
+    return _pool
+
+
+def get_pool() -> ConnectionPool:
+    if _pool is None:
+        raise RuntimeError("Connection pool has not been initialized")
+    return _pool
+
+
+def swap_pool(db_uri: str, size: Optional[int] = None) -> ConnectionPool:
+    """Replace the worker's pool, e.g. after the loader rebuilds or replaces the db.
+
+    Connections checked out of the old pool are closed when they are released.
+    """
+    global _pool
+    with _pool_lock:
+        old = _pool
+        new = ConnectionPool(db_uri, size=size or (old.size if old else DEFAULT_POOL_SIZE))
+        _pool = new
+    if old is not None:
+        new._listeners = list(old._listeners)
+        old.close()
+        if new.generation != old.generation:
+            for callback in new._listeners:
+                callback(new.generation)
+    logger.info(f"Swapped connection pool to {db_uri} (generation {new.generation})")
+    return new
+
+
+def close_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
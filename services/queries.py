@@ -0,0 +1,73 @@
+"""SQL for the API's reads. Every statement is parameterized with fixed text, so sqlite3's
+per-connection statement cache (see db.CACHED_STATEMENTS) prepares each one once per connection
+rather than once per distinct utility or date range."""
+
+from dataclasses import dataclass
+from datetime import date
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from models.observation import CdpheObservation
+
+# DB conventions
+PROD_TABLE = "latest"
+UTILITIES_TABLE = "utilities"
+SUMMARY_TABLE = "summary"
+DATE_COL = CdpheObservation.DATE.value
+SAMPLES_COLS = [CdpheObservation.COPIES_LP2.value, CdpheObservation.COPIES_LP1.value]
+UTILITY_COL = CdpheObservation.UTILITY.value
+SAMPLES_INDEX = f"idx_{PROD_TABLE}_utility_date"
+
+
+def double_quote(name: str) -> str:
+    # manually double-quote col names
+    return f'"{name}"'
+
+
+UTILITIES = f"SELECT {UTILITY_COL} FROM {UTILITIES_TABLE} ORDER BY {UTILITY_COL} ASC"
+SUMMARY = f"SELECT * FROM {SUMMARY_TABLE} ORDER BY {UTILITY_COL} ASC"
+
+
+@lru_cache(maxsize=256)
+def samples_statement(n_utilities: int, start: bool, end: bool, with_utility: bool) -> str:
+    # notes on sqlite quoting and keywords: https://www.sqlite.org/lang_keywords.html
+    cols = ([UTILITY_COL] if with_utility else []) + [DATE_COL]
+    cols += [double_quote(col) for col in SAMPLES_COLS]
+    if n_utilities == 0:
+        # every utility, driven by the lookup table: still one index range per utility
+        conditions = [f"{UTILITY_COL} IN (SELECT {UTILITY_COL} FROM {UTILITIES_TABLE})"]
+    elif n_utilities == 1:
+        conditions = [f"{UTILITY_COL} = ?"]
+    else:
+        conditions = [f"{UTILITY_COL} IN ({','.join('?' * n_utilities)})"]
+    if start:
+        conditions.append(f"{DATE_COL} >= ?")
+    if end:
+        conditions.append(f"{DATE_COL} <= ?")
+    order = ([UTILITY_COL] if with_utility else []) + [DATE_COL]
+    return (
+        f"SELECT {', '.join(cols)} FROM {PROD_TABLE} WHERE {' AND '.join(conditions)} "
+        + f"ORDER BY {', '.join(f'{col} ASC' for col in order)}"
+    )
+
+
+@dataclass(frozen=True)
+class SamplesQuery:
+    """Rows of `latest` for some (or, with `utilities=None`, all) utilities, optionally limited
+    to a date range. The statement depends on which filters are set, never on their values."""
+
+    utilities: Optional[Tuple[str, ...]] = None
+    start: Optional[date] = None
+    end: Optional[date] = None
+    # select the utility too, and order by it first
+    with_utility: bool = False
+
+    def build(self) -> Tuple[str, tuple]:
+        utilities = self.utilities or ()
+        if self.utilities is not None and not utilities:
+            raise ValueError("utilities must be None (all) or non-empty")
+        dates = tuple(str(d) for d in (self.start, self.end) if d is not None)
+        query = samples_statement(
+            len(utilities), self.start is not None, self.end is not None, self.with_utility
+        )
+        return query, utilities + dates
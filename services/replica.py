@@ -0,0 +1,161 @@
+"""Immutable, checksummed copies of the db, for API nodes that don't run the loader.
+
+The loader publishes every generation it commits into PUBLISH_DIR:
+
+    wastewater-1700000000.db      VACUUM INTO copy, never modified afterwards
+    wastewater-1700000000.json    its manifest: generation, file, size, sha256
+    current.json                  manifest of the newest one, replaced atomically
+
+A replica node's refresh leader (see services/scheduler.py) pulls current.json from a primary's
+PUBLISH_DIR, served over http(s) or mounted as a directory, downloads the db it names into
+REPLICA_DIR, checks it against the manifest and then replaces its own current.json. Each
+worker swaps its connection pool to the new file when it sees that change, so every response
+comes from one complete generation.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import re
+import shutil
+import sqlite3
+from typing import IO, Optional
+
+import requests
+
+from services.db import get_generation
+
+logger = logging.getLogger(__name__)
+
+# set on the primary: where the loader publishes snapshots (unset: it doesn't)
+PUBLISH_DIR = os.environ.get("WASTEWATER_PUBLISH_DIR")
+# set on replicas: a primary's PUBLISH_DIR, e.g. http://10.0.0.2/snapshots/ or /mnt/primary
+REPLICA_SOURCE = os.environ.get("WASTEWATER_REPLICA_SOURCE")
+REPLICA_DIR = os.environ.get("WASTEWATER_REPLICA_DIR", "data/replica")
+CURRENT = "current.json"
+SNAPSHOT_NAME = re.compile(r"wastewater-(\d+)\.db")
+# snapshots kept on either side; replica workers may still be reading the previous one
+KEEP = 3
+BLOCK_SIZE = 1024 * 1024
+REQUEST_TIMEOUT = 60
+
+
+class ReplicaError(Exception):
+    pass
+
+
+def snapshot_name(generation: int) -> str:
+    return f"wastewater-{generation}.db"
+
+
+def write_manifest(path: Path, manifest: dict) -> None:
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(manifest))
+    os.replace(tmp, path)
+
+
+def read_current(directory: str) -> Optional[dict]:
+    try:
+        return json.loads((Path(directory) / CURRENT).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def current_uri(directory: str = REPLICA_DIR) -> Optional[str]:
+    """URI of the newest snapshot pulled into `directory`; nothing writes it, so it's opened
+    immutable, without locking or change checks"""
+    if (manifest := read_current(directory)) is None:
+        return None
+    return f"file:{(Path(directory) / manifest['file']).resolve()}?immutable=1"
+
+
+def sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        while block := f.read(BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def prune(directory: str, keep: int = KEEP) -> None:
+    """Delete all but the newest `keep` snapshots in `directory`"""
+    snapshots = sorted(
+        (int(match.group(1)), path)
+        for path in Path(directory).glob("wastewater-*.db")
+        if (match := SNAPSHOT_NAME.fullmatch(path.name))
+    )
+    for _, path in snapshots[:-keep]:
+        path.unlink()
+        path.with_suffix(".json").unlink(missing_ok=True)
+        logger.info(f"Removed snapshot {path}")
+
+
+def publish(conn: sqlite3.Connection, publish_dir: str, keep: int = KEEP) -> dict:
+    """Publish the db's current generation as an immutable snapshot; returns its manifest"""
+    generation = get_generation(conn)
+    directory = Path(publish_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+    target = directory / snapshot_name(generation)
+    if target.exists():
+        return json.loads(target.with_suffix(".json").read_text())
+    tmp = target.with_name(f".{target.name}.tmp")
+    tmp.unlink(missing_ok=True)
+    # a consistent, compacted copy, even while the API reads the db
+    conn.execute("VACUUM INTO ?", (str(tmp),))
+    # replicas open it read-only, so it can't rely on a -wal/-shm next to it
+    with sqlite3.connect(tmp) as copy:
+        copy.execute("PRAGMA journal_mode = DELETE")
+    copy.close()
+    manifest = {
+        "generation": generation,
+        "file": target.name,
+        "size": tmp.stat().st_size,
+        "sha256": sha256_file(tmp),
+    }
+    os.replace(tmp, target)
+    write_manifest(target.with_suffix(".json"), manifest)
+    write_manifest(directory / CURRENT, manifest)
+    logger.info(f"Published snapshot {target} ({manifest['size']} bytes)")
+    prune(publish_dir, keep)
+    return manifest
+
+
+def open_source(source: str, name: str) -> IO[bytes]:
+    if source.startswith(("http://", "https://")):
+        response = requests.get(
+            f"{source.rstrip('/')}/{name}", stream=True, timeout=REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return response.raw
+    return (Path(source) / name).open("rb")
+
+
+def pull(source: str, replica_dir: str = REPLICA_DIR, keep: int = KEEP) -> Optional[dict]:
+    """Download the primary's current snapshot if it's newer than the local one; returns its
+    manifest, or None if the replica is already current"""
+    with open_source(source, CURRENT) as f:
+        manifest = json.loads(f.read())
+    local = read_current(replica_dir)
+    if local is not None and local["generation"] >= manifest["generation"]:
+        return None
+    if not SNAPSHOT_NAME.fullmatch(manifest["file"]):
+        raise ReplicaError(f"Unexpected snapshot name in {source}: {manifest['file']!r}")
+    directory = Path(replica_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+    target = directory / manifest["file"]
+    # workers that start before any snapshot was pulled may all pull the same one
+    tmp = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+    with open_source(source, manifest["file"]) as src, tmp.open("wb") as dst:
+        shutil.copyfileobj(src, dst, BLOCK_SIZE)
+    if tmp.stat().st_size != manifest["size"] or sha256_file(tmp) != manifest["sha256"]:
+        tmp.unlink()
+        raise ReplicaError(f"{manifest['file']} from {source} does not match its checksum")
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, target)
+    write_manifest(directory / CURRENT, manifest)
+    logger.info(f"Pulled snapshot generation {manifest['generation']} from {source}")
+    prune(replica_dir, keep)
+    return manifest
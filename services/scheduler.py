@@ -0,0 +1,171 @@
+"""Optional in-process data refresh, instead of cron runs of tools/update_data.py.
+
+Every gunicorn worker starts the scheduler, and one of them becomes the leader by holding an
+flock on LOCK_PATH. The leader polls the portal's metadata with conditional requests and runs
+an update when the portal reports newer data. If the leader exits, the lock is released and
+another worker takes over on its next attempt.
+
+Loads, the leader's and tools/update_data.py's, take a second flock on LOAD_LOCK_PATH for as
+long as they run, since they all write the same staging tables.
+
+On a replica node (see services/replica.py) the leader pulls the primary's published snapshots
+instead, and never runs the loader itself.
+
+Every worker, leader included, also watches the dataset generation so that a new one clears
+its caches (and reloads its snapshot) ahead of the next request rather than during it.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from dataclasses import dataclass, field
+import fcntl
+import logging
+import os
+import sqlite3
+from pathlib import Path
+from typing import Awaitable, Callable, Iterator, List, Optional
+
+from services import ingests, replica
+
+logger = logging.getLogger(__name__)
+
+# seconds between portal polls; 0 leaves updates to cron (see server/scripts/server_setup.sh)
+REFRESH_INTERVAL = int(os.environ.get("WASTEWATER_REFRESH_INTERVAL", 0))
+LOCK_PATH = os.environ.get("WASTEWATER_REFRESH_LOCK", "data/refresh.lock")
+LOAD_LOCK_PATH = os.environ.get("WASTEWATER_LOAD_LOCK", "data/load.lock")
+# seconds between each worker's generation checks
+WATCH_INTERVAL = float(os.environ.get("WASTEWATER_WATCH_INTERVAL", 5))
+
+_tasks: List[asyncio.Task] = []
+_lock_fd: Optional[int] = None
+# updates run off the event loop, one at a time
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def acquire_lock(path: str = LOCK_PATH) -> Optional[int]:
+    """Return the fd holding the exclusive lock on `path`, or None if another process holds it.
+    The lock lasts until the fd is closed or the process exits."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    os.ftruncate(fd, 0)
+    os.write(fd, f"{os.getpid()}\n".encode())
+    return fd
+
+
+def lock_holder(path: str) -> Optional[int]:
+    """pid of the process holding the lock on `path`, as it wrote it"""
+    try:
+        return int(Path(path).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+@contextmanager
+def load_lock(path: str) -> Iterator[bool]:
+    """Hold the load lock on `path` for the block if no other load does; yields whether it
+    was taken"""
+    fd = acquire_lock(path)
+    try:
+        yield fd is not None
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+@dataclass
+class RefreshState:
+    # ETag / Last-Modified of the last full metadata response
+    validators: dict = field(default_factory=dict)
+
+
+def refresh(state: RefreshState, csv_workers: int = 1) -> bool:
+    """Poll the portal and update the db if it has newer data; returns whether it did"""
+    # the loader (and requests) only load in the leader, and only once it polls
+    from tools import update_data
+
+    latest_portal_edit = update_data.poll_portal_edit(state.validators)
+    if latest_portal_edit is None:
+        return False
+    with closing(sqlite3.connect(update_data.DATABASE)) as conn:
+        latest_local_edit = ingests.latest_portal_edit(conn)
+    if latest_local_edit is not None and latest_portal_edit <= latest_local_edit:
+        return False
+    logger.info(f"Portal reports new data (edited {latest_portal_edit}); updating")
+    updated = False
+    try:
+        with load_lock(LOAD_LOCK_PATH) as locked:
+            if locked:
+                # a worker process shouldn't fork more workers, so the CSV fallback runs inline
+                updated = update_data.update_from_portal(latest_portal_edit, csv_workers)
+            else:
+                holder = lock_holder(LOAD_LOCK_PATH)
+                logger.info(f"Another load (pid {holder}) is running; retrying on the next poll")
+    finally:
+        if not updated:
+            # failed or raised: the metadata won't change again until the next edit, so poll
+            # unconditionally to retry
+            state.validators.clear()
+    if updated:
+        update_data.archive_downloads()
+    return updated
+
+
+def refresh_replica(state: RefreshState) -> bool:
+    """Pull the primary's newest snapshot, if it's newer than the replica's; returns whether
+    there was one"""
+    return replica.pull(replica.REPLICA_SOURCE) is not None
+
+
+async def lead(interval: int = REFRESH_INTERVAL, lock_path: str = LOCK_PATH) -> None:
+    global _executor, _lock_fd
+    state = RefreshState()
+    job = refresh_replica if replica.REPLICA_SOURCE else refresh
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            if _lock_fd is None and (_lock_fd := acquire_lock(lock_path)) is not None:
+                logger.info(f"Worker {os.getpid()} is the refresh leader ({interval=}s)")
+                _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="refresh")
+        except OSError as e:
+            # e.g. a lock file this worker's user can't open; tried again next interval
+            logger.error(f"Can't take the refresh lock {lock_path}: {e!r}")
+        if _lock_fd is not None:
+            try:
+                await loop.run_in_executor(_executor, job, state)
+            except Exception as e:
+                logger.error(f"Scheduled refresh failed: {e!r}")
+        await asyncio.sleep(interval)
+
+
+async def watch(on_tick: Callable[[], Awaitable[None]], interval: float = WATCH_INTERVAL) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await on_tick()
+        except Exception as e:
+            logger.warning(f"Generation check failed: {e!r}")
+
+
+def start(on_tick: Callable[[], Awaitable[None]], interval: int = REFRESH_INTERVAL) -> None:
+    """Start the leader election and generation watch tasks on the running loop"""
+    logger.info(f"Starting refresh scheduler ({interval=}s, {LOCK_PATH=})")
+    _tasks.append(asyncio.create_task(lead(interval)))
+    _tasks.append(asyncio.create_task(watch(on_tick)))
+
+
+def stop() -> None:
+    global _executor, _lock_fd
+    while _tasks:
+        _tasks.pop().cancel()
+    if _executor is not None:
+        # hold the lock until a running update finishes, so no other worker starts one meanwhile
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+    if _lock_fd is not None:
+        os.close(_lock_fd)
+        _lock_fd = None
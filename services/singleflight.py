@@ -0,0 +1,46 @@
+"""Coalesce identical concurrent calls into one.
+
+When a burst of requests misses the response cache at once (say the frontend's default report,
+right after a new generation clears the cache), each of them would otherwise run the same query
+and serialize the same body. With a SingleFlight the first request for a key starts the call and
+later ones, until it finishes, await that same call. Nothing is kept once it finishes: caching
+results is the response cache's job.
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+from services.metrics import SINGLE_FLIGHT
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """In-flight calls by key, for one event loop (so one per worker process)"""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, endpoint: str, fn: Callable[..., Awaitable[T]], *args) -> T:
+        """Return `await fn(*args)`, sharing the call with any other caller of the same key
+        while it runs. Exceptions are raised to every caller."""
+        call = self._calls.get(key)
+        if call is None:
+            SINGLE_FLIGHT.labels(endpoint=endpoint, role="leader").inc()
+            call = self._calls[key] = asyncio.ensure_future(fn(*args))
+            call.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            SINGLE_FLIGHT.labels(endpoint=endpoint, role="follower").inc()
+            logger.debug(f"Joined in-flight call for {key}")
+        # a caller that goes away (e.g. a client disconnect) doesn't cancel it for the others
+        return await asyncio.shield(call)
+
+    def _forget(self, key: Hashable, call: asyncio.Future) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
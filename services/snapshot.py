@@ -0,0 +1,164 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date
+from functools import lru_cache
+import logging
+import math
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from models.report import BatchReport, Report
+from services.db import (
+    DATE_COL,
+    PROD_TABLE,
+    SAMPLES_COLS,
+    UTILITY_COL,
+    db_path,
+    double_quote,
+    get_generation,
+)
+from services.pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+NAN = float("nan")
+
+
+@lru_cache(maxsize=4096)
+def _iso(day: int) -> str:
+    return date.fromordinal(day).isoformat()
+
+
+def _value(x: float) -> Optional[float]:
+    return None if math.isnan(x) else x
+
+
+class Snapshot:
+    """Read-only, columnar copy of the `latest` table.
+
+    Rows are sorted by (utility, date). Utilities are dictionary-encoded by their sorted position,
+    `offsets[i]:offsets[i + 1]` is the row range for utility `i`, and dates are stored as
+    proleptic ordinals so a date range is two binary searches within that row range.
+    """
+
+    def __init__(self, generation: int, rows: List[tuple]):
+        self.generation = generation
+        self.utilities: List[str] = []
+        self.codes: Dict[str, int] = {}
+        self.offsets = array("i")
+        self.days = array("i")
+        # one array per SAMPLES_COLS entry; NaN stands in for NULL
+        self.values = [array("d") for _ in SAMPLES_COLS]
+        for i, (utility, day, *values) in enumerate(rows):
+            if utility not in self.codes:
+                self.codes[utility] = len(self.utilities)
+                self.utilities.append(utility)
+                self.offsets.append(i)
+            self.days.append(date.fromisoformat(day).toordinal())
+            for column, value in zip(self.values, values):
+                column.append(NAN if value is None else value)
+        self.offsets.append(len(self.days))
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def get_utilities(self) -> List[str]:
+        # like the utilities table, without rows that have none
+        return [utility for utility in self.utilities if utility is not None]
+
+    def get_samples(self, report: Report) -> List[tuple]:
+        code = self.codes.get(report.utility)
+        if code is None:
+            return []
+        lo, hi = self.offsets[code], self.offsets[code + 1]
+        if report.start:
+            lo = bisect_left(self.days, report.start.toordinal(), lo, hi)
+        if report.end:
+            hi = bisect_right(self.days, report.end.toordinal(), lo, hi)
+        return [
+            (_iso(self.days[i]), *(_value(column[i]) for column in self.values))
+            for i in range(lo, hi)
+        ]
+
+    def iter_batch_samples(self, report: BatchReport) -> Iterator[List[tuple]]:
+        # one chunk of (utility, date, *values) rows per utility, in utility order like sqlite
+        utilities = self.utilities if report.all_utilities else sorted(set(report.utilities))
+        for utility in utilities:
+            if utility is None:
+                continue
+            rows = self.get_samples(Report(utility=utility, start=report.start, end=report.end))
+            if rows:
+                yield [(utility, *row) for row in rows]
+
+
+def load(conn: sqlite3.Connection) -> Snapshot:
+    cols = ", ".join([UTILITY_COL, DATE_COL] + [double_quote(col) for col in SAMPLES_COLS])
+    query = f"SELECT {cols} FROM {PROD_TABLE} ORDER BY {UTILITY_COL} ASC, {DATE_COL} ASC"
+    generation = get_generation(conn)
+    snapshot = Snapshot(generation, conn.execute(query).fetchall())
+    logger.info(f"Loaded snapshot of {len(snapshot)} rows (generation {generation})")
+    return snapshot
+
+
+# one snapshot per worker process
+_snapshot: Optional[Snapshot] = None
+_file_state: Optional[Tuple[int, int]] = None
+_reload_lock = threading.Lock()
+
+
+def db_file_state(db_uri: str) -> Tuple[int, int]:
+    # the loader writes through the WAL, so watch both files
+    state = []
+    db_file = db_path(db_uri)
+    for path in (db_file, f"{db_file}-wal"):
+        try:
+            state.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            state.append(0)
+    return tuple(state)
+
+
+def invalidate(generation: Optional[int] = None) -> None:
+    global _file_state
+    _file_state = None
+
+
+def is_fresh(conn_pool: ConnectionPool) -> bool:
+    return _snapshot is not None and _file_state == db_file_state(conn_pool.db_uri)
+
+
+def get_snapshot(conn_pool: ConnectionPool) -> Snapshot:
+    """Return this worker's snapshot, reloading it if the loader has published new data"""
+    global _snapshot, _file_state
+    if is_fresh(conn_pool):
+        return _snapshot
+    if not _reload_lock.acquire(blocking=_snapshot is None):
+        # another thread is already reloading; keep serving the previous snapshot meanwhile
+        return _snapshot
+    try:
+        state = db_file_state(conn_pool.db_uri)
+        conn_pool.add_listener(invalidate)
+        with conn_pool.connection() as conn:
+            if _snapshot is None or get_generation(conn) != _snapshot.generation:
+                _snapshot = load(conn)
+        _file_state = state
+        return _snapshot
+    finally:
+        _reload_lock.release()
+
+
+def preload(conn: sqlite3.Connection, db_uri: str) -> Snapshot:
+    """Load the snapshot ahead of any pool, e.g. in gunicorn's master before it forks workers,
+    which then share its memory until they reload it for new data"""
+    global _snapshot, _file_state
+    state = db_file_state(db_uri)
+    _snapshot = load(conn)
+    _file_state = state
+    return _snapshot
+
+
+def clear() -> None:
+    global _snapshot, _file_state
+    _snapshot, _file_state = None, None
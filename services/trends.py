@@ -0,0 +1,67 @@
+"""Per-utility trend figures for the summary table, computed by the loader after each load"""
+
+from bisect import bisect_right
+from datetime import date
+from statistics import fmean
+from typing import Iterable, List, Optional, Tuple
+
+# days covered by each rolling mean and percent change
+WINDOWS = (7, 14, 30)
+# a change (percent) larger than this over TREND_WINDOW days counts as a trend
+TREND_WINDOW = 14
+TREND_THRESHOLD = 10.0
+
+SUMMARY_COLS = [
+    "latest_date",
+    "latest_value",
+    *(f"mean_{days}d" for days in WINDOWS),
+    *(f"change_{days}d" for days in WINDOWS),
+    "percentile",
+    "trend",
+]
+
+
+def _window_mean(days: List[int], values: List[float], lo: int, hi: int) -> Optional[float]:
+    # mean of the readings with lo < day <= hi
+    window = values[bisect_right(days, lo) : bisect_right(days, hi)]
+    return fmean(window) if window else None
+
+
+def _percent_change(current: Optional[float], previous: Optional[float]) -> Optional[float]:
+    if current is None or not previous:
+        return None
+    return round((current - previous) / previous * 100, 1)
+
+
+def summarize(readings: Iterable[Tuple[str, Optional[float]]]) -> tuple:
+    """Return one summary row (see SUMMARY_COLS) for a utility's date-ordered readings.
+
+    Rolling means cover the N days up to the latest reading; percent changes compare them with
+    the N days before that. The percentile places the latest reading among all of the utility's
+    readings.
+    """
+    present = [(day, value) for day, value in readings if value is not None]
+    if not present:
+        return (None,) * len(SUMMARY_COLS)
+    days = [date.fromisoformat(day).toordinal() for day, _ in present]
+    values = [value for _, value in present]
+    latest_day, latest = present[-1]
+    end = days[-1]
+    means, changes = [], []
+    for window in WINDOWS:
+        current = _window_mean(days, values, end - window, end)
+        previous = _window_mean(days, values, end - 2 * window, end - window)
+        means.append(current)
+        changes.append(_percent_change(current, previous))
+    ranked = sorted(values)
+    percentile = round(bisect_right(ranked, latest) / len(ranked) * 100, 1)
+    trend_change = changes[WINDOWS.index(TREND_WINDOW)]
+    if trend_change is None:
+        trend = None
+    elif trend_change > TREND_THRESHOLD:
+        trend = "up"
+    elif trend_change < -TREND_THRESHOLD:
+        trend = "down"
+    else:
+        trend = "flat"
+    return (latest_day, latest, *means, *changes, percentile, trend)
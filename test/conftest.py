@@ -0,0 +1,14 @@
+import pytest
+
+from test.records import RECORDS
+
+
+@pytest.fixture
+def loaded_db(tmp_path) -> str:
+    # a db as the loader leaves it, at its first generation. The loader configures logging
+    # when it's imported, so only the tests that use it import it
+    from tools.update_data import update_db
+
+    database = str(tmp_path / "wastewater.db")
+    update_db(RECORDS, database=database)
+    return database
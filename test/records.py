@@ -0,0 +1,33 @@
+"""Portal records shared by the updater, data layer and API tests"""
+
+from datetime import datetime
+import sqlite3
+
+from models.observation import CdpheObservation
+
+
+def record(day: str, utility: str, lp2: float = 1.0) -> dict:
+    # same shape as a flattened portal feature (see transform_raw_json_data)
+    return {
+        CdpheObservation.DATE.value: int(datetime.fromisoformat(day).timestamp() * 1000),
+        CdpheObservation.UTILITY.value: utility,
+        CdpheObservation.COPIES_LP1.value: None,
+        CdpheObservation.COPIES_LP2.value: lp2,
+        CdpheObservation.CASES.value: 0,
+        CdpheObservation.PHASE.value: "Phase 2",
+    }
+
+
+UTILITIES = ["Arapahoe County", "Boulder", "Denver", "Metro WW - Platte/Central"]
+RECORDS = [
+    record("2022-03-16", "Arapahoe County"),
+    record("2022-03-17", "Arapahoe County"),
+    record("2022-03-16", "Boulder"),
+]
+
+
+def latest_rows(database: str) -> list:
+    conn = sqlite3.connect(database)
+    rows = sorted(conn.execute("SELECT * FROM latest").fetchall(), key=repr)
+    conn.close()
+    return rows
@@ -0,0 +1,85 @@
+import math
+
+from models.report import AggregateReport
+from services import aggregate
+
+ROWS = [
+    ("2022-02-27", 1.0, None),
+    ("2022-02-28", None, None),
+    ("2022-03-01", 3.0, 2.0),
+    ("2022-03-02", None, 4.0),
+    ("2022-03-07", 8.0, None),
+]
+
+
+def test_bucket_start():
+    assert aggregate.bucket_start("2022-03-02", "week") == "2022-02-28"
+    assert aggregate.bucket_start("2022-02-27", "week") == "2022-02-21"
+    assert aggregate.bucket_start("2022-03-31", "month") == "2022-03-01"
+
+
+def test_drop_nulls():
+    assert [row[0] for row in aggregate.drop_nulls(ROWS)] == [
+        "2022-02-27",
+        "2022-03-01",
+        "2022-03-02",
+        "2022-03-07",
+    ]
+
+
+def test_bucketed_ignores_nulls():
+    assert aggregate.bucketed(ROWS, "week") == [
+        ("2022-02-21", 1.0, None),
+        ("2022-02-28", 3.0, 3.0),
+        ("2022-03-07", 8.0, None),
+    ]
+    assert aggregate.bucketed(ROWS, "month", "max") == [
+        ("2022-02-01", 1.0, None),
+        ("2022-03-01", 8.0, 4.0),
+    ]
+
+
+def test_rolling_mean():
+    rows = [("2022-03-01", 1.0), ("2022-03-02", None), ("2022-03-03", 5.0), ("2022-03-04", 9.0)]
+    assert aggregate.rolling(rows, 2) == [
+        ("2022-03-01", 1.0),
+        ("2022-03-02", 1.0),
+        ("2022-03-03", 5.0),
+        ("2022-03-04", 7.0),
+    ]
+
+
+def test_lttb_keeps_endpoints_and_peaks():
+    rows = [
+        (f"2022-01-{d:02d}", math.sin(d / 2) + (10.0 if d == 17 else 0.0)) for d in range(1, 32)
+    ]
+    sampled = aggregate.lttb(rows, 8)
+    assert len(sampled) == 8
+    assert sampled[0] == rows[0] and sampled[-1] == rows[-1]
+    assert rows[16] in sampled
+    assert sampled == sorted(sampled)
+    # nothing to downsample
+    assert aggregate.lttb(rows, 100) == rows
+
+
+def test_lttb_keeps_rows_with_only_lp1():
+    # (date, LP2, LP1): LP1 only before LP2 was introduced
+    lp1 = [(f"2022-01-{d:02d}", None, float(d)) for d in range(1, 8)]
+    lp2 = [(f"2022-01-{d:02d}", float(d), None) for d in range(8, 11)]
+    rows = lp1 + lp2
+    assert aggregate.lttb(rows, 100) == rows
+    sampled = aggregate.lttb(rows, 5)
+    assert len(sampled) == 5
+    assert sampled[0] == rows[0] and sampled[-1] == rows[-1]
+    assert any(row[1] is None for row in sampled[1:-1])
+    report = AggregateReport(utility="x", points=100)
+    assert aggregate.summarize(rows, report) == rows
+
+
+def test_summarize_applies_steps_in_order():
+    report = AggregateReport(utility="x", bucket="week", rolling=2, points=3)
+    assert aggregate.summarize(ROWS, report) == [
+        ("2022-02-21", 1.0, None),
+        ("2022-02-28", 2.0, 3.0),
+        ("2022-03-07", 5.5, 3.0),
+    ]
@@ -0,0 +1,466 @@
+import asyncio
+from datetime import date, timedelta
+from email.utils import parsedate_to_datetime
+import json
+import os
+from pathlib import Path
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from typing import List
+
+import fastapi
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+import pytest
+import requests
+
+from api import data_api
+from api.data_api import API_ROOT
+from models.report import BatchReport, Report
+from services import (
+    cache,
+    db,
+    db_async,
+    encoding,
+    pool,
+    queries,
+    replica,
+    snapshot,
+    trends,
+)
+from test.records import RECORDS, record
+
+
+@pytest.fixture
+def db_file(tmp_path) -> str:
+    path = str(tmp_path / "wastewater.db")
+    con = sqlite3.connect(path)
+    con.execute('CREATE TABLE latest("Date", "Utility")')
+    con.execute("INSERT INTO latest VALUES ('2022-03-16', 'Arapahoe County')")
+    con.commit()
+    con.close()
+    return path
+
+
+def test_pool_connections_are_read_only(db_file):
+    conn_pool = pool.ConnectionPool(db_file, size=2)
+    with conn_pool.connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM latest")
+    conn_pool.close()
+
+
+def test_pool_is_bounded(db_file):
+    conn_pool = pool.ConnectionPool(db_file, size=2, timeout=0.01)
+    first, second = conn_pool.acquire(), conn_pool.acquire()
+    with pytest.raises(pool.PoolExhausted):
+        conn_pool.acquire()
+    conn_pool.release(first)
+    assert conn_pool.acquire() is first
+    conn_pool.release(first)
+    conn_pool.release(second)
+    conn_pool.close()
+
+
+def test_pool_notifies_on_new_generation(db_file):
+    conn_pool = pool.ConnectionPool(db_file, size=1)
+    seen = []
+    conn_pool.add_listener(seen.append)
+    assert conn_pool.generation == 0
+
+    writer = sqlite3.connect(db_file)
+    generation = db.publish_generation(writer)
+    writer.close()
+
+    with conn_pool.connection():
+        pass
+    assert seen == [generation]
+    assert conn_pool.generation == generation
+    conn_pool.close()
+
+
+def test_async_connections_wait_without_exhausting_pool(db_file):
+    conn_pool = pool.ConnectionPool(db_file, size=2, timeout=0.5)
+
+    async def query():
+        async with db_async.connection(conn_pool) as conn:
+            return await db_async.run(
+                lambda: conn.execute("SELECT count(*) FROM latest").fetchone()
+            )
+
+    async def burst():
+        return await asyncio.gather(*(query() for _ in range(50)))
+
+    assert asyncio.run(burst()) == [(1,)] * 50
+    conn_pool.close()
+
+
+@pytest.fixture
+def samples_db_file(tmp_path) -> str:
+    path = str(tmp_path / "samples.db")
+    con = sqlite3.connect(path)
+    cols = ",".join(db.double_quote(col) for col in [db.DATE_COL, db.UTILITY_COL, *db.SAMPLES_COLS])
+    con.execute(f"CREATE TABLE latest({cols})")
+    con.executemany(
+        "INSERT INTO latest VALUES (?, ?, ?, ?)",
+        [
+            ("2022-03-19", "Arapahoe County", 5.0, None),
+            ("2022-03-16", "Arapahoe County", 1.0, 2.0),
+            ("2022-03-17", "Arapahoe County", None, None),
+            ("2022-03-17", "Boulder", 7.5, None),
+            ("2023-01-01", "Boulder", 8.5, 1.5),
+            # the portal has rows without a utility
+            ("2022-03-18", None, 3.0, None),
+        ],
+    )
+    con.commit()
+    db.create_indexes(con)
+    db.build_utilities_table(con)
+    con.close()
+    return path
+
+
+@pytest.mark.parametrize(
+    "report",
+    [
+        Report(utility="Arapahoe County", start="2022-03-01", end="2022-03-31"),
+        Report(utility="Arapahoe County", start="2022-03-17", end="2022-03-17"),
+        Report(utility="Boulder", start="2022-03-18", end="2023-01-01"),
+        Report(utility="Boulder", start="2024-01-01", end="2024-02-01"),
+        Report(utility="Nowhere", start="2022-01-01", end="2024-01-01"),
+    ],
+)
+def test_snapshot_matches_sqlite(samples_db_file, report):
+    conn = sqlite3.connect(samples_db_file)
+    snap = snapshot.load(conn)
+    assert snap.get_utilities() == db.get_utilities(conn)
+    assert snap.get_samples(report) == db.get_samples(conn, report)
+    conn.close()
+
+
+@pytest.mark.parametrize(
+    "report",
+    [
+        BatchReport(start="2022-03-01", end="2023-12-31"),
+        BatchReport(utilities=["Boulder", "Arapahoe County"], start="2022-03-17", end="2023-01-01"),
+        BatchReport(utilities=["Nowhere"], start="2022-01-01", end="2024-01-01"),
+    ],
+)
+def test_batch_samples_match_snapshot(samples_db_file, report):
+    # like pooled connections, used from the db executor's threads
+    conn = sqlite3.connect(samples_db_file, check_same_thread=False)
+
+    async def collect(source) -> list:
+        chunks = db_async.iter_batch_samples(source, report, fetch_size=2)
+        return [row async for chunk in chunks for row in chunk]
+
+    rows = asyncio.run(collect(conn))
+    assert rows == asyncio.run(collect(snapshot.load(conn)))
+    assert rows == sorted(rows, key=lambda row: row[:2])
+    conn.close()
+
+
+def test_snapshot_reloads_on_new_generation(samples_db_file):
+    conn_pool = pool.ConnectionPool(samples_db_file, size=1)
+    snapshot.clear()
+    first = snapshot.get_snapshot(conn_pool)
+    assert snapshot.get_snapshot(conn_pool) is first
+
+    writer = sqlite3.connect(samples_db_file)
+    writer.execute("INSERT INTO latest VALUES ('2023-01-02', 'Boulder', 1.0, 1.0)")
+    writer.commit()
+    db.publish_generation(writer)
+    writer.close()
+
+    second = snapshot.get_snapshot(conn_pool)
+    assert second is not first
+    assert len(second) == len(first) + 1
+    snapshot.clear()
+    conn_pool.close()
+
+
+def test_response_cache_is_lru_and_generation_tagged():
+    response_cache = cache.ResponseCache(maxsize=2)
+    first = response_cache.put("a", 1, b"[1]")
+    response_cache.put("b", 1, b"[2]")
+    assert response_cache.get("a", 1) == first
+    response_cache.put("c", 1, b"[3]")
+    # "b" was least recently used
+    assert response_cache.get("b", 1) is None
+    assert response_cache.get("a", 2) is None
+    assert first.last_modified == "Thu, 01 Jan 1970 00:00:01 GMT"
+
+
+def test_trend_summary():
+    # readings double halfway through four weeks
+    readings = [(f"2022-03-{d:02d}", 10.0 if d <= 14 else 20.0) for d in range(1, 29)]
+    readings.insert(3, ("2022-03-03", None))
+    summary = dict(zip(trends.SUMMARY_COLS, trends.summarize(readings)))
+    assert summary["latest_date"] == "2022-03-28"
+    assert summary["latest_value"] == 20.0
+    assert summary["mean_7d"] == 20.0
+    assert summary["change_7d"] == 0.0
+    assert summary["change_14d"] == 100.0
+    # no earlier readings to compare the 30 day window with
+    assert summary["change_30d"] is None
+    assert summary["percentile"] == 100.0
+    assert summary["trend"] == "up"
+    assert trends.summarize([("2022-03-01", None)]) == (None,) * len(trends.SUMMARY_COLS)
+
+
+def test_content_negotiation():
+    assert encoding.parse_header("gzip;q=0.5, br, *;q=0") == [
+        ("br", 1.0),
+        ("gzip", 0.5),
+        ("*", 0.0),
+    ]
+    rep = encoding.negotiate("text/html, application/json;q=0.9", "gzip, deflate")
+    assert rep == encoding.Representation(encoding.JSON, "gzip")
+    rep = encoding.negotiate(None, None, fmt="columnar")
+    assert rep == encoding.Representation(encoding.COLUMNAR_JSON, None)
+    with pytest.raises(encoding.NotAcceptable):
+        encoding.negotiate(encoding.COLUMNAR_JSON, None, tabular=False)
+    with pytest.raises(encoding.NotAcceptable):
+        encoding.negotiate("application/json;q=0", None)
+
+
+def test_slow_query_log(samples_db_file, monkeypatch, caplog):
+    conn = sqlite3.connect(samples_db_file)
+    report = Report(utility="Boulder", start="2022-03-01", end="2023-12-31")
+    fast = db.get_samples(conn, report)
+    # any query is slower than this
+    monkeypatch.setattr(db, "SLOW_QUERY_MS", 1e-9)
+    with caplog.at_level("WARNING", logger=db.logger.name):
+        assert db.get_samples(conn, report) == fast
+    (record,) = caplog.records
+    assert "Slow query samples" in record.getMessage()
+    # the plan shows the covering index is used
+    assert db.SAMPLES_INDEX in record.getMessage()
+    conn.close()
+
+
+def test_samples_statements_are_reused(samples_db_file):
+    boulder = db.samples_query(Report(utility="Boulder", start="2022-03-01", end="2023-12-31"))
+    arapahoe = db.samples_query(Report(utility="Arapahoe County", start="2022-03-17"))
+    # only the parameters differ, so the connection prepares the statement once
+    assert boulder[0] == arapahoe[0]
+    assert boulder[1] == ("Boulder", "2022-03-01", "2023-12-31")
+
+    conn = sqlite3.connect(samples_db_file)
+    # values are bound, never spliced into the SQL
+    hostile = Report(utility="Boulder' OR '1'='1", start="2022-01-01", end="2024-01-01")
+    assert db.get_samples(conn, hostile) == []
+    conn.close()
+
+    with pytest.raises(ValueError):
+        queries.SamplesQuery(utilities=()).build()
+
+
+def test_preload_shares_snapshot_and_utilities(loaded_db, monkeypatch):
+    monkeypatch.setattr(data_api, "DB_URI", loaded_db)
+    monkeypatch.setattr(data_api, "SERVING_MODE", "snapshot")
+    snapshot.clear()
+    data_api.response_cache.clear()
+    # as gunicorn's master does before forking workers
+    data_api.preload()
+    conn_pool = pool.ConnectionPool(loaded_db, size=1)
+    preloaded = snapshot.get_snapshot(conn_pool)
+    assert preloaded.get_utilities() == ["Arapahoe County", "Boulder"]
+    # a worker finds it fresh rather than loading its own
+    assert snapshot.get_snapshot(conn_pool) is preloaded
+    conn = sqlite3.connect(loaded_db)
+    rep = encoding.Representation(encoding.JSON)
+    cached = data_api.get_cached(("utilities",), db.get_generation(conn), rep)
+    assert json.loads(cached.body) == {"utilities": ["Arapahoe County", "Boulder"]}
+    conn.close()
+    conn_pool.close()
+    snapshot.clear()
+    data_api.response_cache.clear()
+
+
+def test_workers_refresh_caches_on_new_generation(loaded_db, monkeypatch):
+    from tools.update_data import update_db
+
+    monkeypatch.setattr(data_api, "DB_URI", loaded_db)
+    monkeypatch.setattr(data_api, "SERVING_MODE", "snapshot")
+    pool.close_pool()
+    snapshot.clear()
+    app = fastapi.FastAPI()
+    app.include_router(data_api.router)
+    with TestClient(app) as client:
+        assert client.get(f"{API_ROOT}/utilities").json() == {
+            "utilities": ["Arapahoe County", "Boulder"]
+        }
+        assert len(data_api.response_cache) > 0
+        update_db(RECORDS + [record("2022-03-16", "Denver")], database=loaded_db)
+        # what each worker's scheduler does every WATCH_INTERVAL
+        client.portal.call(data_api.refresh_caches)
+        assert len(data_api.response_cache) == 0
+        conn_pool = pool.get_pool()
+        assert snapshot.is_fresh(conn_pool)
+        assert snapshot.get_snapshot(conn_pool).get_utilities() == [
+            "Arapahoe County",
+            "Boulder",
+            "Denver",
+        ]
+    pool.close_pool()
+    snapshot.clear()
+
+
+def free_ports(n: int) -> List[int]:
+    # all bound at once, so they're distinct
+    sockets = [socket.socket() for _ in range(n)]
+    try:
+        for sock in sockets:
+            sock.bind(("127.0.0.1", 0))
+        return [sock.getsockname()[1] for sock in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+def test_replicas_serve_whole_generations_and_converge(loaded_db, tmp_path):
+    from tools.update_data import update_db
+
+    publish_dir = str(tmp_path / "snapshots")
+    with sqlite3.connect(loaded_db) as conn:
+        first = replica.publish(conn, publish_dir)
+    conn.close()
+    # a snapshot that doesn't match its manifest is never served
+    tampered = tmp_path / "tampered"
+    tampered.mkdir()
+    (tampered / replica.CURRENT).write_text(json.dumps({**first, "sha256": "0" * 64}))
+    (tampered / first["file"]).write_bytes(Path(publish_dir, first["file"]).read_bytes())
+    with pytest.raises(replica.ReplicaError):
+        replica.pull(str(tampered), str(tmp_path / "bad_replica"))
+    assert replica.read_current(str(tmp_path / "bad_replica")) is None
+
+    # two API nodes, each with its own replica dir and refresh leader
+    repo_root = Path(__file__).resolve().parent.parent
+    ports = free_ports(2)
+    nodes = []
+    for i, port in enumerate(ports):
+        env = {
+            **os.environ,
+            "WASTEWATER_REPLICA_SOURCE": publish_dir,
+            "WASTEWATER_REPLICA_DIR": str(tmp_path / f"replica{i}"),
+            "WASTEWATER_REFRESH_LOCK": str(tmp_path / f"refresh{i}.lock"),
+            "WASTEWATER_REFRESH_INTERVAL": "1",
+            "WASTEWATER_WATCH_INTERVAL": "0.2",
+        }
+        command = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)]
+        nodes.append(subprocess.Popen(command, cwd=repo_root, env=env, stderr=subprocess.DEVNULL))
+    first_utilities = ["Arapahoe County", "Boulder"]
+    second_utilities = first_utilities + ["Denver"]
+    seen = {port: [] for port in ports}
+
+    def get(port: int) -> None:
+        response = requests.get(f"http://127.0.0.1:{port}{API_ROOT}/utilities", timeout=5)
+        generation = int(parsedate_to_datetime(response.headers["last-modified"]).timestamp())
+        seen[port].append((generation, response.json()["utilities"]))
+
+    try:
+        deadline = time.monotonic() + 30
+        for port in ports:
+            while True:
+                try:
+                    get(port)
+                    break
+                except requests.ConnectionError:
+                    assert time.monotonic() < deadline, "node did not start"
+                    time.sleep(0.1)
+
+        update_db(RECORDS + [record("2022-03-16", "Denver")], database=loaded_db)
+        with sqlite3.connect(loaded_db) as conn:
+            second = replica.publish(conn, publish_dir)
+        conn.close()
+        assert second["generation"] > first["generation"]
+        deadline = time.monotonic() + 30
+        while not all(seen[port][-1][0] == second["generation"] for port in ports):
+            assert time.monotonic() < deadline, "replicas did not pick up the new generation"
+            for port in ports:
+                get(port)
+    finally:
+        for node in nodes:
+            node.terminate()
+            node.wait(timeout=10)
+
+    expected = {first["generation"]: first_utilities, second["generation"]: second_utilities}
+    for port in ports:
+        generations = [generation for generation, _ in seen[port]]
+        # every response comes from one whole generation, and a node never goes back to an older one
+        assert all(utilities == expected[generation] for generation, utilities in seen[port])
+        assert generations == sorted(generations)
+        assert generations[0] == first["generation"]
+    for i in range(2):
+        assert replica.read_current(str(tmp_path / f"replica{i}")) == second
+
+
+def test_identical_concurrent_requests_share_one_query(loaded_db, monkeypatch):
+    from tools.update_data import update_db
+
+    burst_size = 8
+    days = [date.today() - timedelta(days=d) for d in range(10)]
+    update_db([record(day.isoformat(), Report().utility) for day in days], database=loaded_db)
+    pool.close_pool()
+    # fewer connections than requests: waiting for the shared query must not hold one
+    pool.init_pool(loaded_db, size=2)
+    data_api.response_cache.clear()
+    app = fastapi.FastAPI()
+    app.include_router(data_api.router)
+    statements, release = [], threading.Event()
+    get_samples = db.get_samples
+
+    def held_get_samples(conn: sqlite3.Connection, report: Report) -> List[str]:
+        # what the db actually runs, once every request of the burst has arrived
+        assert release.wait(timeout=10)
+        conn.set_trace_callback(statements.append)
+        try:
+            return get_samples(conn, report)
+        finally:
+            conn.set_trace_callback(None)
+
+    monkeypatch.setattr(db, "get_samples", held_get_samples)
+
+    def coalesced(role: str) -> float:
+        labels = {"endpoint": "samples", "role": role}
+        return REGISTRY.get_sample_value("wastewater_singleflight_requests_total", labels) or 0
+
+    with TestClient(app) as client:
+        for burst in range(2):
+            if burst:
+                # a new generation clears the cache: the next burst misses it all at once
+                update_db(
+                    [record(day.isoformat(), Report().utility, 2.0) for day in days], loaded_db
+                )
+            statements.clear()
+            release.clear()
+            leaders, followers = coalesced("leader"), coalesced("follower")
+            responses = []
+            # the frontend's default report, requested by many users at once
+            readers = [
+                threading.Thread(target=lambda: responses.append(client.get(f"{API_ROOT}/samples")))
+                for _ in range(burst_size)
+            ]
+            for reader in readers:
+                reader.start()
+            deadline = time.monotonic() + 10
+            while coalesced("follower") - followers < burst_size - 1:
+                assert time.monotonic() < deadline, "requests were not coalesced"
+                time.sleep(0.01)
+            release.set()
+            for reader in readers:
+                reader.join()
+
+            assert [r.status_code for r in responses] == [200] * burst_size
+            assert len({r.content for r in responses}) == 1
+            assert len(responses[0].json()["samples"]) == len(days)
+            assert len(statements) == 1 and statements[0].lstrip().startswith("SELECT")
+            assert coalesced("leader") - leaders == 1
+            assert len(data_api.inflight) == 0
+    pool.close_pool()
@@ -1,11 +1,23 @@
+from contextlib import asynccontextmanager
 from datetime import date, timedelta
+import json
+from pathlib import Path
+import re
 import sqlite3
+from typing import Iterator
 
+import fastapi
 from fastapi.testclient import TestClient
+import pytest
 
 from main import app, configure_logging
-from api.data_api import get_db_conn, API_ROOT
+from api import data_api
+from api.data_api import get_data_source_opener, get_db_conn, API_ROOT
+from models import report
 from models.observation import CdpheObservation
+from services import db, encoding, export, pool
+from test.records import RECORDS, latest_rows, record
+from tools.update_data import merge_db, update_db
 
 DEFAULT_UTILITY = "Metro WW - Platte/Central"
 
@@ -45,14 +57,23 @@ def override_db_conn() -> sqlite3.Connection:
     table_create_stmt = f"CREATE TABLE {table_and_cols}"
     insert_stmt = f"INSERT INTO {table_and_cols} VALUES (?, ?, ?, ?, ?)"
 
-    con: sqlite3.Connection = sqlite3.connect(":memory:")
+    con: sqlite3.Connection = sqlite3.connect(":memory:", check_same_thread=False)
     con.execute(table_create_stmt)
     con.executemany(insert_stmt, test_data)
+    db.create_indexes(con)
+    db.build_utilities_table(con)
+    db.build_summary_table(con)
     logger.debug("created and loaded test db")
     return con
 
 
+@asynccontextmanager
+async def open_test_db():
+    yield override_db_conn()
+
+
 app.dependency_overrides[get_db_conn] = override_db_conn
+app.dependency_overrides[get_data_source_opener] = lambda: open_test_db
 client = TestClient(app)
 
 
@@ -83,6 +104,22 @@ def test_samples_default():
     assert len(resp_json["samples"]) == 2
 
 
+def test_default_windows_move_with_the_date(monkeypatch):
+    class Tomorrow(date):
+        @classmethod
+        def today(cls):
+            return date.today() + timedelta(days=1)
+
+    # the app (and its models) was imported, and would be preloaded, a day earlier
+    monkeypatch.setattr(report, "date", Tomorrow)
+    parameters = client.get(f"{API_ROOT}/samples").json()["parameters"]
+    tomorrow = date.today() + timedelta(days=1)
+    assert parameters["end"] == tomorrow.isoformat()
+    assert parameters["start"] == (tomorrow - timedelta(days=30)).isoformat()
+    batch = client.get(f"{API_ROOT}/samples/batch").json()["parameters"]
+    assert (batch["start"], batch["end"]) == (parameters["start"], parameters["end"])
+
+
 def test_samples_start():
     start = "2022-12-01"
     query_path = f"{API_ROOT}/samples?start={start}"
@@ -124,3 +161,260 @@ def test_samples_all():
     assert resp_json["samples"][0][0] >= start
     assert resp_json["samples"][-1][0] <= end
     assert len(resp_json["samples"]) == 3
+
+
+def test_samples_etag():
+    query_path = f"{API_ROOT}/samples?utility=Arapahoe County&start=2022-03-01&end=2022-03-20"
+    resp = client.get(query_path)
+    assert resp.status_code == 200
+    etag = resp.headers["etag"]
+    assert etag.startswith('"') and etag.endswith('"')
+
+    resp = client.get(query_path, headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.headers["etag"] == etag
+    assert resp.content == b""
+
+    other = client.get(f"{API_ROOT}/samples?utility=Arapahoe County&start=2022-03-17")
+    assert other.status_code == 200
+    assert other.headers["etag"] != etag
+
+
+def test_utilities_if_none_match_mismatch():
+    resp = client.get(f"{API_ROOT}/utilities", headers={"If-None-Match": '"stale"'})
+    assert resp.status_code == 200
+    assert len(resp.json()["utilities"]) == 2
+
+
+def test_samples_aggregate_weekly():
+    params = "utility=Arapahoe County&start=2022-03-01&end=2022-03-20&bucket=week&stat=max"
+    resp = client.get(f"{API_ROOT}/samples/aggregate?{params}")
+    assert resp.status_code == 200
+
+    resp_json = resp.json()
+    assert resp_json["parameters"]["bucket"] == "week"
+    # 2022-03-16, -17 and -19 all fall in the week starting Monday 2022-03-14
+    assert resp_json["samples"] == [["2022-03-14", 0, 5]]
+
+
+def test_samples_aggregate_validates_parameters():
+    resp = client.get(f"{API_ROOT}/samples/aggregate?points=2")
+    assert resp.status_code == 422
+    resp = client.get(f"{API_ROOT}/samples/aggregate?bucket=year")
+    assert resp.status_code == 422
+
+
+def test_summary():
+    resp = client.get(f"{API_ROOT}/summary")
+    assert resp.status_code == 200
+
+    summary = {row["Utility"]: row for row in resp.json()["summary"]}
+    assert list(summary) == ["Arapahoe County", DEFAULT_UTILITY]
+    assert summary["Arapahoe County"]["latest_date"] == "2022-03-19"
+    assert summary["Arapahoe County"]["latest_value"] == 0
+    assert summary[DEFAULT_UTILITY]["latest_date"] == date.today().isoformat()
+
+
+def test_samples_batch():
+    query_path = f"{API_ROOT}/samples/batch?utility=Arapahoe County&utility={DEFAULT_UTILITY}"
+    resp = client.get(f"{query_path}&start=2022-03-17")
+    assert resp.status_code == 200
+
+    resp_json = resp.json()
+    assert resp_json["parameters"]["utilities"] == ["Arapahoe County", DEFAULT_UTILITY]
+    assert list(resp_json["samples"]) == ["Arapahoe County", DEFAULT_UTILITY]
+    assert [row[0] for row in resp_json["samples"]["Arapahoe County"]] == [
+        "2022-03-17",
+        "2022-03-19",
+    ]
+    assert len(resp_json["samples"][DEFAULT_UTILITY]) == 2
+
+
+def test_samples_batch_streams_same_document():
+    for params in ["start=2022-01-01", "start=2022-03-17&utility=Boulder", "start=2050-01-01"]:
+        buffered = client.get(f"{API_ROOT}/samples/batch?{params}")
+        streamed = client.get(f"{API_ROOT}/samples/batch?{params}&stream=true")
+        assert streamed.status_code == 200
+        if buffered.status_code == 200:
+            assert streamed.json() == buffered.json()
+        else:
+            # nothing matched
+            assert streamed.json()["samples"] == {}
+    # the other formats aren't streamed, rather than silently answered with JSON
+    resp = client.get(f"{API_ROOT}/samples/batch?stream=true&format=columnar")
+    assert resp.status_code == 406
+    resp = client.get(
+        f"{API_ROOT}/samples/batch?stream=true", headers={"Accept": encoding.COLUMNAR_JSON}
+    )
+    assert resp.status_code == 406
+
+
+def test_samples_columnar_format():
+    query_path = f"{API_ROOT}/samples?utility=Arapahoe County&start=2022-03-01&end=2022-03-20"
+    resp = client.get(f"{query_path}&format=columnar")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == encoding.COLUMNAR_JSON
+
+    columns = resp.json()["samples"]
+    assert columns[CdpheObservation.DATE.value] == ["2022-03-16", "2022-03-17", "2022-03-19"]
+    assert columns[CdpheObservation.COPIES_LP1.value] == [1, 3, 5]
+    # same content negotiated through the Accept header
+    resp = client.get(query_path, headers={"Accept": f"{encoding.COLUMNAR_JSON}, */*;q=0.1"})
+    assert resp.json()["samples"] == columns
+
+
+def test_samples_arrow_format():
+    pyarrow = pytest.importorskip("pyarrow")
+    query_path = f"{API_ROOT}/samples?utility=Arapahoe County&start=2022-03-01&end=2022-03-20"
+    resp = client.get(query_path, headers={"Accept": encoding.ARROW})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == encoding.ARROW
+
+    table = pyarrow.ipc.open_stream(resp.content).read_all()
+    assert table.column(CdpheObservation.DATE.value).to_pylist()[0] == "2022-03-16"
+    assert json.loads(table.schema.metadata[b"parameters"])["utility"] == "Arapahoe County"
+
+
+def test_samples_not_acceptable():
+    resp = client.get(f"{API_ROOT}/samples", headers={"Accept": "text/csv"})
+    assert resp.status_code == 406
+    resp = client.get(f"{API_ROOT}/samples?format=xml")
+    assert resp.status_code == 422
+
+
+def test_compressed_responses(monkeypatch):
+    monkeypatch.setattr(encoding, "MIN_COMPRESS_BYTES", 0)
+    query_path = f"{API_ROOT}/samples?utility=Arapahoe County&start=2022-03-01&end=2022-03-18"
+    plain = client.get(query_path, headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+
+    resp = client.get(query_path, headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in resp.headers["vary"]
+    assert resp.headers["etag"] != plain.headers["etag"]
+    # the test client decodes it
+    assert resp.json() == plain.json()
+
+
+def test_metrics():
+    resp = client.get(f"{API_ROOT}/samples?utility=Arapahoe County&start=2022-03-02&end=2022-03-18")
+    assert resp.status_code == 200
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    body = resp.text
+    assert 'wastewater_db_query_seconds_count{query="samples",stage="execute"}' in body
+    assert "wastewater_db_acquire_seconds_count" in body
+    assert 'wastewater_serialize_seconds_count{endpoint="samples"' in body
+
+
+@pytest.fixture
+def export_client(loaded_db, monkeypatch) -> Iterator[TestClient]:
+    # exports open their own connection to the db file, so they need a real one
+    monkeypatch.setattr(data_api, "DB_URI", loaded_db)
+    monkeypatch.setattr(export, "BATCH_ROWS", 2)
+    export_app = fastapi.FastAPI()
+    export_app.include_router(data_api.router)
+    pool.close_pool()
+    # startup opens the worker's pool, which exports take their db from
+    with TestClient(export_app) as client:
+        yield client
+    pool.close_pool()
+
+
+def test_export_streams_tables_with_resume(loaded_db, export_client):
+    # a dated copy of `latest`, as full loads used to leave behind
+    conn = sqlite3.connect(loaded_db)
+    conn.execute('CREATE TABLE "2022-03-20" AS SELECT * FROM latest')
+    conn.commit()
+    conn.close()
+    update_db(RECORDS[:2], database=loaded_db)
+    client = export_client
+
+    assert client.get(f"{API_ROOT}/export/tables").json()["tables"] == ["latest", "2022-03-20"]
+    resp = client.get(f"{API_ROOT}/export?table=2022-03-20")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/csv")
+    lines = resp.text.splitlines()
+    assert lines[0].split(",")[:2] == ["Date", "Utility"]
+    assert [line.split(",")[:2] for line in lines[1:]] == [
+        ["2022-03-16", "Arapahoe County"],
+        ["2022-03-17", "Arapahoe County"],
+        ["2022-03-16", "Boulder"],
+    ]
+
+    # resuming after the first row: no header, the remaining rows
+    tag = resp.headers["etag"]
+    resume = {"Range": "rows=1-", "If-Range": tag}
+    resp = client.get(f"{API_ROOT}/export?table=2022-03-20", headers=resume)
+    assert resp.status_code == 206
+    assert resp.headers["content-range"] == "rows 1-2/3"
+    assert resp.text.splitlines() == lines[2:]
+
+    tag = client.get(f"{API_ROOT}/export?format=ndjson").headers["etag"]
+    resp = client.get(
+        f"{API_ROOT}/export?format=ndjson", headers={"Range": "rows=1-1", "If-Range": tag}
+    )
+    assert [json.loads(line)["Date"] for line in resp.text.splitlines()] == ["2022-03-17"]
+    resp = client.get(f"{API_ROOT}/export", headers={"Range": "rows=5-", "If-Range": tag})
+    assert resp.status_code == 416
+    assert resp.headers["content-range"] == "rows */2"
+    for table in ["sqlite_master", "utilities", "latest; DROP TABLE latest"]:
+        assert client.get(f"{API_ROOT}/export?table={table}").status_code == 404
+
+
+def test_export_resumes_only_the_same_generation(loaded_db, export_client):
+    client = export_client
+    first = client.get(f"{API_ROOT}/export")
+    tag = first.headers["etag"]
+    # a range without a validator could splice rows from two generations
+    assert client.get(f"{API_ROOT}/export", headers={"Range": "rows=1-"}).status_code == 428
+
+    # a new load replaces `latest` between the first request and the resume
+    update_db([record("2022-03-15", "Denver")] + RECORDS, database=loaded_db)
+    resp = client.get(f"{API_ROOT}/export", headers={"Range": "rows=1-", "If-Range": tag})
+    assert resp.status_code == 200
+    assert resp.headers["etag"] != tag
+    assert "content-range" not in resp.headers
+    assert len(resp.text.splitlines()) == len(RECORDS) + 2
+
+
+def test_export_rebuilds_past_generations(loaded_db, export_client):
+    first = db.get_generation(sqlite3.connect(loaded_db))
+    first_rows = latest_rows(loaded_db)
+    # a full load that drops a row, and a merge that adds one
+    update_db(RECORDS[1:], database=loaded_db)
+    merge_db([record("2022-03-18", "Denver")], database=loaded_db)
+    client = export_client
+
+    generations = client.get(f"{API_ROOT}/export/tables").json()["generations"]
+    assert len(generations) == 3 and generations[0] == first
+    resp = client.get(f"{API_ROOT}/export?generation={first}&format=ndjson")
+    assert resp.status_code == 200
+    assert resp.headers["content-disposition"] == f'attachment; filename="latest-{first}.ndjson"'
+    exported = [tuple(json.loads(line).values()) for line in resp.text.splitlines()]
+    assert sorted(exported, key=repr) == first_rows
+    # resumable like `latest`, with its own validator
+    tag = resp.headers["etag"]
+    assert tag != client.get(f"{API_ROOT}/export").headers["etag"]
+    resp = client.get(
+        f"{API_ROOT}/export?generation={first}&format=ndjson",
+        headers={"Range": "rows=1-", "If-Range": tag},
+    )
+    assert resp.status_code == 206
+    assert resp.headers["content-range"] == f"rows 1-{len(first_rows) - 1}/{len(first_rows)}"
+    assert [tuple(json.loads(line).values()) for line in resp.text.splitlines()] == exported[1:]
+    for params in [f"generation={first - 1}", f"table=utilities&generation={first}"]:
+        assert client.get(f"{API_ROOT}/export?{params}").status_code == 404
+
+
+def test_nginx_passes_export_ranges_upstream():
+    # nginx doesn't forward Range (or If-Range) to a cached upstream, it would answer every
+    # resume with the whole table: exports need their own, uncached location
+    config = (Path(__file__).parent.parent / "server" / "nginx" / "wastewater.nginx").read_text()
+    location = re.search(r"location /api/v1/export \{(.*?)\}", config, re.DOTALL)
+    assert location is not None
+    directives = [line.strip() for line in location.group(1).splitlines()]
+    assert "proxy_cache off;" in directives
+    assert "proxy_buffering off;" in directives
+    assert "proxy_pass http://127.0.0.1:8888;" in directives
@@ -0,0 +1,616 @@
+import asyncio
+import csv
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from pathlib import Path
+import sqlite3
+import subprocess
+import sys
+import threading
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from dateutil import parser as date_parser
+import fastapi
+from fastapi.testclient import TestClient
+import pytest
+from sqlite_utils import Database
+
+from api import data_api
+from api.data_api import API_ROOT
+from models.observation import CdpheObservation
+from models.report import Report
+from services import (
+    archive,
+    db,
+    export,
+    history,
+    ingests,
+    pool,
+    queries,
+    scheduler,
+)
+from test.records import RECORDS, UTILITIES, latest_rows, record
+from tools import archive as archive_tool
+from tools import update_data
+from tools.update_data import (
+    merge_db,
+    read_json_file,
+    transform_raw_csv_data,
+    transform_raw_json_pages,
+    update_db,
+)
+
+
+def query_plan(conn: sqlite3.Connection, query: str, params: tuple = ()) -> str:
+    # one line per plan node, e.g. "SEARCH latest USING COVERING INDEX ..."
+    return "\n".join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params))
+
+
+def test_update_db_loads_and_indexes(loaded_db):
+    conn = sqlite3.connect(loaded_db)
+    assert db.get_utilities(conn) == ["Arapahoe County", "Boulder"]
+    report = Report(utility="Arapahoe County", start="2022-03-01", end="2022-03-31")
+    assert [row[0] for row in db.get_samples(conn, report)] == ["2022-03-16", "2022-03-17"]
+    assert db.get_generation(conn) > 0
+
+
+def test_dates_are_stored_as_iso_text(loaded_db):
+    conn = sqlite3.connect(loaded_db)
+    date_col = db.double_quote(db.DATE_COL)
+    types = conn.execute(f"SELECT DISTINCT typeof({date_col}) FROM latest").fetchall()
+    assert types == [("text",)]
+
+
+@pytest.mark.parametrize(
+    "raw_dt", ["2022/03/16 00:00:00+00", "2022/03/16 12:00:00", "03/16/2022 12:00:00 AM"]
+)
+def test_csv_dates_match_epoch_ms_conversion(raw_dt):
+    # the fast path and the dateutil fallback both agree with the json path's epoch ms dates
+    epoch_ms = int(date_parser.parse(raw_dt).timestamp() * 1000.0)
+    # DictReader row: every value is a string
+    row = {k: "" if v is None else str(v) for k, v in record("2022-03-16", "Boulder").items()}
+    row.update({CdpheObservation.DATE.value: raw_dt, CdpheObservation.OBJECTID.value: "1"})
+    expected = update_data.epoch_ms_to_iso(epoch_ms)
+    assert transform_raw_csv_data(row)[CdpheObservation.DATE.value] == expected
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_csv_batches_load_like_json_records(tmp_path, workers):
+    # quoted values, including one spanning lines, must not be split across batches
+    utilities = ["Boulder", 'Metro WW - "Platte", Central', "Line\nbreak"]
+    records = [record(f"2022-03-{day}", u, 1.5) for day in range(10, 20) for u in utilities]
+    records[4][CdpheObservation.COPIES_LP2.value] = None
+    cols = [CdpheObservation.OBJECTID.value] + update_data.STAGING_COLS
+    data_file = tmp_path / "2022-03-20_download.csv"
+    with data_file.open("w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(cols)
+        for i, r in enumerate(records):
+            day = update_data.epoch_ms_to_iso(r[CdpheObservation.DATE.value]).replace("-", "/")
+            row = {
+                **r,
+                CdpheObservation.OBJECTID.value: i,
+                CdpheObservation.DATE.value: f"{day} 00:00:00+00",
+            }
+            writer.writerow(["" if row[col] is None else row[col] for col in cols])
+    batches = list(update_data.transform_csv_file(str(data_file), workers, batch_rows=4))
+    assert len(batches) > 2
+
+    from_csv, from_json = str(tmp_path / "csv.db"), str(tmp_path / "json.db")
+    assert update_db(iter(batches), database=from_csv, load=update_data.load_staging_rows)
+    update_db(records, database=from_json)
+    query = "SELECT * FROM latest ORDER BY rowid"
+    assert (
+        sqlite3.connect(from_csv).execute(query).fetchall()
+        == sqlite3.connect(from_json).execute(query).fetchall()
+    )
+    # load pragmas are only set for the duration of the insert
+    loader = Database(from_csv)
+    synchronous = loader.execute("PRAGMA synchronous").fetchone()[0]
+    assert update_data.load_staging_rows(loader, iter(batches), "latest_staging") == len(records)
+    assert loader.execute("PRAGMA synchronous").fetchone()[0] == synchronous
+
+
+def test_samples_query_uses_covering_index(loaded_db):
+    conn = sqlite3.connect(loaded_db)
+    plan = query_plan(conn, *db.samples_query(Report(utility="Boulder")))
+    assert f"SEARCH {db.PROD_TABLE} USING COVERING INDEX {db.SAMPLES_INDEX}_" in plan
+    assert "SCAN" not in plan
+    # ORDER BY Date is satisfied by the index order
+    assert "TEMP B-TREE" not in plan
+
+
+def test_utilities_query_reads_lookup_table(loaded_db):
+    conn = sqlite3.connect(loaded_db)
+    plan = query_plan(conn, queries.UTILITIES)
+    assert f"SCAN {db.UTILITIES_TABLE}" in plan
+    assert db.PROD_TABLE not in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_update_db_reindexes_on_reload(loaded_db):
+    update_db(RECORDS + [record("2022-03-18", "Denver")], database=loaded_db)
+    conn = sqlite3.connect(loaded_db)
+    assert db.get_utilities(conn) == ["Arapahoe County", "Boulder", "Denver"]
+    indexed = conn.execute(
+        "SELECT tbl_name FROM sqlite_master WHERE type = 'index' AND name LIKE ?",
+        (f"{db.SAMPLES_INDEX}%",),
+    ).fetchall()
+    assert indexed == [(db.PROD_TABLE,)]
+
+
+def test_update_db_streams_and_keeps_latest_on_partial_load(loaded_db):
+    consumed = []
+
+    def stream():
+        for r in [record("2022-04-01", "Denver")]:
+            consumed.append(r)
+            yield r
+
+    assert not update_db(stream(), database=loaded_db, min_rows=10)
+    assert len(consumed) == 1
+    conn = sqlite3.connect(loaded_db)
+    assert db.get_utilities(conn) == ["Arapahoe County", "Boulder"]
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    assert "latest_staging" not in tables
+
+
+def test_json_pages_load_from_ndjson_backup(tmp_path):
+    pages = [
+        {"features": [{"attributes": {"OBJECTID": i, **r}} for i, r in enumerate(RECORDS[:2])]},
+        {"features": [{"attributes": {"OBJECTID": 2, **RECORDS[2]}}]},
+    ]
+    backup = tmp_path / "2022-03-20_download.ndjson"
+    backup.write_text("".join(json.dumps(page) + "\n" for page in pages))
+    records = list(transform_raw_json_pages(read_json_file(str(backup))))
+    assert records == RECORDS
+
+
+class PortalStub(BaseHTTPRequestHandler):
+    """Replays recorded portal pages; the first request for each offset in `failures` gets the
+    configured failure instead, as do the first `count_failures` record count requests"""
+
+    records: List[dict] = []
+    failures: Dict[int, str] = {}
+    requested: List[int] = []
+    count_failures = 0
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        if params.get("f") == ["pjson"]:
+            return self.metadata()
+        if params.get("returnCountOnly") == ["true"]:
+            if PortalStub.count_failures:
+                PortalStub.count_failures -= 1
+                return self.reply({"error": {"code": 500, "message": "Unable to complete"}})
+            return self.reply({"count": len(self.records)})
+        offset = int(params["resultOffset"][0])
+        count = int(params["resultRecordCount"][0])
+        self.requested.append(offset)
+        features = [{"attributes": dict(r)} for r in self.records[offset : offset + count]]
+        failure = self.failures.pop(offset, None)
+        if failure == "error":
+            self.send_response(500)
+            self.end_headers()
+            return
+        if failure == "truncate":
+            features = features[: count // 2]
+        self.reply({"features": features, "exceededTransferLimit": failure == "truncate"})
+
+    def metadata(self):
+        # layer metadata only changes with the data, so its ETag is the last edit date
+        edited = max(r[CdpheObservation.DATE.value] for r in self.records)
+        if self.headers.get("If-None-Match") == f'"{edited}"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.reply({"editingInfo": {"dataLastEditDate": edited}}, {"ETag": f'"{edited}"'})
+
+    def reply(self, body: dict, headers: Optional[Dict[str, str]] = None):
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def portal_stub(monkeypatch):
+    PortalStub.records = [
+        {"OBJECTID": i, **record("2022-01-01", f"Utility {i // 1000:02d}")} for i in range(12_345)
+    ]
+    PortalStub.requested = []
+    PortalStub.failures = {5_000: "error", 10_000: "truncate"}
+    PortalStub.count_failures = 1
+    monkeypatch.setattr(update_data.time, "sleep", lambda seconds: None)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PortalStub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/FeatureServer/1"
+    server.shutdown()
+
+
+def test_fetch_retries_failed_and_truncated_pages(portal_stub, tmp_path):
+    pages = list(
+        update_data.fetch_portal_json_data(
+            datetime(2022, 1, 2), url_root=portal_stub, workers=3, backup_dir=str(tmp_path)
+        )
+    )
+    assert [len(page["features"]) for page in pages] == [5_000, 5_000, 2_345]
+    object_ids = [f["attributes"]["OBJECTID"] for page in pages for f in page["features"]]
+    assert object_ids == list(range(12_345))
+    # one retry each for the failed and the truncated page
+    assert sorted(PortalStub.requested) == [0, 5_000, 5_000, 10_000, 10_000]
+    backup = tmp_path / "2022-01-02_download-partial.ndjson"
+    assert len(backup.read_text().splitlines()) == 3
+
+
+def test_fetch_gives_up_after_retries(portal_stub):
+    session = update_data.portal_session()
+    with pytest.raises(update_data.PortalFetchError):
+        update_data.fetch_portal_page(session, 5_000, 5_000, url_root=portal_stub, retries=0)
+    with pytest.raises(update_data.PortalFetchError):
+        update_data.fetch_portal_record_count(session, portal_stub, retries=0)
+    # nothing listening: connection errors end up as PortalFetchError too
+    with pytest.raises(update_data.PortalFetchError):
+        update_data.fetch_portal_record_count(session, "http://127.0.0.1:9/FeatureServer/1")
+
+
+def test_portal_metadata_is_polled_conditionally(portal_stub):
+    validators = {}
+    first_edit = record("2022-01-01", "Boulder")[CdpheObservation.DATE.value]
+    assert update_data.poll_portal_edit(validators, portal_stub) == first_edit
+    assert "ETag" in validators
+    assert update_data.poll_portal_edit(validators, portal_stub) is None
+    PortalStub.records.append(record("2022-01-02", "Boulder"))
+    assert update_data.poll_portal_edit(validators, portal_stub) > first_edit
+    # without validators there's always a date
+    assert update_data.get_latest_portal_update(portal_stub) == date(2022, 1, 2)
+
+
+def test_scheduler_leader_updates_on_new_portal_data(tmp_path, monkeypatch):
+    lock_path = str(tmp_path / "refresh.lock")
+    leader = scheduler.acquire_lock(lock_path)
+    assert leader is not None
+    # another worker (or any other open of the file) can't take it...
+    assert scheduler.acquire_lock(lock_path) is None
+    assert scheduler.lock_holder(lock_path) == os.getpid()
+    os.close(leader)
+    # ...until the leader is gone
+    follower = scheduler.acquire_lock(lock_path)
+    assert follower is not None
+    os.close(follower)
+    # a lock file it can't open doesn't end the leader election
+    unopenable = str(tmp_path / "missing" / "refresh.lock")
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(scheduler.lead(1, unopenable), timeout=0.2))
+
+    database = str(tmp_path / "wastewater.db")
+    update_db(RECORDS, database=database, portal_edit_ms=1_000)
+    monkeypatch.setattr(update_data, "DATABASE", database)
+    load_lock_path = str(tmp_path / "load.lock")
+    monkeypatch.setattr(scheduler, "LOAD_LOCK_PATH", load_lock_path)
+    polls = iter([1_000, None, 2_000, 2_000, 2_000, 2_000, 2_000])
+    updates, results = [], iter([False, ConnectionError("portal unreachable"), True])
+    monkeypatch.setattr(update_data, "poll_portal_edit", lambda validators: next(polls))
+    monkeypatch.setattr(update_data, "archive_downloads", lambda: None)
+
+    def update_from_portal(portal_edit_ms: int, csv_workers: int) -> bool:
+        updates.append(portal_edit_ms)
+        if isinstance(updated := next(results), Exception):
+            raise updated
+        if updated:
+            update_db(RECORDS, database=database, portal_edit_ms=portal_edit_ms)
+        return updated
+
+    monkeypatch.setattr(update_data, "update_from_portal", update_from_portal)
+    state = scheduler.RefreshState(validators={"ETag": '"1"'})
+    # nothing newer than the local data, then not modified
+    assert not scheduler.refresh(state)
+    assert not scheduler.refresh(state)
+    # a failed update forgets the validators so that the next poll retries it
+    assert not scheduler.refresh(state)
+    assert state.validators == {}
+    # and so does one that raises
+    state.validators["ETag"] = '"2"'
+    with pytest.raises(ConnectionError):
+        scheduler.refresh(state)
+    assert state.validators == {}
+    # a manual load is running: retried on the next poll
+    state.validators["ETag"] = '"2"'
+    manual_load = scheduler.acquire_lock(load_lock_path)
+    assert not scheduler.refresh(state)
+    assert state.validators == {}
+    os.close(manual_load)
+    assert scheduler.refresh(state)
+    # the manifest now has the new edit
+    assert not scheduler.refresh(state)
+    assert updates == [2_000, 2_000, 2_000]
+
+
+def test_cli_loads_only_while_no_other_load_runs(loaded_db, tmp_path):
+    lock_path, load_lock_path = str(tmp_path / "refresh.lock"), str(tmp_path / "load.lock")
+    env = {
+        **os.environ,
+        "WASTEWATER_DB": loaded_db,
+        "WASTEWATER_REFRESH_LOCK": lock_path,
+        "WASTEWATER_LOAD_LOCK": load_lock_path,
+    }
+    command = [sys.executable, "tools/update_data.py", "--reindex"]
+    repo_root = Path(__file__).resolve().parent.parent
+    generation = db.get_generation(sqlite3.connect(loaded_db))
+    # the service's refresh leader is loading
+    leader = scheduler.acquire_lock(lock_path)
+    load = scheduler.acquire_lock(load_lock_path)
+    assert subprocess.run(command, cwd=repo_root, env=env).returncode == 1
+    assert db.get_generation(sqlite3.connect(loaded_db)) == generation
+    # and done loading, though it's still the leader
+    os.close(load)
+    assert subprocess.run(command, cwd=repo_root, env=env).returncode == 0
+    assert db.get_generation(sqlite3.connect(loaded_db)) > generation
+    os.close(leader)
+
+
+def test_ingests_manifest_records_every_load(loaded_db):
+    conn = sqlite3.connect(loaded_db)
+    generation = db.get_generation(conn)
+    # identical content: recorded, but nothing is republished
+    assert update_db(list(RECORDS), database=loaded_db, portal_edit_ms=2_000)
+    assert ingests.last_ingest(conn)["status"] == ingests.UNCHANGED
+    assert db.get_generation(conn) == generation
+    assert not update_db([record("2022-04-01", "Denver")], database=loaded_db, min_rows=10)
+    assert ingests.last_ingest(conn)["status"] == ingests.PARTIAL
+
+    def broken():
+        yield record("2022-04-01", "Denver")
+        raise update_data.PortalFetchError("page 5000 failed")
+
+    with pytest.raises(update_data.PortalFetchError):
+        update_db(broken(), database=loaded_db, portal_edit_ms=3_000)
+    failed = ingests.last_ingest(conn)
+    assert failed["status"] == ingests.FAILED and "page 5000" in failed["error"]
+    assert merge_db([record("2022-03-18", "Denver")], database=loaded_db, portal_edit_ms=4_000)
+    merged = ingests.last_ingest(conn)
+    assert (merged["kind"], merged["status"], merged["row_count"]) == ("merge", ingests.OK, 1)
+    assert merged["generation"] == db.get_generation(conn) > generation
+    # only loads that left the portal's data in place count
+    assert ingests.latest_portal_edit(conn) == 4_000
+    assert [row[0] for row in conn.execute("SELECT status FROM ingests ORDER BY id")] == [
+        ingests.OK,
+        ingests.UNCHANGED,
+        ingests.PARTIAL,
+        ingests.FAILED,
+        ingests.OK,
+    ]
+    # the manifest is read from the index, not scanned
+    plan = query_plan(conn, "SELECT max(portal_edit_ms) FROM ingests WHERE status = 'ok'")
+    assert "USING COVERING INDEX" in plan
+    conn.close()
+
+
+def test_full_load_after_a_merge_is_never_unchanged(loaded_db):
+    # an --incremental run without --edit-field merges the whole download, and merges never
+    # delete: `latest` keeps a row the portal has since dropped
+    download = RECORDS[:2] + [record("2022-03-18", "Denver")]
+    assert merge_db(download, database=loaded_db) == (1, 0)
+    assert len(latest_rows(loaded_db)) == len(download) + 1
+    conn = sqlite3.connect(loaded_db)
+    generation = db.get_generation(conn)
+    # the same download as a full load does pick up the deletions
+    assert update_db(download, database=loaded_db)
+    assert ingests.last_ingest(conn)["status"] == ingests.OK
+    assert db.get_generation(conn) > generation
+    assert len(latest_rows(loaded_db)) == len(download)
+    # and then an identical full load is unchanged again
+    assert update_db(download, database=loaded_db)
+    assert ingests.last_ingest(conn)["status"] == ingests.UNCHANGED
+    conn.close()
+
+
+def test_status_reports_freshness_and_last_load(loaded_db):
+    pool.close_pool()
+    pool.init_pool(loaded_db, size=1)
+    app = fastapi.FastAPI()
+    app.include_router(data_api.router)
+    update_db(RECORDS + [record("2022-03-18", "Denver")], database=loaded_db, portal_edit_ms=0)
+    with TestClient(app) as client:
+        status = client.get(f"{API_ROOT}/status").json()
+    pool.close_pool()
+    generation = db.get_generation(sqlite3.connect(loaded_db))
+    assert status["generation"] == generation
+    assert status["latest_sample_date"] == "2022-03-18"
+    last = status["last_ingest"]
+    assert last["status"] == ingests.OK and last["row_count"] == 4
+    assert last["rows_per_s"] > 0 and last["duration_s"] > 0
+    assert last == status["last_published"]
+    assert last["generation"] == generation
+
+
+def test_merge_db_touches_only_changed_rows(loaded_db):
+    generation = db.get_generation(sqlite3.connect(loaded_db))
+    changed = record("2022-03-17", "Arapahoe County", lp2=9.0)
+    new = record("2022-03-18", "Denver")
+    inserted, updated = merge_db(RECORDS[:1] + [changed, new, RECORDS[2]], database=loaded_db)
+    assert (inserted, updated) == (1, 1)
+
+    conn = sqlite3.connect(loaded_db)
+    assert db.get_utilities(conn) == ["Arapahoe County", "Boulder", "Denver"]
+    report = Report(utility="Arapahoe County", start="2022-03-17", end="2022-03-17")
+    assert db.get_samples(conn, report) == [("2022-03-17", 9.0, None)]
+    assert conn.execute("SELECT count(*) FROM latest").fetchone()[0] == 4
+    assert db.get_generation(conn) > generation
+
+
+def test_merge_db_applies_the_last_of_duplicate_keys(loaded_db):
+    generation = db.get_generation(sqlite3.connect(loaded_db))
+    delta = [
+        record("2022-03-17", "Arapahoe County", lp2=8.0),
+        record("2022-03-18", "Denver", lp2=1.0),
+        record("2022-03-17", "Arapahoe County", lp2=9.0),
+        record("2022-03-18", "Denver", lp2=2.0),
+    ]
+    assert merge_db(delta, database=loaded_db) == (1, 1)
+
+    conn = sqlite3.connect(loaded_db)
+    report = Report(utility="Arapahoe County", start="2022-03-17", end="2022-03-17")
+    assert db.get_samples(conn, report) == [("2022-03-17", 9.0, None)]
+    report = Report(utility="Denver", start="2022-03-18", end="2022-03-18")
+    assert db.get_samples(conn, report) == [("2022-03-18", 2.0, None)]
+    assert conn.execute("SELECT count(*) FROM latest").fetchone()[0] == 4
+    # one history entry per key, so both generations rebuild to exactly what was served
+    assert len(list(history.rebuild(conn, generation))) == len(RECORDS)
+    rebuilt = sorted(history.rebuild(conn, db.get_generation(conn)), key=repr)
+    assert rebuilt == latest_rows(loaded_db)
+
+
+def test_summary_is_published_with_loads_and_merges(loaded_db):
+    conn = sqlite3.connect(loaded_db)
+    summary = {row["Utility"]: row for row in db.get_summary(conn)}
+    assert list(summary) == ["Arapahoe County", "Boulder"]
+    assert summary["Arapahoe County"]["latest_date"] == "2022-03-17"
+    assert f"{db.SUMMARY_TABLE}_staging" not in Database(conn).table_names()
+
+    merge_db([record("2022-03-18", "Boulder", lp2=4.0)], database=loaded_db)
+    summary = {row["Utility"]: row for row in db.get_summary(conn)}
+    assert (summary["Boulder"]["latest_date"], summary["Boulder"]["latest_value"]) == (
+        "2022-03-18",
+        4.0,
+    )
+    assert summary["Arapahoe County"]["latest_date"] == "2022-03-17"
+
+
+def test_merge_db_without_changes_keeps_generation(loaded_db):
+    generation = db.get_generation(sqlite3.connect(loaded_db))
+    assert merge_db(RECORDS, database=loaded_db) == (0, 0)
+    assert db.get_generation(sqlite3.connect(loaded_db)) == generation
+
+
+def test_api_serves_without_errors_during_loads(loaded_db, monkeypatch):
+    pool.close_pool()
+    pool.init_pool(loaded_db, size=4)
+    app = fastapi.FastAPI()
+    app.include_router(data_api.router)
+    statuses = []
+
+    def get(client: TestClient, seed: int):
+        # make sure requests query the db rather than the response cache
+        data_api.response_cache.clear()
+        end = f"2022-03-{seed % 16 + 16:02d}"
+        query = f"{API_ROOT}/samples?utility=Boulder&start=2022-03-01&end={end}"
+        statuses.append(client.get(query).status_code)
+        statuses.append(client.get(f"{API_ROOT}/utilities").status_code)
+
+    # one client (one event loop, as in a server worker) shared by the loader probe and readers
+    with TestClient(app, raise_server_exceptions=False) as client:
+        # deterministic part: probe the api before every statement the loader runs...
+        def traced_database(path: str) -> Database:
+            loader_db = Database(path)
+            loader_db.conn.set_trace_callback(lambda statement: get(client, len(statuses)))
+            return loader_db
+
+        monkeypatch.setattr(update_data, "Database", traced_database)
+
+        # ...and concurrent readers hammering it meanwhile
+        done = threading.Event()
+
+        def hammer(seed: int):
+            while not done.is_set():
+                get(client, seed + len(statuses))
+
+        readers = [threading.Thread(target=hammer, args=(seed,)) for seed in range(4)]
+        for reader in readers:
+            reader.start()
+        try:
+            for i in range(4):
+                records = [record(f"2022-03-{d:02d}", u) for d in range(1, 29) for u in UTILITIES]
+                assert update_db(records, database=loaded_db)
+        finally:
+            done.set()
+            for reader in readers:
+                reader.join()
+    pool.close_pool()
+
+    assert len(statuses) > 0
+    assert set(statuses) == {200}
+
+
+def test_history_rebuilds_every_generation(loaded_db, tmp_path):
+    expected = {db.get_generation(sqlite3.connect(loaded_db)): latest_rows(loaded_db)}
+    # a full load drops a row and adds one, a merge changes one
+    update_db(RECORDS[1:] + [record("2022-03-18", "Denver")], database=loaded_db)
+    expected[db.get_generation(sqlite3.connect(loaded_db))] = latest_rows(loaded_db)
+    merge_db([record("2022-03-18", "Denver", lp2=5.0)], database=loaded_db)
+    expected[db.get_generation(sqlite3.connect(loaded_db))] = latest_rows(loaded_db)
+    # nothing changed: no new generation
+    merge_db([record("2022-03-18", "Denver", lp2=5.0)], database=loaded_db)
+
+    conn = sqlite3.connect(loaded_db)
+    assert history.generations(conn) == sorted(expected)
+    for generation, rows in expected.items():
+        assert sorted(history.rebuild(conn, generation), key=repr) == rows
+    # no dated copies of latest
+    assert not [name for name in export.exportable_tables(conn) if name != "latest"]
+
+    generation = min(expected)
+    rebuilt = str(tmp_path / "rebuilt.db")
+    assert archive_tool.rebuild_db(loaded_db, generation, rebuilt) == len(expected[generation])
+    rebuilt_conn = sqlite3.connect(rebuilt)
+    assert db.get_generation(rebuilt_conn) == generation
+    assert db.get_utilities(rebuilt_conn) == ["Arapahoe County", "Boulder"]
+
+    # past the retention window everything folds into the newest generation
+    assert history.compact(conn, retention_days=-1) == max(expected)
+    assert history.generations(conn) == [max(expected)]
+    assert sorted(history.rebuild(conn, max(expected)), key=repr) == expected[max(expected)]
+    # the next run has nothing left to fold, and doesn't rewrite the base
+    changes = conn.total_changes
+    assert history.compact(conn, retention_days=-1) is None
+    assert conn.total_changes == changes
+
+
+def portal_download(features: List[dict]) -> bytes:
+    # fetch_portal_json_data's backup: one page per line
+    pages = [features[i : i + 1_000] for i in range(0, len(features), 1_000)]
+    return b"".join(json.dumps({"features": page}).encode() + b"\n" for page in pages)
+
+
+def test_archive_dedups_restores_and_prunes(tmp_path):
+    features = [
+        {"attributes": {"OBJECTID": i, **record("2022-01-01", f"Utility {i % 60:02d}")}}
+        for i in range(5_000)
+    ]
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    archive_dir = str(data_dir / "archive")
+    first = portal_download(features)
+    (data_dir / "2022-11-18_download.ndjson").write_bytes(first)
+    # the next day: one record edited, a few added
+    features[2_500]["attributes"][CdpheObservation.COPIES_LP2.value] = 9.0
+    features += [
+        {"attributes": {"OBJECTID": 5_000 + i, **record("2022-01-02", "A")}} for i in range(5)
+    ]
+    second = portal_download(features)
+    (data_dir / "2022-11-19_download.ndjson").write_bytes(second)
+
+    stored = archive.store_downloads(str(data_dir), archive_dir)
+    assert not list(data_dir.glob("*.ndjson"))
+    assert stored[1]["new_chunks"] <= 4 < len(stored[1]["chunks"])
+    assert sum(s["stored_bytes"] for s in stored) < len(first) / 4
+    assert archive.restore("2022-11-18_download.ndjson", archive_dir) == first
+    assert archive.restore("2022-11-19_download.ndjson", archive_dir) == second
+
+    # outside the retention window only the first download of the month is kept
+    archive.prune(archive_dir, retention_days=30, today=datetime(2023, 1, 1).date())
+    assert archive.names(archive_dir) == ["2022-11-18_download.ndjson"]
+    assert archive.restore("2022-11-18_download.ndjson", archive_dir) == first
+    chunk_files = list((data_dir / "archive" / "chunks").glob("*/*"))
+    assert len(chunk_files) == len(set(stored[0]["chunks"]))
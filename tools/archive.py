@@ -0,0 +1,108 @@
+"""Manage the raw download archive and the history of `latest`.
+
+usage:
+    python tools/archive.py list
+    python tools/archive.py store data/2022-11-18_download.ndjson
+    python tools/archive.py restore 2022-11-18_download.ndjson -o /tmp/2022-11-18_download.ndjson
+    python tools/archive.py prune [--retention-days 90]
+    python tools/archive.py generations
+    python tools/archive.py rebuild 1668816000 -o /tmp/wastewater-1668816000.db
+    python tools/archive.py compact [--retention-days 365]
+"""
+
+import argparse
+from datetime import datetime
+import logging
+from pathlib import Path
+import sqlite3
+import sys
+
+# enable the script to have access to other modules
+project_root = Path(__file__).resolve().parent.parent
+sys.path.append(str(project_root))
+
+from services import archive, history
+from services.db import (
+    DB_PATH,
+    PROD_TABLE,
+    build_summary_table,
+    build_utilities_table,
+    create_indexes,
+    double_quote,
+    publish_generation,
+)
+
+logger = logging.getLogger(__name__)
+
+DATABASE = DB_PATH
+
+
+def rebuild_db(database: str, generation: int, output: str) -> int:
+    """Write `latest` as of `generation` (with its indexes and lookup tables) to a new db that
+    the API can serve or export from; returns its row count"""
+    if Path(output).exists():
+        raise FileExistsError(output)
+    source = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
+    if generation not in history.generations(source):
+        raise ValueError(f"Generation {generation} is not in the history of {database}")
+    target = sqlite3.connect(output)
+    cols = ", ".join(double_quote(col) for col in history.ROW_COLS)
+    placeholders = ", ".join("?" for _ in history.ROW_COLS)
+    target.execute(f"CREATE TABLE {PROD_TABLE}({cols})")
+    with target:
+        target.executemany(
+            f"INSERT INTO {PROD_TABLE} VALUES ({placeholders})", history.rebuild(source, generation)
+        )
+    create_indexes(target)
+    build_utilities_table(target)
+    build_summary_table(target)
+    publish_generation(target, generation)
+    target.commit()
+    row_count = target.execute(f"SELECT count(*) FROM {PROD_TABLE}").fetchone()[0]
+    target.close()
+    source.close()
+    return row_count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s : %(message)s")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--archive-dir", default=archive.ARCHIVE_DIR)
+    parser.add_argument("--database", default=DATABASE)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="archived downloads")
+    store = commands.add_parser("store", help="archive (and keep) downloaded files")
+    store.add_argument("files", nargs="+")
+    restore = commands.add_parser("restore", help="write an archived download back out")
+    restore.add_argument("name")
+    restore.add_argument("-o", "--output", required=True)
+    prune = commands.add_parser("prune", help="apply the download retention policy")
+    prune.add_argument("--retention-days", type=int, default=archive.RETENTION_DAYS)
+    commands.add_parser("generations", help="generations that can be rebuilt")
+    rebuild = commands.add_parser("rebuild", help="rebuild a generation into a new db file")
+    rebuild.add_argument("generation", type=int)
+    rebuild.add_argument("-o", "--output", required=True)
+    compact = commands.add_parser("compact", help="apply the history retention policy")
+    compact.add_argument("--retention-days", type=int, default=history.RETENTION_DAYS)
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for name in archive.names(args.archive_dir):
+            manifest = archive.read_manifest(name, args.archive_dir)
+            print(f"{name}\t{manifest['size']} bytes\t{len(manifest['chunks'])} chunks")
+    elif args.command == "store":
+        for path in args.files:
+            archive.store(path, args.archive_dir)
+    elif args.command == "restore":
+        Path(args.output).write_bytes(archive.restore(args.name, args.archive_dir))
+    elif args.command == "prune":
+        archive.prune(args.archive_dir, args.retention_days)
+    elif args.command == "generations":
+        conn = sqlite3.connect(args.database)
+        for generation in history.generations(conn):
+            print(f"{generation}\t{datetime.fromtimestamp(generation).isoformat()}")
+    elif args.command == "rebuild":
+        row_count = rebuild_db(args.database, args.generation, args.output)
+        print(f"Wrote {row_count} rows of generation {args.generation} to {args.output}")
+    elif args.command == "compact":
+        history.compact(sqlite3.connect(args.database), args.retention_days)
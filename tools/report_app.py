@@ -7,6 +7,7 @@ URL_BASE = "http://wastewater.jrmontag.xyz"
 API_ROOT = "/api/v1"
 UTILITIES_PATH = f"{URL_BASE}{API_ROOT}/utilities"
 SAMPLES_PATH = f"{URL_BASE}{API_ROOT}/samples"
+AGGREGATE_PATH = f"{SAMPLES_PATH}/aggregate"
 
 
 def main():
@@ -38,7 +39,11 @@ def main():
                     break
             start = end - diff
             param_query = f"?utility={utility}&start={start.isoformat()}&end={end.isoformat()}"
-            resp = requests.get(SAMPLES_PATH + param_query).json()
+            if lookback == "a":
+                # weekly averages, bucketed server-side
+                resp = requests.get(AGGREGATE_PATH + param_query + "&bucket=week").json()
+            else:
+                resp = requests.get(SAMPLES_PATH + param_query).json()
             cleaned_result = [data for data in resp["samples"] if data[1] is not None]
             pprint(cleaned_result)
         else:
@@ -1,14 +1,22 @@
 import argparse
-from csv import DictReader
-from datetime import date, datetime, timedelta
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import csv
+from datetime import date, datetime
+from functools import lru_cache, partial
 import json
+from itertools import islice
 import logging
+import os
 from pathlib import Path
 import sys
-from typing import List, Optional
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
 
 from dateutil import parser as date_parser
 import requests
+from requests.adapters import HTTPAdapter
 from sqlite_utils import Database
 
 # enable the script to have access to other modules
@@ -16,11 +24,22 @@ project_root = Path(__file__).resolve().parent.parent
 sys.path.append(str(project_root))
 
 from models.observation import CdpheObservation
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--csv", help="filepath to csv data file")
-parser.add_argument("--json", help="filepath to json data file")
-args = parser.parse_args()
+from services import archive, history, ingests, replica, scheduler
+from services.db import (
+    DB_PATH,
+    SUMMARY_TABLE,
+    UTILITIES_TABLE,
+    build_summary_table,
+    build_utilities_table,
+    create_indexes,
+    double_quote,
+    drop_indexes,
+    get_generation,
+    next_generation,
+    publish_generation,
+    update_summary,
+)
+from services.metrics import UPDATER_STAGE, Stopwatch, timed
 
 # dataset landing page > View Table > More info >
 # I want to use this... > View Data Source
@@ -32,6 +51,35 @@ PORTAL_URL_ROOT = (
 # see docstring for fetch_portal_data
 PARTIAL_UPDATE_THRESHOLD = 45_000
 
+DATABASE = DB_PATH
+
+ALL_RECORDS = "1=1"
+
+# portal fetch tuning
+FETCH_WORKERS = 4
+FETCH_RETRIES = 4
+FETCH_BACKOFF_SECONDS = 2.0
+REQUEST_TIMEOUT = 30
+
+# distinct dates seen in a load (a few per utility-day); plenty of room for years of data
+DATE_CACHE_SIZE = 16_384
+# date format of the portal's CSV export, e.g. 2022/11/18 00:00:00+00
+CSV_DATE_FORMAT = "%Y/%m/%d %H:%M:%S%z"
+# CSV loads: records per batch handed to a worker process, and how many workers
+CSV_BATCH_ROWS = 20_000
+CSV_WORKERS = min(4, os.cpu_count() or 1)
+# columns of the staging table, in insert order (see create_staging_table)
+STAGING_COLS = [
+    CdpheObservation.DATE.value,
+    CdpheObservation.UTILITY.value,
+    CdpheObservation.COPIES_LP1.value,
+    CdpheObservation.COPIES_LP2.value,
+    CdpheObservation.CASES.value,
+    CdpheObservation.PHASE.value,
+]
+# sqlite settings while bulk inserting into staging; journal_mode stays WAL for the API's readers
+LOAD_PRAGMAS = {"synchronous": "OFF", "cache_size": -256_000, "temp_store": "MEMORY"}
+
 
 def logging_location() -> str:
     log_file = "app.log"
@@ -51,45 +99,152 @@ logging.basicConfig(
 )
 
 
-def get_latest_local_update() -> Optional[date]:
-    """Return the date associated with the local file version of the data"""
-    logger.debug("Checking for latest local update")
-    # assumes cwd = repo root
-    data_dir = Path.cwd() / "data"
-    # file name convention: 2022-11-18_download.(json|csv)
-    # must match naming convention in fetch fn!
-    present_json = list(Path(data_dir).glob("*_download.json"))
-    present_csv = list(Path(data_dir).glob("*_download.csv"))
-    present_data = present_json + present_csv
-    if len(present_data) == 0:
-        logger.warning(f"Found no local data files in {Path(data_dir)}")
-        return None
-    else:
-        latest_data_file = sorted(present_data, reverse=True)[0].parts[-1]
-        latest_date = latest_data_file.split("_")[0]
-        logger.debug(f"Latest local file date: {latest_date}")
-        result = date_parser.parse(latest_date).date()
-        return result
+def edit_date(epoch_ms: int) -> date:
+    return date.fromtimestamp(epoch_ms / 1000.0)
 
 
-def get_latest_portal_update() -> date:
+def get_latest_portal_update(url_root: str = PORTAL_URL_ROOT) -> date:
     """Return the latest update date according to the portal metadata API"""
+    return edit_date(get_latest_portal_edit(url_root))
+
+
+def get_latest_portal_edit(url_root: str = PORTAL_URL_ROOT) -> int:
+    """Return the portal data's last edit timestamp (epoch ms) from its metadata API"""
+    # without validators the request is unconditional, so there is always a timestamp
+    return poll_portal_edit({}, url_root)
+
+
+def poll_portal_edit(validators: dict, url_root: str = PORTAL_URL_ROOT) -> Optional[int]:
+    """Return the portal data's last edit timestamp (epoch ms), or None if the metadata hasn't
+    changed since the response `validators` (ETag, Last-Modified) came from. `validators` is
+    updated in place from each full response."""
     # ref: https://services3.arcgis.com/66aUo8zsujfVXRIT/arcgis/rest/services/
     # CDPHE_COVID19_Wastewater_Dashboard_Data/FeatureServer/0
     # fetch portal data metadata json
     logger.debug("Checking for latest update date from portal metadata")
-    query = PORTAL_URL_ROOT + "?f=pjson"
-    data = requests.get(query).json()
+    query = url_root + "?f=pjson"
+    headers = {}
+    if "ETag" in validators:
+        headers["If-None-Match"] = validators["ETag"]
+    if "Last-Modified" in validators:
+        headers["If-Modified-Since"] = validators["Last-Modified"]
+    response = requests.get(query, headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304:
+        logger.debug("Portal metadata not modified")
+        return None
+    data = response.json()
     if data.get("error"):
         raise Exception(f"Error fetching portal metadata. Response: {data}")
+    validators.clear()
+    validators.update(
+        {
+            name: response.headers[name]
+            for name in ["ETag", "Last-Modified"]
+            if name in response.headers
+        }
+    )
     update_epoch_ms = data["editingInfo"]["dataLastEditDate"]
-    update = date.fromtimestamp(update_epoch_ms / 1000.0)
+    update = edit_date(update_epoch_ms)
     logger.debug(f"Latest reported portal data edit date (epoch ms): {update} ({update_epoch_ms})")
-    return update
+    return update_epoch_ms
+
+
+class PortalFetchError(Exception):
+    pass
+
+
+def portal_session(workers: int = FETCH_WORKERS) -> requests.Session:
+    """Return a session whose keep-alive connection pool is shared by all page fetches"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def portal_query(
+    session: requests.Session,
+    query: str,
+    what: str,
+    check: Callable[[dict], Optional[str]],
+    retries: int = FETCH_RETRIES,
+    backoff: float = FETCH_BACKOFF_SECONDS,
+) -> dict:
+    """GET a portal query, retrying failed responses, and those `check` finds a problem with,
+    with backoff"""
+    for attempt in range(retries + 1):
+        try:
+            with timed(UPDATER_STAGE, stage="fetch"):
+                response = session.get(query, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            data = response.json()
+            if (problem := check(data)) is None:
+                return data
+        except (requests.RequestException, ValueError, KeyError) as e:
+            problem = repr(e)
+        delay = backoff * 2**attempt
+        logger.warning(f"{what} attempt {attempt + 1}: {problem}; wait {delay}s")
+        time.sleep(delay)
+    raise PortalFetchError(f"{what} failed after {retries + 1} attempts")
+
+
+def fetch_portal_record_count(
+    session: requests.Session,
+    url_root: str = PORTAL_URL_ROOT,
+    where: str = ALL_RECORDS,
+    retries: int = FETCH_RETRIES,
+    backoff: float = FETCH_BACKOFF_SECONDS,
+) -> int:
+    """Return the number of records the portal layer currently holds (that match `where`)"""
+    query = url_root + f"/query?where={quote(where)}&returnCountOnly=true&f=json"
+
+    def check(data: dict) -> Optional[str]:
+        return None if "count" in data else f"no count in response {data}"
+
+    return portal_query(session, query, "Portal record count", check, retries, backoff)["count"]
+
+
+def fetch_portal_page(
+    session: requests.Session,
+    offset: int,
+    expected: int,
+    url_root: str = PORTAL_URL_ROOT,
+    retries: int = FETCH_RETRIES,
+    backoff: float = FETCH_BACKOFF_SECONDS,
+    where: str = ALL_RECORDS,
+) -> dict:
+    """Fetch one page of records, retrying failed or truncated responses with backoff"""
+    query = (
+        url_root
+        + f"/query?where={quote(where)}&outFields=*&outSR=4326&f=json&orderByFields=OBJECTID&"
+        + f"resultOffset={offset}&resultRecordCount={expected}"
+    )
+
+    def check(page: dict) -> Optional[str]:
+        received = len(page["features"])
+        if received < expected:
+            return f"truncated page ({received} of {expected} records)"
+        return None
 
+    return portal_query(session, query, f"Portal page {offset=}", check, retries, backoff)
 
-def fetch_portal_json_data(last_update: datetime) -> dict:
-    """Return (and serialize) the current data available through the portal API"""
+
+def edited_since(edit_field: str, since: date) -> str:
+    """Return a portal `where` clause for records edited after `since`"""
+    return f"{edit_field} > timestamp '{since.isoformat()} 00:00:00'"
+
+
+def fetch_portal_json_data(
+    last_update: datetime,
+    url_root: str = PORTAL_URL_ROOT,
+    workers: int = FETCH_WORKERS,
+    backup_dir: str = "data",
+    where: str = ALL_RECORDS,
+    backup_name: str = "download",
+    complete_threshold: int = PARTIAL_UPDATE_THRESHOLD,
+) -> Iterator[dict]:
+    """Yield the pages of data currently available through the portal API, appending each one
+    to a local NDJSON backup as it arrives"""
     logger.debug(f"Fetching new data from portal")
     # "fun" quirks:
     # - the state's API has a max record count response of 32000 ObjectIds
@@ -103,45 +258,50 @@ def fetch_portal_json_data(last_update: datetime) -> dict:
     # enterprise/query-feature-service-layer-.htm
     # - quite often (for unknown reasons) the state's API will return a valid
     # json response with only a subset of the available data and no other
-    # indication of an error. save this partial data with a different pattern
-    # and log it. anecdotally, this situation returns ~20k records.
+    # indication of an error. pages are checked against the layer's record count
+    # and retried (see fetch_portal_page). anecdotally, this situation returns ~20k records.
     chunk_size = 5_000
-    results_cap = 80_000
-    result = dict()
-    offsets = (i * chunk_size for i in range(results_cap // chunk_size))
-    for offset in offsets:
-        logger.debug(f"API request params: {offset=}, {chunk_size=}")
-        query = (
-            PORTAL_URL_ROOT
-            + "/query?where=1%3D1&outFields=*&outSR=4326&f=json&"
-            + f"resultOffset={offset}&resultRecordCount={chunk_size}"
-        )
-        response = requests.get(query).json()
-        if existing_features := result.get("features"):
-            existing_features.extend(response["features"])
-        else:
-            result = response
-        # short-circuit the loop if we've passed beyond the available record count
-        # (the api will return empty array)
-        if len(response["features"]) == 0:
-            break
-    results_size = len(result.get("features", []))
+    results_size = 0
+    session = portal_session(workers)
+    record_count = fetch_portal_record_count(session, url_root, where)
+    logger.debug(f"Portal reports {record_count} records; fetching with {workers=}")
+    offsets = iter(range(0, record_count, chunk_size))
+
+    def submit(executor: ThreadPoolExecutor, offset: int) -> Future:
+        expected = min(chunk_size, record_count - offset)
+        return executor.submit(fetch_portal_page, session, offset, expected, url_root, where=where)
+
+    # side-effect saving latest data, one page per line.
+    # "-partial" marks a download with no more than complete_threshold records
+    last_update_date = last_update.strftime("%Y-%m-%d")
+    partial_local_data = Path(backup_dir) / f"{last_update_date}_{backup_name}-partial.ndjson"
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="portal")
+    try:
+        # keep at most 2x workers pages in flight, and yield them in offset order
+        in_flight = deque(submit(executor, offset) for offset in islice(offsets, 2 * workers))
+        with partial_local_data.open("w") as backup:
+            while in_flight:
+                response = in_flight.popleft().result()
+                if (offset := next(offsets, None)) is not None:
+                    in_flight.append(submit(executor, offset))
+                results_size += len(response["features"])
+                backup.write(json.dumps(response) + "\n")
+                yield response
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        session.close()
     logger.debug(f"Total object count: {results_size}")
 
-    # side-effect saving latest data
-    last_update_date = last_update.strftime("%Y-%m-%d")
-    if results_size > PARTIAL_UPDATE_THRESHOLD:
-        new_local_data = f"data/{last_update_date}_download.json"
+    if results_size > complete_threshold:
+        new_local_data = partial_local_data.with_name(f"{last_update_date}_{backup_name}.ndjson")
+        partial_local_data.rename(new_local_data)
     else:
-        # "-partial" convention will prevent data from matching in get_latest_local_update
-        new_local_data = f"data/{last_update_date}_download-partial.json"
-    Path(new_local_data).write_text(json.dumps(result))
+        new_local_data = partial_local_data
     logger.info(f"Wrote backup of fetched data to {new_local_data}")
-    return result
 
 
 def transform_raw_json_data(raw_data: dict) -> List[dict]:
-    """Convert the downloaded JSON data to the format compatible with bulk loading in DB"""
+    """Convert one page of downloaded JSON data to the format compatible with bulk loading in DB"""
     logger.debug("Transforming raw data to preferred schema")
     try:
         features: List[dict] = raw_data["features"]
@@ -152,21 +312,38 @@ def transform_raw_json_data(raw_data: dict) -> List[dict]:
     if raw_data.get("exceededTransferLimit"):
         logger.debug("ArcGiS transfer limit exceeded; results may be truncated")
     flat_features: List[dict] = []
-    for i, feature in enumerate(features):
+    for feature in features:
         flat_feature: dict = feature["attributes"]
         del flat_feature["OBJECTID"]
         flat_features.append(flat_feature)
-    logger.info(f"Counted {i} observations during data transformation")
+    logger.debug(f"Counted {len(flat_features)} observations during data transformation")
     return flat_features
 
 
+def transform_raw_json_pages(pages: Iterable[dict]) -> Iterator[dict]:
+    """Lazily flatten pages of downloaded JSON data into records for bulk loading"""
+    for page in pages:
+        with timed(UPDATER_STAGE, stage="transform"):
+            records = transform_raw_json_data(page)
+        yield from records
+
+
+def read_json_file(data_file: str) -> Iterator[dict]:
+    """Yield the pages in a local download: NDJSON (one page per line) or a single JSON object"""
+    path = Path(data_file)
+    if path.suffix == ".ndjson":
+        with path.open() as f:
+            for line in f:
+                yield json.loads(line)
+    else:
+        yield json.loads(path.read_text())
+
+
 def update_db_from_json_file(data_file: str) -> None:
     """Manually run a db update from a local JSON download"""
     logger.info(f"Initiating database update from local JSON: {data_file}")
-    raw_data = json.loads(Path(data_file).read_text())
-    xformed_data = transform_raw_json_data(raw_data)
-    tmp_date = (date.today() - timedelta(days=1)).isoformat()
-    update_db(data=xformed_data, latest_local=tmp_date)
+    xformed_data = transform_raw_json_pages(read_json_file(data_file))
+    update_db(data=xformed_data, source=data_file)
 
 
 def fetch_portal_csv_data() -> str | None:
@@ -188,14 +365,39 @@ def fetch_portal_csv_data() -> str | None:
         return None
 
 
-# TODO: consistent date transformations upstream of update_db (remove)
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def epoch_ms_to_iso(epoch_ms: int) -> str:
+    """Convert a portal timestamp (epoch ms) to its YYYY-MM-DD date in local time"""
+    return datetime.fromtimestamp(epoch_ms / 1000.0).date().isoformat()
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def csv_date_to_iso(raw_dt: str) -> str:
+    """Convert a portal CSV date string to YYYY-MM-DD, the same way as its epoch ms value"""
+    try:
+        # strptime wants the export's "+00" offsets as "+0000"
+        dt = datetime.strptime(raw_dt + "00" if raw_dt[-3] in "+-" else raw_dt, CSV_DATE_FORMAT)
+    except (ValueError, IndexError):
+        dt = date_parser.parse(raw_dt)
+    return epoch_ms_to_iso(int(dt.timestamp() * 1000.0))
+
+
+def with_iso_dates(data: Iterable[dict]) -> Iterator[dict]:
+    """Lazily replace epoch ms dates with YYYY-MM-DD strings; other values pass through"""
+    date_col = CdpheObservation.DATE.value
+    for record in data:
+        epoch_ms = record.get(date_col)
+        # dates repeat across utilities, so the conversion is a cache hit for almost every row
+        if isinstance(epoch_ms, (int, float)) and epoch_ms:
+            record[date_col] = epoch_ms_to_iso(epoch_ms)
+        yield record
+
+
 def transform_raw_csv_data(csv_row: dict) -> dict:
     """Adjust the dict to match the expected schema defined in update_db."""
-    # date string -> epoch ms
+    # date string -> YYYY-MM-DD
     raw_dt = csv_row[CdpheObservation.DATE.value]
-    dt = date_parser.parse(raw_dt)
-    epoch_ms = int(dt.timestamp() * 1000.0)
-    csv_row[CdpheObservation.DATE.value] = epoch_ms
+    csv_row[CdpheObservation.DATE.value] = csv_date_to_iso(raw_dt)
     # drop unused field
     del csv_row[CdpheObservation.OBJECTID.value]
     # cast numeric vals (match schema in update_db)
@@ -208,85 +410,501 @@ def transform_raw_csv_data(csv_row: dict) -> dict:
     return csv_row
 
 
-def update_db_from_csv_file(data_file: str) -> None:
+def csv_floats(values: Iterable[str]) -> List[Optional[float]]:
+    """Cast a column of CSV strings to floats; empty or non-numeric values are None"""
+    try:
+        return [float(v) if v else None for v in values]
+    except ValueError:
+        floats = []
+        for v in values:
+            try:
+                floats.append(float(v))
+            except ValueError:
+                floats.append(None)
+        return floats
+
+
+def csv_batch_rows(header: List[str], lines: List[str]) -> List[tuple]:
+    """Parse a batch of CSV lines into typed rows in STAGING_COLS order.
+
+    Converts column by column rather than row by row: one cast per column instead of one dict
+    per row, and dates are converted through the cache.
+    """
+    columns = dict(zip(header, zip(*csv.reader(lines))))
+    try:
+        dates, utilities, lp1, lp2, cases, phases = (columns[col] for col in STAGING_COLS)
+    except KeyError as ke:
+        raise Exception(f"CSV data did not match expected schema. Observed columns: {header}")
+    return list(
+        zip(
+            map(csv_date_to_iso, dates),
+            utilities,
+            csv_floats(lp1),
+            csv_floats(lp2),
+            map(int, cases),
+            phases,
+        )
+    )
+
+
+def read_csv_batches(data_file: str, batch_rows: int = CSV_BATCH_ROWS) -> Iterator[List[str]]:
+    """Yield the CSV's lines in batches of about `batch_rows` records, header line first"""
+    with open(data_file, encoding="utf-8-sig", mode="r", newline="") as f:
+        yield [f.readline()]
+        batch: List[str] = []
+        quotes = 0
+        for line in f:
+            batch.append(line)
+            # a quoted value can span lines; only cut where every quote so far is closed
+            quotes += line.count('"')
+            if len(batch) >= batch_rows and quotes % 2 == 0:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def transform_csv_file(
+    data_file: str, workers: int = CSV_WORKERS, batch_rows: int = CSV_BATCH_ROWS
+) -> Iterator[List[tuple]]:
+    """Lazily parse a local CSV download into batches of typed rows, in `workers` processes"""
+    batches = read_csv_batches(data_file, batch_rows)
+    transform = partial(csv_batch_rows, next(csv.reader(next(batches))))
+    if workers <= 1:
+        for batch in batches:
+            with timed(UPDATER_STAGE, stage="transform"):
+                rows = transform(batch)
+            yield rows
+        return
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        # keep at most 2x workers batches in flight, and yield them in file order
+        in_flight = deque(
+            executor.submit(transform, batch) for batch in islice(batches, 2 * workers)
+        )
+        while in_flight:
+            rows = in_flight.popleft().result()
+            if (batch := next(batches, None)) is not None:
+                in_flight.append(executor.submit(transform, batch))
+            yield rows
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def update_db_from_csv_file(
+    data_file: str,
+    workers: int = CSV_WORKERS,
+    source: Optional[str] = None,
+    portal_edit_ms: Optional[int] = None,
+) -> bool:
     """Manually run a db update from a local CSV download"""
     logger.info(f"Initiating database update from local csv: {data_file}")
-    # read csv with stdlib csv module
-    xformed_data = []
-    with open(data_file, encoding="utf-8-sig", mode="r") as f:
-        reader = DictReader(f)
-        for row in reader:
-            xformed_data.append(transform_raw_csv_data(row))
-    tmp_date = (date.today() - timedelta(days=1)).isoformat()
-    update_db(data=xformed_data, latest_local=tmp_date)
-
-
-def update_db(data: List[dict], latest_local: Optional[str]) -> None:
-    """Update the db to reflect the latest data, including making a backup table"""
+    batches = transform_csv_file(data_file, workers)
+    return update_db(
+        batches, load=load_staging_rows, source=source or data_file, portal_edit_ms=portal_edit_ms
+    )
+
+
+def index_db(db: Database) -> None:
+    """Build the indexes and lookup tables the API queries rely on"""
+    logger.debug(f"Indexing {db.conn} and rebuilding lookup tables")
+    create_indexes(db.conn)
+    build_utilities_table(db.conn)
+    build_summary_table(db.conn)
+
+
+def create_staging_table(db: Database, staging_table: str) -> None:
+    db[staging_table].drop(ignore=True)
+    logger.info(f"Creating and inserting new data to {db.conn} {staging_table=}")
+    # sqlite-utils incorrectly auto-infers a measurement col as string, so set schema manually
+    db[staging_table].create(dict(zip(STAGING_COLS, [str, str, float, float, int, str])))
+
+
+def load_staging(db: Database, data: Iterable[dict], staging_table: str) -> int:
+    """Stream records into a fresh staging table, converting dates to ISO on the way in;
+    returns its row count"""
+    create_staging_table(db, staging_table)
+    # consumes `data` lazily, one batch at a time; time spent waiting on the fetch and transform
+    # stages upstream is tracked separately so that `insert` is sqlite's share alone
+    upstream = Stopwatch(with_iso_dates(data))
+    start = time.perf_counter()
+    db[staging_table].insert_all(records=upstream)
+    elapsed = time.perf_counter() - start
+    UPDATER_STAGE.labels(stage="insert").observe(elapsed - upstream.elapsed)
+    row_count = db[staging_table].count
+    logger.info(
+        f"Loaded {row_count} rows into {staging_table} in {elapsed:.1f}s: "
+        + f"{elapsed - upstream.elapsed:.1f}s inserting, {upstream.elapsed:.1f}s fetch/transform"
+    )
+    return row_count
+
+
+def load_staging_rows(db: Database, batches: Iterable[List[tuple]], staging_table: str) -> int:
+    """Insert batches of typed rows (in STAGING_COLS order) into a fresh staging table in one
+    transaction, with LOAD_PRAGMAS set for its duration; returns its row count"""
+    create_staging_table(db, staging_table)
+    conn = db.conn
+    previous = {name: conn.execute(f"PRAGMA {name}").fetchone()[0] for name in LOAD_PRAGMAS}
+    for name, value in LOAD_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    insert = (
+        f"INSERT INTO {double_quote(staging_table)} VALUES ({', '.join('?' * len(STAGING_COLS))})"
+    )
+    # time spent waiting on the transform stage upstream is tracked separately
+    upstream = Stopwatch(batches)
+    start = time.perf_counter()
+    row_count = 0
+    conn.execute("BEGIN")
+    try:
+        for rows in upstream:
+            conn.executemany(insert, rows)
+            row_count += len(rows)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        for name, value in previous.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+    elapsed = time.perf_counter() - start
+    UPDATER_STAGE.labels(stage="insert").observe(elapsed - upstream.elapsed)
+    logger.info(
+        f"Loaded {row_count} rows into {staging_table} in {elapsed:.1f}s "
+        + f"({row_count / max(elapsed, 1e-9):.0f} rows/s): "
+        + f"{elapsed - upstream.elapsed:.1f}s inserting, {upstream.elapsed:.1f}s transform"
+    )
+    return row_count
+
+
+def update_db(
+    data: Iterable,
+    database: str = DATABASE,
+    min_rows: int = 0,
+    load: Callable[[Database, Iterable, str], int] = load_staging,
+    source: str = "portal",
+    portal_edit_ms: Optional[int] = None,
+) -> bool:
+    """Update the db to reflect the latest data, recording what changed in the history table.
+
+    `data` is streamed into a staging table by `load`: records for load_staging (the default),
+    batches of typed rows for load_staging_rows. The staging table only replaces `latest` if it
+    ends up with more than `min_rows` rows, and its content differs from the last published
+    full load's (unless a merge has changed `latest` since). Every call is recorded in the
+    ingests manifest with `source` and the portal edit timestamp the data reflects. Returns
+    False if too few rows were loaded.
+    """
     logger.debug("Updating local database")
-    database = "data/wastewater.db"
+    started_at = time.time()
     main_table = "latest"
+    staging_table = f"{main_table}_staging"
     db = Database(database)
-    if latest_local and (main_table in db.table_names()):
-        logger.debug(f"Moving {database}[{main_table}] to {database}[{latest_local}]")
-        # move existing content to backup table named by download date
-        db.execute(f"ALTER TABLE `{main_table}` RENAME TO `{latest_local}`")
-
-    logger.info(f"Creating and inserting new data to {database=} {main_table=}")
-    # sqlite-utils incorrectly auto-infers a measurement col as string, so set schema manually
-    db[main_table].create(
-        {
-            CdpheObservation.DATE.value: int,
-            CdpheObservation.UTILITY.value: str,
-            CdpheObservation.COPIES_LP1.value: float,
-            CdpheObservation.COPIES_LP2.value: float,
-            CdpheObservation.CASES.value: int,
-            CdpheObservation.PHASE.value: str,
-        }
+    # let the API's read-only connections keep serving while this process writes
+    db.execute("PRAGMA journal_mode = WAL")
+    history.create_history_table(db.conn)
+    ingests.create_ingests_table(db.conn)
+    ingest = {"kind": "load", "source": source, "portal_edit_ms": portal_edit_ms}
+    try:
+        ingest["row_count"] = row_count = load(db, data, staging_table)
+        if row_count <= min_rows:
+            logger.info(
+                f"Loaded only {row_count} rows ({min_rows=}); keeping existing {main_table}"
+            )
+            db[staging_table].drop()
+            ingests.record_ingest(db.conn, started_at, **ingest, status=ingests.PARTIAL)
+            return False
+
+        with timed(UPDATER_STAGE, stage="hash"):
+            ingest["content_hash"] = ingests.content_hash(db.conn, staging_table)
+        # only a full load's hash describes all of `latest`
+        last = ingests.last_published_load(db.conn)
+        if last and last["content_hash"] == ingest["content_hash"] and db[main_table].exists():
+            # same rows as what's being served: keep the generation, and so the API's caches
+            logger.info(f"Loaded data is identical to ingest {last['id']}; keeping {main_table}")
+            db[staging_table].drop()
+            generation = get_generation(db.conn)
+            ingests.record_ingest(
+                db.conn, started_at, **ingest, status=ingests.UNCHANGED, generation=generation
+            )
+            return True
+
+        # everything the API reads is built next to the live tables, then swapped in at once
+        with timed(UPDATER_STAGE, stage="index"):
+            create_indexes(db.conn, staging_table)
+            build_utilities_table(db.conn, staging_table, target=f"{UTILITIES_TABLE}_staging")
+            build_summary_table(db.conn, staging_table, target=f"{SUMMARY_TABLE}_staging")
+        with timed(UPDATER_STAGE, stage="publish"):
+            generation = publish_staging(db, staging_table)
+    except Exception as e:
+        ingests.record_ingest(db.conn, started_at, **ingest, status=ingests.FAILED, error=repr(e))
+        raise
+    ingests.record_ingest(db.conn, started_at, **ingest, status=ingests.OK, generation=generation)
+    logger.info(f"Table names in current db: {db.table_names()}")
+    logger.info(f"Published dataset generation {generation} ({row_count} rows)")
+    publish_replica(db)
+    return True
+
+
+def publish_replica(db: Database) -> None:
+    """Publish the db's generation for replica nodes, if this is a primary (see
+    services/replica.py)"""
+    if replica.PUBLISH_DIR:
+        with timed(UPDATER_STAGE, stage="replicate"):
+            replica.publish(db.conn, replica.PUBLISH_DIR)
+
+
+def publish_staging(db: Database, staging_table: str) -> int:
+    """Replace `latest` and its lookup tables with their staged versions in one transaction.
+
+    Readers (in WAL mode) see either the old tables or the new ones, never a missing or
+    half-built `latest`. The rows that differ between the two are appended to the history
+    table under the new dataset generation, which is returned.
+    """
+    main_table = "latest"
+    conn = db.conn
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        generation = next_generation(conn)
+        previous = main_table if main_table in db.table_names() else None
+        changes = history.record_changes(conn, generation, staging_table, previous)
+        logger.debug(f"Recorded {changes} changed rows in {history.HISTORY_TABLE}")
+        if previous:
+            drop_indexes(conn, main_table)
+            conn.execute(f"DROP TABLE `{main_table}`")
+        conn.execute(f"ALTER TABLE `{staging_table}` RENAME TO `{main_table}`")
+        for lookup_table in [UTILITIES_TABLE, SUMMARY_TABLE]:
+            conn.execute(f"DROP TABLE IF EXISTS `{lookup_table}`")
+            conn.execute(f"ALTER TABLE `{lookup_table}_staging` RENAME TO `{lookup_table}`")
+        publish_generation(conn, generation)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return generation
+
+
+def merge_db(
+    data: Iterable[dict],
+    database: str = DATABASE,
+    source: str = "portal",
+    portal_edit_ms: Optional[int] = None,
+) -> Tuple[int, int]:
+    """Upsert records into the existing `latest` table, touching only rows that changed.
+
+    Rows are matched on their natural key (Utility, Date, Lab Phase). Rows missing from `data`
+    are left alone, so a partial download can't remove data. The merge is recorded in the
+    ingests manifest, as for update_db. Returns (inserted, updated) counts.
+    """
+    logger.debug("Merging into local database")
+    started_at = time.time()
+    main_table = "latest"
+    delta_table = f"{main_table}_delta"
+    db = Database(database)
+    db.execute("PRAGMA journal_mode = WAL")
+    if main_table not in db.table_names():
+        raise Exception(f"Incremental update needs an existing {main_table} table")
+    if SUMMARY_TABLE not in db.table_names():
+        build_summary_table(db.conn)
+    history.create_history_table(db.conn)
+    ingests.create_ingests_table(db.conn)
+    ingest = {"kind": "merge", "source": source, "portal_edit_ms": portal_edit_ms}
+    try:
+        ingest["row_count"] = row_count = load_staging(db, data, delta_table)
+        ingest["content_hash"] = ingests.content_hash(db.conn, delta_table)
+        inserted, updated = apply_delta(db, delta_table)
+    except Exception as e:
+        ingests.record_ingest(db.conn, started_at, **ingest, status=ingests.FAILED, error=repr(e))
+        raise
+    finally:
+        db[delta_table].drop(ignore=True)
+    logger.info(f"Merged {row_count} rows into {main_table}: {inserted=}, {updated=}")
+    status = ingests.OK if inserted or updated else ingests.UNCHANGED
+    ingests.record_ingest(
+        db.conn, started_at, **ingest, status=status, generation=get_generation(db.conn)
     )
-    db[main_table].insert_all(records=data)
+    if status == ingests.OK:
+        publish_replica(db)
+    return inserted, updated
 
-    logger.debug(f"Transforming date to ISO format in {database=} {main_table=}")
-    # epoch -> YYYY-MM-DD
-    db[main_table].convert(
-        CdpheObservation.DATE.value, lambda x: datetime.fromtimestamp(x / 1000.0).date().isoformat()
-    )
-    names = db.table_names()
-    logger.info(f"Table names in current db: {names}")
+
+def apply_delta(db: Database, delta_table: str) -> Tuple[int, int]:
+    """Upsert `delta_table` into `latest` in one transaction, publishing a new generation if
+    anything changed; returns (inserted, updated) counts"""
+    main_table = "latest"
+    key_cols = [
+        CdpheObservation.UTILITY.value,
+        CdpheObservation.DATE.value,
+        CdpheObservation.PHASE.value,
+    ]
+    value_cols = [
+        CdpheObservation.COPIES_LP1.value,
+        CdpheObservation.COPIES_LP2.value,
+        CdpheObservation.CASES.value,
+    ]
+    # IS rather than = so that NULLs compare equal
+    same_key = " AND ".join(f"m.`{col}` IS d.`{col}`" for col in key_cols)
+    changed = " OR ".join(f"m.`{col}` IS NOT d.`{col}`" for col in value_cols)
+    assignments = ", ".join(f"`{col}` = d.`{col}`" for col in value_cols)
+    cols = ", ".join(f"`{col}`" for col in key_cols + value_cols)
+    utility = CdpheObservation.UTILITY.value
+    history_cols = ", ".join(double_quote(col) for col in history.ROW_COLS)
+    key = ", ".join(f"`{col}`" for col in key_cols)
+    # everything commits together, so readers see the old or the new rows, never a mix
+    with timed(UPDATER_STAGE, stage="merge"), db.conn:
+        # one row per key, the last one downloaded, or the statements below would disagree on
+        # which duplicate applies (GROUP BY, like IS, treats NULLs as equal)
+        duplicates = db.execute(
+            f"DELETE FROM `{delta_table}` WHERE rowid NOT IN "
+            + f"(SELECT max(rowid) FROM `{delta_table}` GROUP BY {key})"
+        ).rowcount
+        if duplicates:
+            logger.warning(f"Dropped {duplicates} delta rows with a duplicate ({key}) key")
+        generation = next_generation(db.conn)
+        # the versions about to be replaced, and the delta rows that aren't in `latest` yet
+        db.execute(
+            f"INSERT INTO {history.HISTORY_TABLE} SELECT ?, -1, {history_cols} "
+            + f"FROM `{main_table}` WHERE rowid IN (SELECT m.rowid FROM `{main_table}` AS m "
+            + f"JOIN `{delta_table}` AS d ON {same_key} WHERE {changed})",
+            [generation],
+        )
+        db.execute(
+            f"INSERT INTO {history.HISTORY_TABLE} SELECT ?, 1, {history_cols} "
+            + f"FROM `{delta_table}` AS d WHERE NOT EXISTS "
+            + f"(SELECT 1 FROM `{main_table}` AS m WHERE {same_key} AND NOT ({changed}))",
+            [generation],
+        )
+        updated = db.execute(
+            f"UPDATE `{main_table}` AS m SET {assignments} FROM `{delta_table}` AS d "
+            + f"WHERE {same_key} AND ({changed})"
+        ).rowcount
+        inserted = db.execute(
+            f"INSERT INTO `{main_table}` ({cols}) SELECT {cols} FROM `{delta_table}` AS d "
+            + f"WHERE NOT EXISTS (SELECT 1 FROM `{main_table}` AS m WHERE {same_key})"
+        ).rowcount
+        db.execute(
+            f"INSERT OR IGNORE INTO `{UTILITIES_TABLE}` "
+            + f"SELECT DISTINCT `{utility}` FROM `{delta_table}` WHERE `{utility}` IS NOT NULL"
+        )
+        if inserted or updated:
+            changed_utilities = db.execute(
+                f"SELECT DISTINCT `{utility}` FROM `{delta_table}` WHERE `{utility}` IS NOT NULL"
+            ).fetchall()
+            update_summary(db.conn, [name for (name,) in changed_utilities])
+            publish_generation(db.conn, generation)
+            logger.info(f"Published dataset generation {generation}")
+        else:
+            # nothing changed, so serving caches stay valid
+            logger.info("No changes; keeping current dataset generation")
+    return inserted, updated
+
+
+def update_from_portal(portal_edit_ms: int, csv_workers: int = CSV_WORKERS) -> bool:
+    """Fetch the portal's data as of its last edit (epoch ms) and load it, falling back to its
+    CSV export if the JSON API returns partial data; returns whether the db is up to date"""
+    latest_pages = fetch_portal_json_data(edit_date(portal_edit_ms))
+    transformed_data = transform_raw_json_pages(latest_pages)
+    # don't update the DB with partial data - the front-end ux is bad
+    # see docstring for fetch_portal_data
+    try:
+        updated = update_db(
+            data=transformed_data, min_rows=PARTIAL_UPDATE_THRESHOLD, portal_edit_ms=portal_edit_ms
+        )
+    except PortalFetchError as e:
+        logger.error(f"Portal JSON fetch failed: {e}")
+        updated = False
+    if not updated:
+        logger.info("Fetched + transformed data is unusually small - skipping update.")
+        # try csv update
+        if csv_file := fetch_portal_csv_data():
+            updated = update_db_from_csv_file(csv_file, csv_workers, "portal csv", portal_edit_ms)
+            logging.info("Updated DB from CSV import")
+        else:
+            logger.info("CSV portal fetch unsuccessful")
+    return updated
+
+
+def archive_downloads(database: str = DATABASE) -> None:
+    """Move raw downloads into the compressed archive instead of letting them pile up in data/,
+    and apply the archive's and the history's retention"""
+    archive.store_downloads("data")
+    archive.prune()
+    history.compact(Database(database).conn)
 
 
 if __name__ == "__main__":
-    if args.csv:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--csv", help="filepath to csv data file")
+    parser.add_argument("--json", help="filepath to json data file")
+    parser.add_argument(
+        "--reindex", action="store_true", help="rebuild indexes and lookup tables in place"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="upsert changed rows into the existing latest table instead of rebuilding it",
+    )
+    parser.add_argument(
+        "--edit-field",
+        help="with --incremental, portal field (e.g. EditDate) used to fetch only rows edited "
+        + "since the last local update",
+    )
+    args = parser.parse_args()
+
+    # loads share the staging tables, so only one may run at a time: the service's refresh leader
+    # (see services/scheduler.py) takes the same lock while it loads. Held until this process exits
+    if scheduler.acquire_lock(scheduler.LOAD_LOCK_PATH) is None:
+        holder = scheduler.lock_holder(scheduler.LOAD_LOCK_PATH)
+        logger.error(
+            f"Another load (pid {holder}) holds {scheduler.LOAD_LOCK_PATH}; exiting without loading"
+        )
+        sys.exit(1)
+
+    if args.reindex:
+        reindexed = Database(DATABASE)
+        index_db(reindexed)
+        publish_generation(reindexed.conn)
+        publish_replica(reindexed)
+    elif args.csv:
         update_db_from_csv_file(args.csv)
+    elif args.json and args.incremental:
+        records = transform_raw_json_pages(read_json_file(args.json))
+        inserted, updated = merge_db(records, source=args.json)
+        logger.info(f"Inserted {inserted} rows, updated {updated} rows")
     elif args.json:
         update_db_from_json_file(args.json)
+    elif args.incremental:
+        logger.info("> Starting new incremental run of data fetch")
+        latest_local_edit = ingests.latest_portal_edit(Database(DATABASE).conn)
+        latest_portal_edit = get_latest_portal_edit()
+        where = ALL_RECORDS
+        if args.edit_field and latest_local_edit:
+            where = edited_since(args.edit_field, edit_date(latest_local_edit))
+        logger.info(f"Fetching portal records where {where}")
+        latest_pages = fetch_portal_json_data(
+            edit_date(latest_portal_edit),
+            where=where,
+            backup_name="delta_download",
+            complete_threshold=0,
+        )
+        records = transform_raw_json_pages(latest_pages)
+        inserted, updated = merge_db(records, portal_edit_ms=latest_portal_edit)
+        logger.info(f"Inserted {inserted} rows, updated {updated} rows")
     else:
         logger.info("> Starting new run of data check/fetch")
-        latest_local_update: Optional[date] = get_latest_local_update()
-        latest_portal_update: date = get_latest_portal_update()
+        # the portal edit the data on hand reflects, from the ingests manifest
+        latest_local_edit: Optional[int] = ingests.latest_portal_edit(Database(DATABASE).conn)
+        latest_portal_edit: int = get_latest_portal_edit()
 
         # simpler logs
-        local_date = latest_local_update.isoformat() if latest_local_update else None
-        portal_date = latest_portal_update.isoformat()
+        local_date = edit_date(latest_local_edit).isoformat() if latest_local_edit else None
+        portal_date = edit_date(latest_portal_edit).isoformat()
         comparison = f"portal date (local date): {portal_date} ({local_date})"
         logger.info(f"Observed latest updates -> {comparison}")
 
-        if (not latest_local_update) or (latest_portal_update > latest_local_update):
+        if (not latest_local_edit) or (latest_portal_edit > latest_local_edit):
             logger.info("Initiating data update")
-            latest_data = fetch_portal_json_data(latest_portal_update)
-            transformed_data = transform_raw_json_data(latest_data)
-            # don't update the DB with partial data - the front-end ux is bad
-            # see docstring for fetch_portal_data
-            if len(transformed_data) > PARTIAL_UPDATE_THRESHOLD:
-                update_db(data=transformed_data, latest_local=local_date)
-            else:
-                logger.info("Fetched + transformed data is unusually small - skipping update.")
-                # try csv update
-                if csv_file := fetch_portal_csv_data():
-                    update_db_from_csv_file(csv_file)
-                    logging.info("Updated DB from CSV import")
-                else:
-                    logger.info("CSV portal fetch unsuccessful")
+            update_from_portal(latest_portal_edit)
         else:
             logger.info(f"Not updating local data files")
+    if not (args.reindex or args.csv or args.json):
+        archive_downloads()
     logger.info("Completed run of data check/fetch")
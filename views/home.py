@@ -1,17 +1,24 @@
+from functools import lru_cache
 import logging
 import fastapi
 from starlette.requests import Request
-from starlette.templating import Jinja2Templates
 
-templates = Jinja2Templates("templates")
 router = fastapi.APIRouter()
 
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=None)
+def get_templates():
+    # jinja2 is only needed for the home page; load it on the first request for it
+    from starlette.templating import Jinja2Templates
+
+    return Jinja2Templates("templates")
+
+
 @router.get("/")
 def index(request: Request):
-    return templates.TemplateResponse("home/index.html", {"request": request})
+    return get_templates().TemplateResponse("home/index.html", {"request": request})
 
 
 @router.get("/favicon.ico")